@@ -0,0 +1,89 @@
+"""
+Latency of Vectorizer.transform_one, compared with transform([x]).
+
+Usage: PYTHONPATH=. python benchmarks/transform_one.py [REPETITIONS]
+
+Fits a vectorizer with a typical mix of features (numbers, an enumerated
+value, a number sequence and a bag of words) and measures the time taken to
+transform a single data point, printing the mean, 50th, 90th and 99th
+percentiles in microseconds for dense and sparse results.
+"""
+import random
+import sys
+from timeit import default_timer
+
+from featureforge.feature import input_schema, output_schema
+from featureforge.vectorizer import Vectorizer
+
+WORDS = [u"word%d" % i for i in range(500)]
+COLORS = [u"red", u"green", u"blue", u"black"]
+
+
+@input_schema({"price": float})
+@output_schema(float)
+def price(d):
+    return d["price"]
+
+
+@input_schema({"quantity": int})
+def quantity(d):
+    return d["quantity"]
+
+
+@input_schema({"color": str})
+def color(d):
+    return d["color"]
+
+
+def position(d):
+    return [d["x"], d["y"]]
+
+
+def words(d):
+    return d["words"]
+
+
+def data_point(rng):
+    return {"price": rng.random() * 100, "quantity": rng.randrange(10),
+            "color": rng.choice(COLORS), "x": rng.random(),
+            "y": rng.random(), "words": rng.sample(WORDS, 10)}
+
+
+def percentile(times, q):
+    return times[int(round(q / 100.0 * (len(times) - 1)))]
+
+
+def measure(function, X):
+    times = []
+    for x in X:
+        start = default_timer()
+        function(x)
+        times.append(default_timer() - start)
+    times.sort()
+    mean = sum(times) / len(times)
+    return [1e6 * t for t in (mean, percentile(times, 50),
+                              percentile(times, 90), percentile(times, 99))]
+
+
+def main(repetitions=10000):
+    rng = random.Random(42)
+    train = [data_point(rng) for _ in range(1000)]
+    X = [data_point(rng) for _ in range(repetitions)]
+    features = [price, quantity, color, position, words]
+    header = (u"(microseconds)", u"mean", u"p50", u"p90", u"p99")
+    print(u"%-28s %9s %9s %9s %9s" % header)
+    for sparse in (False, True):
+        for validation in ("always", "never"):
+            v = Vectorizer(features, sparse=sparse, validation=validation)
+            v.fit(train)
+            kind = u"sparse" if sparse else u"dense"
+            for name, function in [
+                    (u"transform_one", v.transform_one),
+                    (u"transform([x])", lambda x: v.transform([x]))]:
+                label = u"%s %s %s" % (kind, validation, name)
+                print(u"%-28s %9.1f %9.1f %9.1f %9.1f" %
+                      ((label,) + tuple(measure(function, X))))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,357 @@
+"""
+Persistent cache of feature values.
+
+Experiments often evaluate the same features on the same data points over
+and over. Evaluators given a `FeatureCache` store every value computed in a
+local SQLite database, and load it instead of evaluating the feature again
+the next time, even on a different process or run.
+
+Values are stored by feature and data point:
+
+ * Features are identified by their name and a fingerprint of their code
+   (see `feature_fingerprint`), so changing a feature invalidates its values
+   while the values of unchanged features are still used. The fingerprint
+   covers the functions, classes and constants the feature uses by name
+   from its module (and from the modules it uses by name), but not the
+   code of installed packages nor data read from elsewhere (files,
+   databases, mutable objects modified at runtime). A feature can also
+   define a `version` attribute to be identified by it instead of its
+   code; bump it when something the fingerprint can't see changes.
+ * Data points are identified by their `pk` (a key or attribute of that
+   name), or by the result of the `key` function given to the cache. Data
+   points without a key are not cached.
+
+The cache holds at most `max_entries` values, evicting the least recently
+used ones. Values are pickled, and are returned as stored, without being
+validated again.
+"""
+from functools import partial
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import sysconfig
+import threading
+import types
+
+from featureforge.feature import SharedComputation
+
+# Default bound for the amount of values stored
+CACHE_MAX_ENTRIES = 10 ** 7
+# Amount of values read or written between commits to the database
+CACHE_FLUSH_SIZE = 1000
+
+_MISSING = object()
+
+
+def data_point_key(data_point):
+    """
+    Default key of the data points: their `pk` key or attribute (None if
+    there is none)
+    """
+    try:
+        return data_point.get('pk')
+    except AttributeError:
+        return getattr(data_point, 'pk', None)
+
+
+# Directories of the standard library and installed packages, whose code is
+# not part of the fingerprints
+_LIBRARY_PATHS = tuple(set(
+    os.path.join(os.path.realpath(path), "")
+    for name, path in sysconfig.get_paths().items()
+    if name in ("stdlib", "platstdlib", "purelib", "platlib")))
+
+
+def _is_library(obj):
+    # True if obj is a module, or is defined in a module, that is built-in,
+    # from the standard library or from an installed package
+    module = obj
+    if not isinstance(obj, types.ModuleType):
+        module = sys.modules.get(getattr(obj, '__module__', None))
+        if module is None:
+            return False
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return True
+    return os.path.realpath(path).startswith(_LIBRARY_PATHS)
+
+
+def _code_names(code, names):
+    # Adds to `names` the global names used by code and its nested functions
+    names.update(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _code_names(const, names)
+    return names
+
+
+def _update_globals(h, function, seen):
+    # Hashes the helpers and constants `function` uses from its module, and
+    # the ones it uses through other modules (like helpers.tokenize)
+    namespace = getattr(function, '__globals__', None)
+    if not namespace:
+        return
+    names = sorted(_code_names(function.__code__, set()))
+    for name in names:
+        value = namespace.get(name, _MISSING)
+        if value is _MISSING or value is function or _is_library(value):
+            continue
+        if isinstance(value, types.ModuleType):
+            for attribute in names:
+                used = getattr(value, attribute, _MISSING)
+                if used is not _MISSING and not _is_library(used):
+                    h.update(attribute.encode("utf-8"))
+                    _update_hash(h, used, seen)
+        else:
+            h.update(name.encode("utf-8"))
+            _update_hash(h, value, seen)
+
+
+def _update_hash(h, obj, seen):
+    # Hashes the code of obj and of everything it calls that featureforge
+    # knows about (wrapped functions, partials, shared computations, global
+    # helpers and constants...)
+    if isinstance(obj, (int, float, str, bytes, type(None))):
+        # Values captured by closures or used as global constants
+        h.update(repr(obj).encode("utf-8"))
+        return
+    if isinstance(obj, (set, frozenset)):
+        h.update(b"set")
+        for value in sorted(repr(value) for value in obj):
+            h.update(value.encode("utf-8"))
+        return
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, (tuple, list)):
+        h.update(type(obj).__name__.encode("utf-8"))
+        for value in obj:
+            _update_hash(h, value, seen)
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for key, value in sorted(obj.items(), key=lambda i: repr(i[0])):
+            _update_hash(h, key, seen)
+            _update_hash(h, value, seen)
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        h.update(repr(obj.co_names).encode("utf-8"))
+        for const in obj.co_consts:
+            if isinstance(const, types.CodeType):
+                _update_hash(h, const, seen)
+            else:
+                h.update(repr(const).encode("utf-8"))
+    elif isinstance(obj, partial):
+        _update_hash(h, obj.func, seen)
+        for arg in obj.args:
+            _update_hash(h, arg, seen)
+    elif isinstance(obj, SharedComputation):
+        _update_hash(h, obj.function, seen)
+    elif isinstance(obj, types.MethodType):
+        _update_hash(h, obj.__func__, seen)
+    elif hasattr(obj, '__code__'):
+        _update_hash(h, obj.__code__, seen)
+        for cell in obj.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:
+                continue  # Empty cell
+            # Mutable values captured by closures are usually state (like
+            # counters or buffers), not part of what the feature computes
+            if not isinstance(value, (list, dict, set)):
+                _update_hash(h, value, seen)
+        _update_hash(h, getattr(obj, '__wrapped__', None), seen)
+        for dependency in getattr(obj, '_dependencies', ()):
+            _update_hash(h, dependency, seen)
+        if not _is_library(obj):
+            _update_globals(h, obj, seen)
+    elif isinstance(obj, type) and not _is_library(obj):
+        # Classes defined by the user, through their methods
+        h.update(obj.__name__.encode("utf-8"))
+        for name, attribute in sorted(vars(obj).items()):
+            attribute = getattr(attribute, '__func__', attribute)
+            if hasattr(attribute, '__code__'):
+                h.update(name.encode("utf-8"))
+                _update_hash(h, attribute, seen)
+
+
+def feature_fingerprint(feature):
+    """
+    Returns a string identifying the code of `feature`, which changes when
+    the feature is modified. Features with a `version` attribute are
+    identified by it instead.
+    """
+    version = getattr(feature, 'version', None)
+    if version is not None:
+        return u"v%s" % (version,)
+    h = hashlib.sha1()
+    seen = set()
+    h.update(type(feature).__name__.encode("utf-8"))
+    for name in ('_evaluate', '_evaluate_batch'):
+        _update_hash(h, getattr(feature, name, None), seen)
+    if not hasattr(feature, '_evaluate'):
+        _update_hash(h, feature, seen)
+    return h.hexdigest()[:16]
+
+
+class FeatureCache(object):
+    """
+    FeatureCache(path) stores feature values in the SQLite database `path`
+    (created if needed). `max_entries` bounds the amount of values stored,
+    and `key` is the function giving the key of each data point.
+
+    The cache can be shared by threads, and pickled (the database is opened
+    again when used). Values read and written are committed in batches, call
+    `flush` to commit them right away; evaluators do it when they finish.
+    The values are counted when the database is opened, so values written by
+    other processes afterwards are not taken into account by `max_entries`.
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES,
+                 key=data_point_key):
+        self.path = path
+        self.max_entries = max_entries
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_connection'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS feature_values ("
+                       "feature TEXT, key TEXT, value BLOB, used INTEGER, "
+                       "PRIMARY KEY (feature, key))")
+            db.execute("CREATE INDEX IF NOT EXISTS feature_values_used "
+                       "ON feature_values (used)")
+            self._clock = db.execute("SELECT MAX(used) FROM feature_values"
+                                     ).fetchone()[0] or 0
+            # Kept up to date when storing and evicting values, so flushing
+            # doesn't need to count them
+            self._count = db.execute("SELECT COUNT(*) FROM feature_values"
+                                     ).fetchone()[0]
+            self._pending = 0
+            self._used = []
+            self._connection = db
+        return self._connection
+
+    def feature_id(self, feature):
+        """The identifier of `feature` in the cache: name and fingerprint"""
+        name = getattr(feature, 'name', None) or getattr(
+            feature, '__name__', repr(feature))
+        return u"%s:%s" % (name, feature_fingerprint(feature))
+
+    def get(self, feature_id, key, default=None):
+        """Returns the value stored for the data point `key`, or `default`"""
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT value FROM feature_values "
+                             "WHERE feature = ? AND key = ?",
+                             (feature_id, repr(key))).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Updating the recency of the value is deferred until flushing
+            self._clock += 1
+            self._used.append((self._clock, feature_id, repr(key)))
+            self._step()
+            return pickle.loads(bytes(row[0]))
+
+    def set(self, feature_id, key, value):
+        """Stores the value of the feature `feature_id` for the data point"""
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            db = self._connect()
+            self._clock += 1
+            inserted = db.execute("INSERT OR IGNORE INTO feature_values "
+                                  "VALUES (?, ?, ?, ?)",
+                                  (feature_id, repr(key), value, self._clock)
+                                  ).rowcount
+            if inserted:
+                self._count += 1
+            else:
+                db.execute("UPDATE feature_values SET value = ?, used = ? "
+                           "WHERE feature = ? AND key = ?",
+                           (value, self._clock, feature_id, repr(key)))
+            self._step()
+
+    def _step(self):
+        self._pending += 1
+        if self._pending >= CACHE_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Commits the pending changes, evicting values if needed"""
+        with self._lock:
+            db = self._connection
+            if db is None:
+                return
+            if self._used:
+                db.executemany("UPDATE feature_values SET used = ? "
+                               "WHERE feature = ? AND key = ?", self._used)
+                self._used = []
+            excess = self._count - self.max_entries
+            if excess > 0:
+                self._count -= db.execute(
+                    "DELETE FROM feature_values WHERE rowid IN ("
+                    "SELECT rowid FROM feature_values "
+                    "ORDER BY used LIMIT ?)", (excess,)).rowcount
+            db.commit()
+            self._pending = 0
+
+    def clear(self):
+        """Removes every value stored"""
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM feature_values")
+            db.commit()
+            self._count = 0
+            self._used = []
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self.flush()
+                self._connection.close()
+                self._connection = None
+
+    def __len__(self):
+        with self._lock:
+            db = self._connect()
+            return db.execute("SELECT COUNT(*) FROM feature_values"
+                              ).fetchone()[0]
+
+    def cached(self, feature, function):
+        """
+        Returns a function equivalent to `function` (which evaluates
+        `feature`) that loads the values from the cache when possible, and
+        stores the values it computes.
+        """
+        feature_id = self.feature_id(feature)
+        get_key = self.key
+
+        def cached(data_point):
+            key = get_key(data_point)
+            if key is None:
+                return function(data_point)
+            value = self.get(feature_id, key, _MISSING)
+            if value is _MISSING:
+                value = function(data_point)
+                self.set(feature_id, key, value)
+            return value
+        return cached
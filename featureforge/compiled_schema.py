@@ -0,0 +1,208 @@
+"""
+Compilation of schemas into specialized validation functions.
+
+Validating with `schema.Schema` inspects the schema definition on every call
+(and builds new `Schema` objects for every element of containers, every
+argument of `And`/`Or` and every key/value of dictionaries). Feature schemas
+never change after being defined, so here that inspection is done once,
+building a closure that does only the checks needed for the given schema.
+
+The resulting validators accept and reject the same values, return the same
+results, and raise `schema.SchemaError` with the same messages as
+`schema.Schema(s, error=e).validate` does.
+"""
+import schema
+from schema import And, Optional, Or, Schema, SchemaError
+
+
+def _validate_function(cls):
+    # Unbound method on python 2, plain function on python 3
+    return getattr(cls.validate, '__func__', cls.validate)
+
+
+def _identity(data):
+    return data
+
+
+def compile_schema(s, error=None):
+    """
+    Returns a function equivalent to `schema.Schema(s, error=error).validate`
+    """
+    T = type(s)
+    if T in (list, tuple, set, frozenset):
+        return _compile_container(s, error)
+    if T is dict:
+        return _compile_dict(s, error)
+    if hasattr(s, 'validate'):
+        return _compile_validator(s, error)
+    if issubclass(T, type):
+        return _compile_type(s, error)
+    if callable(s):
+        return _compile_predicate(s, error)
+    return _compile_literal(s, error)
+
+
+def _compile_type(s, error):
+    if s is object:
+        # Everything is an object, so there is nothing to check
+        return _identity
+
+    def validate(data):
+        if isinstance(data, s):
+            return data
+        raise SchemaError('%r should be instance of %r' % (data, s), error)
+    return validate
+
+
+def _compile_predicate(s, error):
+    def validate(data):
+        try:
+            if s(data):
+                return data
+        except SchemaError as x:
+            raise SchemaError([None] + x.autos, [error] + x.errors)
+        except BaseException as x:
+            raise SchemaError('%s(%r) raised %r' % (s.__name__, data, x),
+                              error)
+        raise SchemaError('%s(%r) should evaluate to True' %
+                          (s.__name__, data), error)
+    return validate
+
+
+def _compile_literal(s, error):
+    def validate(data):
+        if s == data:
+            return data
+        raise SchemaError('%r does not match %r' % (s, data), error)
+    return validate
+
+
+def _compile_container(s, error):
+    T = type(s)
+    validate_type = _compile_type(T, error)
+    validate_item = _compile_or(Or(*s, error=error))
+
+    def validate(data):
+        data = validate_type(data)
+        return T(validate_item(d) for d in data)
+    return validate
+
+
+def _compile_dict(s, error):
+    validate_type = _compile_type(dict, error)
+    required = set(k for k in s if type(k) is not Optional)
+    # Keys with literal values (the usual case, like 'description' in
+    # {'description': str}) are checked first by schema, so they can be
+    # looked up in a dictionary instead of tried one by one.
+    literals = {}
+    others = []
+    for skey in sorted(s, key=schema.priority):
+        entry = (skey, compile_schema(s[skey], error), skey in required)
+        if schema.priority(skey) == 1:
+            literals.setdefault(skey, entry)
+        else:
+            others.append((compile_schema(skey, error),) + entry)
+
+    def validate(data):
+        data = validate_type(data)
+        new = type(data)()
+        coverage = set()
+        for key, value in data.items():
+            if key in literals:
+                skey, validate_value, is_required = literals[key]
+                new[key] = validate_value(value)
+                if is_required:
+                    coverage.add(skey)
+                continue
+            for validate_key, skey, validate_value, is_required in others:
+                try:
+                    nkey = validate_key(key)
+                except SchemaError:
+                    continue
+                new[nkey] = validate_value(value)
+                if is_required:
+                    coverage.add(skey)
+                break
+        if coverage != required:
+            raise SchemaError('missed keys %r' % (required - coverage), error)
+        if len(new) != len(data):
+            wrong_keys = set(data.keys()) - set(new.keys())
+            s_wrong_keys = ', '.join('%r' % k for k in sorted(wrong_keys))
+            raise SchemaError('wrong keys %s in %r' % (s_wrong_keys, data),
+                              error)
+        return new
+    return validate
+
+
+def _compile_and(s):
+    validators = tuple(compile_schema(a, s._error) for a in s._args)
+    if len(validators) == 1:
+        return validators[0]
+
+    def validate(data):
+        for v in validators:
+            data = v(data)
+        return data
+    return validate
+
+
+def _compile_or(s):
+    validators = tuple(compile_schema(a, s._error) for a in s._args)
+
+    def validate(data):
+        x = SchemaError([], [])
+        for v in validators:
+            try:
+                return v(data)
+            except SchemaError as _x:
+                x = _x
+        raise SchemaError(['%r did not validate %r' % (s, data)] + x.autos,
+                          [s._error] + x.errors)
+    return validate
+
+
+def _compile_validator(s, error):
+    # Objects with a validate method are called and their errors wrapped
+    if isinstance(s, CompiledSchema):
+        inner = s._validate
+    elif (isinstance(s, Schema) and
+          _validate_function(type(s)) is _validate_function(Schema)):
+        inner = compile_schema(s._schema, s._error)
+    elif type(s) is And:
+        inner = _compile_and(s)
+    elif type(s) is Or:
+        inner = _compile_or(s)
+    else:
+        inner = s.validate
+
+    def validate(data):
+        try:
+            return inner(data)
+        except SchemaError as x:
+            raise SchemaError([None] + x.autos, [error] + x.errors)
+        except BaseException as x:
+            raise SchemaError('%r.validate(%r) raised %r' % (s, data, x),
+                              error)
+    return validate
+
+
+class CompiledSchema(Schema):
+    """
+    CompiledSchema(s, error=None) behaves like schema.Schema(s, error), but the
+    validation function is built once when the instance is created, making
+    each validation much cheaper.
+    """
+
+    def __init__(self, schema, error=None):
+        super(CompiledSchema, self).__init__(schema, error)
+        self._validate = compile_schema(schema, error)
+
+    def validate(self, data):
+        return self._validate(data)
+
+    def __getstate__(self):
+        # Validation functions are closures, which can't be pickled
+        return {'_schema': self._schema, '_error': self._error}
+
+    def __setstate__(self, state):
+        self.__init__(state['_schema'], state['_error'])
@@ -1,17 +1,636 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
 import logging
+import multiprocessing
+from timeit import default_timer
+
+from schema import SchemaError
+
+from featureforge.feature import (asyncio, has_dependencies, is_batch_feature,
+                                  is_coroutine_feature, is_io_bound,
+                                  memoize_shared, reuse_event_loop)
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+from featureforge.profiling import Profiler
+from featureforge.validation_policy import make_policy
 
 logger = logging.getLogger(__name__)
 
 
 LOG_STEP = 500
+# Amount of data points sent to a worker process on each task
+PARALLEL_CHUNK_SIZE = 1000
+# Maximum amount of evaluations of I/O bound features running at once
+CONCURRENCY = 16
+
+# Policies for failures when transforming, see TolerantFeatureEvaluator
+RAISE = 'raise'
+SKIP = 'skip'
+FILL = 'fill'
+
+_MISSING = object()
+
+
+def _effective_n_jobs(n_jobs):
+    # Follows the scikit-learn convention: None means 1, and negative values
+    # count backwards from the number of CPUs (-1 is "all of them")
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count() + 1 + n_jobs
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be a non-zero integer")
+    return n_jobs
+
+
+class _WorkerPool(object):
+    """
+    A multiprocessing.Pool created when first needed, and reused by later
+    calls while the amount of processes and the initializer arguments are
+    the same (otherwise it's replaced by a new one). It's terminated by
+    `close`, or when garbage collected, and it's not pickled.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.key = None
+
+    def get(self, n_jobs, initializer=None, initargs=()):
+        key = (n_jobs, initializer, initargs)
+        if self.pool is not None and self.key != key:
+            self.close()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(n_jobs, initializer, initargs)
+            self.key = key
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            pool, self.pool, self.key = self.pool, None, None
+            pool.terminate()
+            pool.join()
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+
+def _chunks(X, size):
+    X = iter(X)
+    while True:
+        chunk = list(islice(X, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Features used by the worker processes. They are set once per worker by the
+# pool initializer, so they are not sent along with every chunk.
+_worker_features = None
+
+
+def _init_worker(features):
+    global _worker_features
+    _worker_features = features
+
+
+def _unchecked(feature):
+    # Calling a feature validates its input and output, _evaluate doesn't
+    return getattr(feature, '_evaluate', feature)
+
+
+class _NoScope(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SCOPE = _NoScope()
+
+
+def _no_scope(data_point):
+    return _NO_SCOPE
+
+
+def _event_loop(features):
+    # Context running the coroutine features called directly (not awaited
+    # by _await_all) on a single event loop, only if there are some
+    if any(map(is_coroutine_feature, features)):
+        return reuse_event_loop()
+    return _NO_SCOPE
+
+
+def _in_scope(scope, function, data_point):
+    # Calls function on data_point inside the context scope(data_point), for
+    # the evaluations done by other threads
+    with scope(data_point):
+        return function(data_point)
+
+
+def _shared_scope(features):
+    # Function returning the context that memoizes the computations shared
+    # by the features (see featureforge.feature.depends_on) while they're
+    # evaluated on a data point, only if some feature uses them
+    if any(map(has_dependencies, features)):
+        return memoize_shared
+    return _no_scope
+
+
+def _evaluate_column(feature, chunk, validate):
+    if is_batch_feature(feature):
+        return feature.evaluate_batch(chunk, validate)
+    if not validate:
+        feature = _unchecked(feature)
+    return [feature(d) for d in chunk]
+
+
+def _profiled_column(profiler, feature, chunk, validate):
+    profile = profiler.profile(feature)
+    start = default_timer()
+    try:
+        column = _evaluate_column(feature, chunk, validate)
+    except Exception:
+        profile.add_error()
+        raise
+    if chunk:
+        profile.record(default_timer() - start, calls=len(chunk))
+    return column
+
+
+def _evaluate_columns(features, chunk, validate=True, profiler=None,
+                      cache=None):
+    by_row = cache is not None or any(map(has_dependencies, features))
+    batch = [i for i, f in enumerate(features) if is_batch_feature(f)]
+    if by_row and batch and len(batch) < len(features):
+        # The batch features are evaluated on the whole chunk, and the rest
+        # by data point with their shared computations memoized
+        others = [i for i in range(len(features)) if i not in batch]
+        columns = [None] * len(features)
+        for indexes in (batch, others):
+            values = _evaluate_columns([features[i] for i in indexes], chunk,
+                                       validate, profiler, cache)
+            for i, column in zip(indexes, values):
+                columns[i] = column
+        return tuple(columns)
+    if by_row and not batch:
+        # Evaluated data point by data point, so the shared computations are
+        # done once for each of them, and cached values are used
+        functions = _feature_functions(features, validate, profiler, cache)
+        rows = []
+        for d in chunk:
+            with memoize_shared(d):
+                rows.append(tuple([f(d) for f in functions]))
+        if not rows:
+            return tuple([] for _ in features)
+        return tuple(map(list, zip(*rows)))
+    if profiler is not None:
+        return tuple(_profiled_column(profiler, f, chunk, validate)
+                     for f in features)
+    return tuple(_evaluate_column(f, chunk, validate) for f in features)
+
+
+def _evaluate_chunk(chunk, validate):
+    with _event_loop(_worker_features):
+        return _evaluate_columns(_worker_features, chunk, validate)
+
+
+def _parallel_evaluate(features, X, n_jobs, chunk_size, should_validate,
+                       workers=None):
+    """
+    Evaluates `features` on every data point of `X` using a pool of `n_jobs`
+    processes, yielding a tuple of columns (one per feature) for each chunk
+    of `X`, in the same order as `X`. `should_validate(n)` decides if the
+    evaluations on a chunk of n data points must be validated. The pool is
+    taken from the _WorkerPool `workers`, so it's reused by later calls
+    (without it, a pool is created for this call only).
+
+    At most 2 * n_jobs chunks are in flight at any time, so memory usage does
+    not depend on the size of `X`.
+    """
+    own = workers is None
+    if own:
+        workers = _WorkerPool()
+    pool = workers.get(n_jobs, _init_worker, (tuple(features),))
+    pending = deque()
+    try:
+        for chunk in _chunks(X, chunk_size):
+            validate = should_validate(len(chunk) * len(features))
+            pending.append(pool.apply_async(_evaluate_chunk,
+                                            (chunk, validate)))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # When the consumer stops early or a feature fails, the chunks
+        # still pending are abandoned with their pool
+        if own or pending:
+            workers.close()
+
+
+def _evaluate_by_columns(features, X, n_jobs, chunk_size, should_validate,
+                         profiler=None, cache=None, workers=None):
+    n_jobs = _effective_n_jobs(n_jobs)
+    if n_jobs > 1:
+        # Evaluations in the worker processes are not profiled nor cached
+        for columns in _parallel_evaluate(features, X, n_jobs, chunk_size,
+                                          should_validate, workers):
+            yield columns
+    else:
+        for chunk in _chunks(X, chunk_size):
+            validate = should_validate(len(chunk) * len(features))
+            yield _evaluate_columns(features, chunk, validate, profiler,
+                                    cache)
+
+
+def _feature_functions(features, validate, profiler=None, cache=None):
+    # Functions evaluating each feature on a data point, with or without
+    # validation, recording their evaluations if profiling and loading or
+    # storing their values if caching
+    if profiler is None:
+        if validate:
+            functions = tuple(features)
+        else:
+            functions = tuple(map(_unchecked, features))
+    elif validate:
+        functions = tuple(map(profiler.timed_validation, features))
+    else:
+        functions = tuple(profiler.timed(f, _unchecked(f)) for f in features)
+    if cache is None:
+        return functions
+    # Values loaded from the cache are not evaluations, so they aren't
+    # recorded by the profiler
+    return tuple(map(cache.cached, features, functions))
+
+
+def _checked_input(feature, data_point):
+    try:
+        return feature.input_schema.validate(data_point)
+    except SchemaError as e:
+        raise feature.InputValueError(e)
+
+
+def _checked_output(feature, value):
+    try:
+        return feature.output_schema.validate(value)
+    except SchemaError as e:
+        raise feature.OutputValueError(e)
+
+
+def _await_all(loop, evaluations, concurrency, validate, cache,
+               profiler=None):
+    """
+    Runs the coroutine features on the event loop `loop` for each pair
+    (feature, data point) in `evaluations`, with at most `concurrency` of
+    them running at once. Returns the list of results, in the same order.
+    When profiling, the time of each evaluation is measured from its start
+    until the loop notices it finished, so it includes waiting for I/O.
+    """
+    results = [None] * len(evaluations)
+    todo = []
+    for k, (feature, d) in enumerate(evaluations):
+        key = cache.key(d) if cache is not None else None
+        if key is not None:
+            feature_id = cache.feature_id(feature)
+            value = cache.get(feature_id, key, _MISSING)
+            if value is not _MISSING:
+                results[k] = value
+                continue
+        todo.append((k, feature, d, key))
+    todo = iter(todo)
+    pending = {}
+    try:
+        while True:
+            for k, feature, d, key in islice(todo,
+                                             concurrency - len(pending)):
+                start = default_timer()
+                if validate:
+                    try:
+                        d = _checked_input(feature, d)
+                    except Exception:
+                        if profiler is not None:
+                            profiler.profile(feature).add_error()
+                        raise
+                evaluate_start = default_timer()
+                task = asyncio.ensure_future(feature._evaluate_async(d),
+                                             loop=loop)
+                pending[task] = (k, feature, key,
+                                 evaluate_start - start, evaluate_start)
+            if not pending:
+                return results
+            done, _ = loop.run_until_complete(asyncio.wait(
+                list(pending), return_when=asyncio.FIRST_COMPLETED))
+            evaluate_end = default_timer()
+            for task in done:
+                k, feature, key, validation_time, evaluate_start = \
+                    pending.pop(task)
+                try:
+                    value = task.result()
+                    if validate:
+                        value = _checked_output(feature, value)
+                except Exception:
+                    if profiler is not None:
+                        profiler.profile(feature).add_error()
+                    raise
+                if profiler is not None:
+                    validation_time += default_timer() - evaluate_end
+                    profiler.profile(feature).record(
+                        evaluate_end - evaluate_start, validation_time)
+                if key is not None:
+                    cache.set(cache.feature_id(feature), key, value)
+                results[k] = value
+    finally:
+        # Reached with tasks pending only when some evaluation failed
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(list(pending)))
+
+
+def _concurrent_evaluate(features, X, chunk_size, should_validate,
+                         concurrency, profiler=None, cache=None):
+    """
+    Evaluates `features` on every data point of `X` by chunks, yielding a
+    tuple per data point in the same order as `X`. On each chunk, the I/O
+    bound features run on a pool of `concurrency` threads and the coroutine
+    features on an event loop (awaiting at most `concurrency` evaluations at
+    once), while the rest of the features are evaluated as usual.
+    """
+    loop = None
+    if any(map(is_coroutine_feature, features)):
+        loop = asyncio.new_event_loop()
+    # Threaded evaluations enter the scope of their data point in their own
+    # thread, so their shared computations are memoized too
+    scope = _shared_scope(features)
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for chunk in _chunks(X, chunk_size):
+                validate = should_validate(len(chunk) * len(features))
+                functions = _feature_functions(features, validate, profiler,
+                                               cache)
+                columns = [None] * len(features)
+                threaded, awaited, local = [], [], []
+                for i, feature in enumerate(features):
+                    if is_coroutine_feature(feature):
+                        awaited.append(i)
+                    elif is_io_bound(feature):
+                        threaded.append(i)
+                        if scope is _no_scope:
+                            columns[i] = [pool.submit(functions[i], d)
+                                          for d in chunk]
+                        else:
+                            columns[i] = [pool.submit(_in_scope, scope,
+                                                      functions[i], d)
+                                          for d in chunk]
+                    else:
+                        local.append(i)
+                if local:
+                    values = _evaluate_columns([features[i] for i in local],
+                                               chunk, validate, profiler,
+                                               cache)
+                    for i, column in zip(local, values):
+                        columns[i] = column
+                if awaited:
+                    evaluations = [(features[i], d) for i in awaited
+                                   for d in chunk]
+                    values = _await_all(loop, evaluations, concurrency,
+                                        validate, cache, profiler)
+                    for n, i in enumerate(awaited):
+                        columns[i] = values[n * len(chunk):
+                                            (n + 1) * len(chunk)]
+                for i in threaded:
+                    columns[i] = [future.result() for future in columns[i]]
+                for r in zip(*columns):
+                    yield r
+    finally:
+        if loop is not None:
+            loop.close()
+
+
+def _evaluate(features, X, n_jobs, chunk_size, should_validate,
+              profiler=None, cache=None, concurrency=CONCURRENCY,
+              workers=None):
+    parallel = _effective_n_jobs(n_jobs) > 1
+    if (not parallel and ThreadPoolExecutor is not None and
+            any(map(is_io_bound, features))):
+        for r in _concurrent_evaluate(features, X, chunk_size,
+                                      should_validate, concurrency, profiler,
+                                      cache):
+            yield r
+    elif parallel or any(map(is_batch_feature, features)):
+        with _event_loop(features):
+            for columns in _evaluate_by_columns(features, X, n_jobs,
+                                                chunk_size, should_validate,
+                                                profiler, cache, workers):
+                for r in zip(*columns):
+                    yield r
+    else:
+        with _event_loop(features):
+            for r in _evaluate_rows(features, X, should_validate, profiler,
+                                    cache):
+                yield r
+
+
+def _evaluate_rows(features, X, should_validate, profiler, cache):
+    # Evaluates the features data point by data point, in this process
+    checked = _feature_functions(features, True, profiler, cache)
+    unchecked = _feature_functions(features, False, profiler, cache)
+    N = len(features)
+    scope = _shared_scope(features)
+    if scope is _no_scope:
+        for d in X:
+            if should_validate(N):
+                yield tuple((f(d) for f in checked))
+            else:
+                yield tuple((f(d) for f in unchecked))
+    else:
+        for d in X:
+            functions = checked if should_validate(N) else unchecked
+            # The scope is left before yielding, so memoized values
+            # don't outlive the evaluation of their data point
+            with scope(d):
+                row = tuple([f(d) for f in functions])
+            yield row
+
+
+def _fill_value(fill_value, feature):
+    # The value of `feature` when it fails, given the fill_value option
+    if isinstance(fill_value, dict):
+        return fill_value.get(feature, float('nan'))
+    return fill_value
+
+
+class _PolicyMixin(object):
+    # Validation policy handling shared by the evaluators
+
+    # Values of the options missing in evaluators pickled by older versions
+    _defaults = dict(n_jobs=1, chunk_size=PARALLEL_CHUNK_SIZE,
+                     validation=None, profiler=None, cache=None,
+                     concurrency=CONCURRENCY)
+
+    def __setstate__(self, state):
+        self.__dict__.update(self._defaults)
+        self.__dict__.update(state)
+
+    @property
+    def policy(self):
+        """The ValidationPolicy in use (the default one if none was given)"""
+        return make_policy(self.validation)
+
+    def _validator(self, fitting):
+        policy = self.policy
+        return lambda count: policy.should_validate(fitting, count)
+
+    def _transform(self, X, fitting):
+        return self._flushing(_evaluate(
+            self.alive_features, X, self.n_jobs, self.chunk_size,
+            self._validator(fitting), self.profiler, self.cache,
+            self.concurrency, self._worker_pool))
+
+    @property
+    def _worker_pool(self):
+        # The processes evaluating in parallel, kept between calls
+        workers = self.__dict__.get("_workers")
+        if workers is None:
+            workers = self._workers = _WorkerPool()
+        return workers
+
+    def close(self):
+        """
+        Terminates the worker processes kept for evaluating in parallel
+        (`n_jobs` > 1). They are started again if needed.
+        """
+        workers = self.__dict__.get("_workers")
+        if workers is not None:
+            workers.close()
 
+    def _flushing(self, results):
+        # Commits the values cached once `results` is consumed
+        if self.cache is None:
+            return results
+        return self._flush_after(results)
 
-class FeatureEvaluator(object):
-    """Simple feature evaluator"""
+    def _flush_after(self, results):
+        try:
+            for r in results:
+                yield r
+        finally:
+            self.flush_cache()
+
+    def flush_cache(self):
+        """Commits the values stored in the cache, if any"""
+        if self.cache is not None:
+            self.cache.flush()
+
+    def shared_scope(self):
+        """
+        Returns a function that, given a data point, returns a context
+        manager to enter while calling the functions from
+        `feature_functions` on it, so the computations shared by the
+        features (see featureforge.feature.depends_on) are done once for
+        the data point. The contexts do nothing when no feature uses them.
+        """
+        return _shared_scope(self.alive_features)
+
+    def feature_functions(self, validate=True):
+        """
+        Returns a tuple with a function for each alive feature, evaluating it
+        on a data point (validating its input and output if `validate`).
+        When profiling, the functions record their evaluations.
+        """
+        return _feature_functions(self.alive_features, validate,
+                                  self.profiler, self.cache)
+
+    def profile_report(self, table=False):
+        """
+        Returns the statistics of the feature evaluations recorded when
+        profiling, as a dictionary (see featureforge.profiling.Profiler.report)
+        or, if `table` is True, as a text table.
+        """
+        if self.profiler is None:
+            raise ValueError("Profiling is not enabled, use profile=True")
+        if table:
+            return self.profiler.format_report()
+        return self.profiler.report()
+
+    def transform(self, X, y=None):
+        return self._transform(X, fitting=False)
+
+    def partial_fit_transform(self, X, y=None):
+        """
+        Evaluates the features on X as part of an incremental fit (i.e.,
+        validating as when fitting). The first call is a fit_transform.
+        """
+        if not hasattr(self, 'alive_features'):
+            return self.fit_transform(X, y)
+        return self._transform(X, fitting=True)
+
+    def transform_columns(self, X, y=None):
+        return self._flushing(_evaluate_by_columns(
+            self.alive_features, X, self.n_jobs, self.chunk_size,
+            self._validator(False), self.profiler, self.cache,
+            self._worker_pool))
+
+
+class FeatureEvaluator(_PolicyMixin):
+    """Simple feature evaluator
+
+    FeatureEvaluator(features, n_jobs=N) evaluates the features during
+    transform on a pool of N worker processes (all the CPUs when N is -1).
+    Data points are sent to the workers in chunks of `chunk_size`, and the
+    resulting tuples are generated in the same order as the input. Features
+    and data points must be picklable for this to work. The pool is started
+    on the first transform and reused by the next ones, until `close` is
+    called or the evaluator is garbage collected.
+
+    Features with an `_evaluate_batch` method (see
+    featureforge.feature.batch_feature) are evaluated on whole chunks of
+    data points at once. `transform_columns` gives access to the evaluation
+    results as a tuple of columns (one per feature) for each chunk.
+
+    FeatureEvaluator(features, validation=policy) decides which evaluations
+    validate the feature input and output using the given policy (see
+    featureforge.validation_policy). When evaluating by chunks, the decision
+    is taken once for each chunk.
+
+    FeatureEvaluator(features, profile=True) records the time spent
+    evaluating and validating each feature, and its errors (see
+    `profile_report` and featureforge.profiling). Evaluations done in worker
+    processes are not recorded.
+
+    FeatureEvaluator(features, cache=FeatureCache(path)) loads the values of
+    the features from the cache when they were already computed, and stores
+    the values computed (see featureforge.cache). Batch features and
+    evaluations done in worker processes are not cached.
+
+    I/O bound features (see featureforge.feature.io_bound) are evaluated
+    concurrently on each chunk of data points, with at most `concurrency`
+    evaluations running at once: regular functions on a pool of threads and
+    coroutines (`async def`) on an event loop. The results are generated in
+    the same order as the input, and validated as usual.
+    """
 
-    def __init__(self, features):
+    def __init__(self, features, n_jobs=1, chunk_size=PARALLEL_CHUNK_SIZE,
+                 validation=None, profile=False, cache=None,
+                 concurrency=CONCURRENCY):
         self.features = features
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.validation = (None if validation is None
+                           else make_policy(validation))
+        self.profiler = Profiler() if profile else None
+        self.cache = cache
+        self.concurrency = concurrency
 
     def fit(self, X, y=None):
         self.alive_features = tuple(self.features)
@@ -19,18 +638,14 @@ class FeatureEvaluator(object):
 
     def fit_transform(self, X, y=None):
         self.fit(X, y)
-        return self.transform(X)
-
-    def transform(self, X, y=None):
-        for d in X:
-            yield tuple((f(d) for f in self.alive_features))
+        return self._transform(X, fitting=True)
 
 
-class TolerantFeatureEvaluator(object):
+class TolerantFeatureEvaluator(_PolicyMixin):
     """Feature Evaluator that tolerates broken features or samples when
      fitting.
 
-     Tolerance to failures (only done during fit or fit_transform):
+     Tolerance to failures (during fit or fit_transform):
      a) Samples are always discarded when failing:
          If a given sample fails when evaluating a feature with it, no matter
          what, no matter when, the sample is discarded.
@@ -42,104 +657,249 @@ class TolerantFeatureEvaluator(object):
            exceeded, an internal counter will be increated for that feature.
         Each time that a feature is discarded, the following things happen:
           - every sampled that was discarded because of this feature,
-            is re-considered.
+            is re-considered. Only the features that were not evaluated yet
+            with it are evaluated.
           - every previously evaluated sample is stripped off of the result
-            of this feature.
+            of this feature (results are kept by feature, so this is just
+            dropping the column of the feature).
+
+     By default transform is not tolerant: a failure raises like in
+     FeatureEvaluator. With `on_transform_error` failures when transforming
+     are handled according to one of these policies:
+     - SKIP: the sample is left out of the result.
+     - FILL: the value of the failing feature is replaced by `fill_value`,
+       which is either a single value (NaN by default) or a dictionary from
+       feature to its value.
+     In both cases, each failure is recorded in `transform_failures` as a
+     tuple (sample index, feature, exception), and the indexes of the
+     samples in the result are recorded in `transform_rows`. Both lists are
+     reset on each call to transform, and filled as its result is consumed.
+     Tolerant transforms are done in a single process, whatever `n_jobs`.
+
+     TolerantFeatureEvaluator(features, profile=True) records the feature
+     evaluations like FeatureEvaluator does, including the failed ones, and
+     TolerantFeatureEvaluator(features, cache=cache) caches the values like
+     FeatureEvaluator does (failures are not cached).
+
+     I/O bound features are evaluated concurrently only by transform, when
+     failures are not tolerated (see FeatureEvaluator).
     """
     FEATURE_STRICT_UNTIL = 100
     FEATURE_MAX_ERRORS_ALLOWED = 5
 
+    RAISE = RAISE
+    SKIP = SKIP
+    FILL = FILL
+
     class NoFeaturesLeftError(Exception):
         pass
 
-    def __init__(self, features):
+    _defaults = dict(_PolicyMixin._defaults, on_transform_error=RAISE,
+                     fill_value=float('nan'))
+
+    def __init__(self, features, n_jobs=1, chunk_size=PARALLEL_CHUNK_SIZE,
+                 validation=None, profile=False, on_transform_error=RAISE,
+                 fill_value=float('nan'), cache=None,
+                 concurrency=CONCURRENCY):
+        if on_transform_error not in (self.RAISE, self.SKIP, self.FILL):
+            raise ValueError("Unknown on_transform_error policy %r" %
+                             (on_transform_error,))
         self.features = features
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.validation = (None if validation is None
+                           else make_policy(validation))
+        self.profiler = Profiler() if profile else None
+        self.cache = cache
+        self.concurrency = concurrency
+        self.on_transform_error = on_transform_error
+        self.fill_value = fill_value
         self.fitted = False
 
-    def fit(self, X, y=None):
-        self._fit_failure_stats = {
-            'discarded_samples': [],
-            'features': defaultdict(list)
-        }
-        self.alive_features = self.features[:]
+    def transform(self, X, y=None, fill_value=None):
+        """
+        Evaluates the features on X, handling failures according to
+        `on_transform_error`. `fill_value`, if given, is used instead of the
+        evaluator's own for this call only.
+        """
+        if self.on_transform_error == self.RAISE:
+            return self._transform(X, fitting=False)
+        self.transform_failures = []
+        self.transform_rows = []
+        if fill_value is None:
+            fill_value = self.fill_value
+        return self._flushing(self._tolerant_transform(X, fill_value))
 
-        dataset = X
-        # Caution to not work in strict mode when retrying
-        last_sample_idx = -1
-        while dataset:
-            self._samples_to_retry = []
-            for i, d in enumerate(dataset, last_sample_idx + 1):
-                for feature in self.alive_features[:]:
-                    try:
-                        feature(d)
-                    except Exception as e:
-                        self.process_failure([], e, feature, d, i)
-                        break
-            last_sample_idx = i
-            dataset = self._samples_to_retry
+    def _tolerant_transform(self, X, fill_value):
+        should_validate = self._validator(fitting=False)
+        checked = self.feature_functions(True)
+        unchecked = self.feature_functions(False)
+        features = self.alive_features
+        skip = self.on_transform_error == self.SKIP
+        scope = self.shared_scope()
+        with _event_loop(features):
+            for i, d in enumerate(X):
+                if should_validate(len(features)):
+                    functions = checked
+                else:
+                    functions = unchecked
+                row = []
+                with scope(d):
+                    for feature, function in zip(features, functions):
+                        try:
+                            row.append(function(d))
+                        except Exception as e:
+                            logger.warning(u'Fail evaluating %s: %s %s' %
+                                           (feature, type(e), e))
+                            self.transform_failures.append((i, feature, e))
+                            if skip:
+                                row = None
+                                break
+                            row.append(_fill_value(fill_value, feature))
+                if row is not None:
+                    self.transform_rows.append(i)
+                    yield tuple(row)
 
-        self.alive_features = tuple(self.alive_features)
-        self.fitted = True
+    def fit(self, X, y=None):
+        self._fit(X, keep_values=False)
         return self
 
-    def transform(self, X, y=None):
-        for d in X:
-            yield tuple((f(d) for f in self.alive_features))
-
     def fit_transform(self, X, y=None):
-        # Very similar to fit alone, but buffers samples evaluation for two
-        # reasons:
-        #   - simply because this is also a transform, so we need to
-        #     return that
-        #   - to be able to patch them if at some given point a Feature that
-        #     was working is killed.
+        # Same as fit alone, but the evaluations are kept in a buffer with a
+        # column per alive feature, so they can be returned, and the column
+        # of a feature can be dropped at once if it's excluded.
+        columns = self._fit(X, keep_values=True)
+        return zip(*columns)
+
+    def _fit(self, X, keep_values):
         self._fit_failure_stats = {
             'discarded_samples': [],
             'features': defaultdict(list)
         }
-        self.alive_features = self.features[:]
-        result = []
+        # Samples that failed, by the feature that failed with them
+        self._failed_samples = defaultdict(list)
+        self.alive_features = list(self.features)
+        columns = [[] for _ in self.alive_features] if keep_values else None
 
-        dataset = X
+        should_validate = self._validator(fitting=True)
+        checked, unchecked = self._functions_by_feature()
+        # Pairs of (sample, values known for it). The values are only known
+        # for samples retried after a failure, so features that already
+        # evaluated fine with them are not evaluated again.
+        dataset = ((d, None) for d in X)
         # Caution to not work in strict mode when retrying
         last_sample_idx = -1
-        while dataset:
-            self._samples_to_retry = []
-            for i, d in enumerate(dataset, last_sample_idx + 1):
-                r = []
-                for feature in self.alive_features[:]:
-                    try:
-                        r.append(feature(d))
-                    except Exception as e:
-                        self.process_failure(result, e, feature, d, i)
-                        break
-                else:
-                    result.append(r)
-            last_sample_idx = i
-            dataset = self._samples_to_retry
-
+        self._fit_loop(dataset, last_sample_idx, columns, keep_values,
+                       should_validate, checked, unchecked)
+        self.flush_cache()
         self.alive_features = tuple(self.alive_features)
+        self._failed_samples = None
         self.fitted = True
-        return (tuple(r) for r in result)
+        return columns
+
+    def _fit_loop(self, dataset, last_sample_idx, columns, keep_values,
+                  should_validate, checked, unchecked):
+        scope = self.shared_scope()
+        with _event_loop(self.alive_features):
+            while True:
+                self._samples_to_retry = []
+                for i, (d, known) in enumerate(dataset, last_sample_idx + 1):
+                    validate = should_validate(len(self.alive_features))
+                    functions = checked if validate else unchecked
+                    with scope(d):
+                        row = self._fit_row(d, i, known, functions, columns)
+                    if row is not None and keep_values:
+                        for column, value in zip(columns, row):
+                            column.append(value)
+                    last_sample_idx = i
+                if not self._samples_to_retry:
+                    break
+                dataset = self._samples_to_retry
+
+    def _fit_row(self, d, i, known, functions, columns):
+        # Evaluates the alive features on the sample d, returning None if
+        # some feature failed
+        row = []
+        for feature in self.alive_features:
+            try:
+                if known and feature in known:
+                    row.append(known[feature])
+                else:
+                    row.append(functions[feature](d))
+            except Exception as e:
+                values = dict(known or ())
+                values.update(zip(self.alive_features, row))
+                self.process_failure(columns, e, feature, d, i, values)
+                return None
+        return row
+
+    def partial_fit_transform(self, X, y=None):
+        """
+        Evaluates the features on X as part of an incremental fit. The first
+        call is a fit_transform, which decides the features kept alive. Later
+        calls keep those features, and discard (and log) the samples failing
+        to evaluate.
+        """
+        if not self.fitted:
+            return self.fit_transform(X, y)
+        return self._flushing(self._partial_fit_transform(X))
+
+    def _functions_by_feature(self):
+        # Dictionaries from feature to the function evaluating it, with and
+        # without validation
+        features = self.alive_features
+        return (dict(zip(features, self.feature_functions(True))),
+                dict(zip(features, self.feature_functions(False))))
+
+    def _partial_fit_transform(self, X):
+        should_validate = self._validator(fitting=True)
+        checked = self.feature_functions(True)
+        unchecked = self.feature_functions(False)
+        scope = self.shared_scope()
+        with _event_loop(self.alive_features):
+            for d in X:
+                if should_validate(len(self.alive_features)):
+                    features = checked
+                else:
+                    features = unchecked
+                try:
+                    with scope(d):
+                        row = tuple([f(d) for f in features])
+                    yield row
+                except Exception as e:
+                    logger.warning(u'Fail evaluating %s: %s' % (type(e), e))
+                    self._fit_failure_stats['discarded_samples'].append(
+                        d.get('pk', 'PK-NOT-FOUND'))
 
-    def process_failure(self, partial_eval, error, feature, dpoint, d_index):
+    def process_failure(self, columns, error, feature, dpoint, d_index,
+                        values=None):
+        """
+        Registers that evaluating `feature` with the sample `dpoint` failed.
+        `values` are the evaluations of other features already done with
+        the sample, kept in case it's retried.
+        """
         logger.warning(u'Fail evaluating %s: %s %s' % (feature,
                                                        type(error), error))
         self._fit_failure_stats['discarded_samples'].append(
             dpoint.get('pk', 'PK-NOT-FOUND'))
         feature_errors = self._fit_failure_stats['features'][feature]
         feature_errors.append(dpoint)
+        self._failed_samples[feature].append((dpoint, values))
         if d_index < self.FEATURE_STRICT_UNTIL:
-            self.exclude_feature(feature, partial_eval)
+            self.exclude_feature(feature, columns)
         elif len(feature_errors) > self.FEATURE_MAX_ERRORS_ALLOWED:
-            self.exclude_feature(feature, partial_eval)
+            self.exclude_feature(feature, columns)
 
-    def exclude_feature(self, feature, partial_evaluation):
+    def exclude_feature(self, feature, columns):
+        """
+        Excludes `feature`, dropping its column from the evaluations buffer
+        (if any) and scheduling for retry only the samples that failed with
+        it.
+        """
         idx = self.alive_features.index(feature)
-        self.alive_features.remove(feature)
+        self.alive_features.pop(idx)
         if not self.alive_features:
             raise self.NoFeaturesLeftError()
-        for evaluation in partial_evaluation:
-            evaluation.pop(idx)
-        discarded_samples = self._fit_failure_stats['features'][feature]
-        self._samples_to_retry += discarded_samples
+        if columns is not None:
+            columns.pop(idx)
+        self._samples_to_retry += self._failed_samples.pop(feature, [])
@@ -1,5 +1,19 @@
+from functools import partial, wraps
+import threading
+
 import schema
 
+try:
+    import asyncio
+    from inspect import iscoroutinefunction
+except ImportError:  # Python 2, coroutine features are not available
+    asyncio = None
+
+    def iscoroutinefunction(f):
+        return False
+
+from featureforge.compiled_schema import CompiledSchema, compile_schema
+
 
 def soft_schema(**kwargs):
     """
@@ -8,7 +22,8 @@ def soft_schema(**kwargs):
     Returns a schema for dicts having the keys k1, k2, ... and possibly other
     string keys not explicitly stated. The schema for the values is the one
     provided (i.e. schema for k2 is Schema(schema2)). Other keys have
-    Schema(object).
+    Schema(object). The result is compiled for fast validation (see
+    featureforge.compiled_schema).
 
     If one of the inner schemas given is a dict, it's interpreted as a soft
     dictionary schema too.
@@ -22,7 +37,7 @@ def soft_schema(**kwargs):
         result[schema.Optional(str)] = object
         return result
 
-    return schema.Schema(_transform(kwargs))
+    return CompiledSchema(_transform(kwargs))
 
 
 class Feature(object):
@@ -36,6 +51,17 @@ class Feature(object):
     `_evaluate` method and leaving the standard `__call__` in place
     (which wraps `_evaluate` adding input and output validation)
 
+    Features that can be computed more efficiently on many data points at
+    once may also define an `_evaluate_batch` method, taking a sequence of
+    data points and returning a sequence with one value for each of them.
+    When present, it is used by `evaluate_batch` (and by the evaluators)
+    instead of calling `_evaluate` once per data point.
+
+    Features spending their time waiting (on the network, the disk, etc)
+    may define `_io_bound = True`, or an `_evaluate_async` coroutine
+    function besides `_evaluate`. The evaluators run many evaluations of
+    those features at once (see io_bound).
+
     Besides the `__call__` methods, the following class attributes are
     available:
 
@@ -51,8 +77,8 @@ class Feature(object):
        fails to validate; it is a subclass of `ValueError`
     """
 
-    input_schema = schema.Schema(object)
-    output_schema = schema.Schema(object)
+    input_schema = CompiledSchema(object)
+    output_schema = CompiledSchema(object)
 
     class InputValueError(ValueError):
         pass
@@ -68,20 +94,68 @@ class Feature(object):
     def __call__(self, data_point):
         """Validate intput, evaluate, and validate result"""
         try:
-            data_point = self.input_schema.validate(data_point)
+            validated = self.input_schema.validate(data_point)
         except schema.SchemaError as e:
             raise self.InputValueError(e)
-        result = self._evaluate(data_point)
+        if validated is not data_point and _memo.point is data_point:
+            # A copy, which shares the memoized computations of the original
+            _memo.copies[id(validated)] = validated, data_point
+        result = self._evaluate(validated)
         try:
             return self.output_schema.validate(result)
         except schema.SchemaError as e:
             raise self.OutputValueError(e)
 
+    def evaluate_batch(self, data_points, validate=True):
+        """
+        Evaluate the feature on a sequence of data points, returning a list
+        with one value per data point. Input and output validation is the
+        same than when calling the feature on each data point, and is
+        skipped if `validate` is False.
+        """
+        evaluate_batch = getattr(self, "_evaluate_batch", None)
+        if not validate:
+            if evaluate_batch is None:
+                return [self._evaluate(d) for d in data_points]
+            return list(evaluate_batch(data_points))
+        if evaluate_batch is None:
+            return [self(d) for d in data_points]
+        validated = []
+        for data_point in data_points:
+            try:
+                validated.append(self.input_schema.validate(data_point))
+            except schema.SchemaError as e:
+                raise self.InputValueError(e)
+        results = evaluate_batch(validated)
+        if len(results) != len(validated):
+            raise self.OutputValueError(
+                "Expected %d values but got %d" % (len(validated),
+                                                   len(results)))
+        try:
+            return [self.output_schema.validate(r) for r in results]
+        except schema.SchemaError as e:
+            raise self.OutputValueError(e)
+
     def _evaluate(self, data_point):
         """Override this to provide your own evaluation function"""
         raise NotImplemented
 
 
+def is_batch_feature(f):
+    """Returns True if the feature `f` can evaluate many data points at once"""
+    return getattr(f, "_evaluate_batch", None) is not None
+
+
+def is_coroutine_feature(f):
+    """Returns True if the feature `f` is evaluated by a coroutine"""
+    return getattr(f, "_evaluate_async", None) is not None
+
+
+def is_io_bound(f):
+    """Returns True if evaluations of `f` should run concurrently"""
+    return bool(getattr(f, "_io_bound", False)) or is_coroutine_feature(f)
+
+
 # Extensions for schema of other objects
 class ObjectSchema(schema.Schema):
     """
@@ -94,10 +168,21 @@ class ObjectSchema(schema.Schema):
     valid value useful for building is schema (i.e., you can use `int` instead
     of `schema.Schema(int)`
 
+    The schemas for the attributes are compiled once on construction (see
+    featureforge.compiled_schema).
     """
 
     def __init__(self, **kwargs):
         self.attrs = kwargs
+        self._validators = [(a, compile_schema(s))
+                            for (a, s) in kwargs.items()]
+
+    def __getstate__(self):
+        # Compiled validators are closures, which can't be pickled
+        return {'attrs': self.attrs}
+
+    def __setstate__(self, state):
+        self.__init__(**state['attrs'])
 
     def __repr__(self):
         attributes = ("%s=%s" % (n, repr(s)) for (n, s) in sorted(self.attrs.items()))
@@ -108,14 +193,13 @@ class ObjectSchema(schema.Schema):
         Check that data has all the attributes specified, and validate each
         attribute with the schema provided on construction
         """
-        for a, s in self.attrs.items():
-            s = schema.Schema(s)
+        for a, validate in self._validators:
             try:
                 value = getattr(data, a)
             except AttributeError:
                 raise schema.SchemaError(" Missing attribute %r" % a, [])
             try:
-                new_value = s.validate(value)
+                new_value = validate(value)
             except schema.SchemaError as e:
                 raise schema.SchemaError(
                     "Invalid value for attribute %r: %s" % (a, e), [])
@@ -136,6 +220,11 @@ def make_feature(f):
         return f
     result = Feature()
     result._evaluate = f
+    if iscoroutinefunction(f):
+        # Called directly, each evaluation runs the coroutine to completion.
+        # The evaluators await many of them at once.
+        result._evaluate = partial(_run_coroutine, f)
+        result._evaluate_async = f
     result._name = getattr(f, "_feature_name", f.__name__)
     input_schema = getattr(f, "_input_schema", None)
     output_schema = getattr(f, "_output_schema", None)
@@ -146,6 +235,95 @@ def make_feature(f):
     return result
 
 
+def _evaluate_one(evaluate_batch, data_point):
+    # Single data point evaluation for features built with batch_feature
+    return evaluate_batch([data_point])[0]
+
+
+class _Loop(threading.local):
+    # Event loop reused by the coroutine features called directly, if any
+    loop = None
+
+
+_loop = _Loop()
+
+
+def _run_coroutine(f, data_point):
+    loop = _loop.loop
+    if loop is not None:
+        return loop.run_until_complete(f(data_point))
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(f(data_point))
+    finally:
+        loop.close()
+
+
+class _LoopScope(object):
+    # Context manager running the coroutine features called inside it on a
+    # single event loop. Contexts can be nested, the inner ones reuse the
+    # loop of the outermost one, which closes it when left.
+    def __enter__(self):
+        self.loop = None
+        if _loop.loop is None:
+            self.loop = _loop.loop = asyncio.new_event_loop()
+
+    def __exit__(self, *exc_info):
+        if self.loop is not None:
+            _loop.loop = None
+            self.loop.close()
+            self.loop = None
+
+
+def reuse_event_loop():
+    """
+    Returns a context manager inside of which the coroutine features called
+    directly (as opposed to awaited by the evaluators) run on a single event
+    loop, instead of creating one for each call. The loop is closed when
+    leaving the context, and it's independent for each thread.
+    """
+    return _LoopScope()
+
+
+def io_bound(f):
+    """
+    Given a function f: data point -> feature that spends its time waiting
+    (for example, querying a database or reading files), upgrade it to a
+    feature instance that the evaluators evaluate concurrently on many data
+    points, in a pool of threads. Functions defined with `async def` are
+    awaited concurrently in an event loop instead (make_feature also detects
+    them, so this decorator is optional for them).
+
+    Results, their order and validation are the same than when evaluating
+    the feature on each data point.
+    Returns f if f is already a Feature instance
+    """
+    if isinstance(f, Feature):
+        return f
+    result = make_feature(f)
+    result._io_bound = True
+    return result
+
+
+def batch_feature(f):
+    """
+    Given a function f: sequence of data points -> sequence of features that
+    computes a feature for many data points at once, upgrade it to a feature
+    instance. The resulting feature can still be called on a single data
+    point, but the evaluators will call f with whole chunks of data points.
+
+    The schemas and name annotated on f apply to each individual data point
+    and feature value, as with make_feature.
+    Returns f if f is already a Feature instance
+    """
+    if isinstance(f, Feature):
+        return f
+    result = make_feature(f)
+    result._evaluate = partial(_evaluate_one, f)
+    result._evaluate_batch = f
+    return result
+
+
 def _build_schema(*args, **kwargs):
     # Helper to build schema form the arguments of input_schema & output_schema
     args = list(args)
@@ -159,7 +337,7 @@ def _build_schema(*args, **kwargs):
                 args[k] = soft_schema(**a)
         # if there are kwargs, add an objectschema to the condition
         args.append(ObjectSchema(**kwargs))
-    return schema.Schema(schema.And(*args))
+    return CompiledSchema(schema.And(*args))
 
 
 def input_schema(*args, **kwargs):
@@ -208,6 +386,127 @@ def output_schema(*args, **kwargs):
     return decorate
 
 
+class _Memo(threading.local):
+    # Values of shared computations for the data point being evaluated, by
+    # computation and argument, and the validated copies of the data point
+    # (by id, with the data point they're a copy of)
+    point = None
+    values = None
+    copies = None
+
+
+_memo = _Memo()
+
+
+class SharedComputation(object):
+    """
+    A computation on data points whose result is used by several features
+    (see depends_on). While the features are evaluated on a data point inside
+    its `memoize_shared(data_point)` context, as the evaluators do, the
+    computation runs once and its value is reused by every feature depending
+    on it. Values are memoized by argument, so calling the computation on
+    something else (like a field of the data point) computes it again for
+    that argument. Outside that context it's simply computed on each call.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.name = getattr(function, "__name__", repr(function))
+
+    def __call__(self, data_point):
+        memo = _memo
+        values = memo.values
+        if values is None:
+            return self.function(data_point)
+        point = data_point
+        copy = memo.copies.get(id(data_point))
+        if copy is not None and copy[0] is data_point:
+            point = copy[1]
+        key = self.function, id(point)
+        try:
+            return values[key][1]
+        except KeyError:
+            value = self.function(data_point)
+            # The argument is kept so its id isn't reused while memoized
+            values[key] = point, value
+            return value
+
+    def __repr__(self):
+        return "SharedComputation(%s)" % self.name
+
+
+class _SharedScope(object):
+    # Context manager memoizing the shared computations done while
+    # evaluating a data point. Contexts can be nested, the inner ones reuse
+    # the values memoized if they are for the same data point.
+    def __init__(self, data_point):
+        self.data_point = data_point
+
+    def __enter__(self):
+        memo = _memo
+        self.saved = memo.point, memo.values, memo.copies
+        if memo.values is None or memo.point is not self.data_point:
+            memo.point, memo.values, memo.copies = self.data_point, {}, {}
+
+    def __exit__(self, *exc_info):
+        _memo.point, _memo.values, _memo.copies = self.saved
+        self.saved = None
+
+
+def memoize_shared(data_point):
+    """
+    Returns a context manager inside of which the shared computations are
+    memoized for the evaluation of `data_point`: each one runs once, no
+    matter how many features use it. The context must be entered for each
+    data point evaluated (the memoized values are forgotten when it's left,
+    even if the next data point is the same object modified), and it's
+    independent for each thread.
+    """
+    return _SharedScope(data_point)
+
+
+def shared(f):
+    """
+    @shared
+    def tokens(data_point): ...
+
+    Declare f as a computation on data points shared by several features
+    (see depends_on). Returns f if it's already a SharedComputation.
+    """
+    if isinstance(f, SharedComputation):
+        return f
+    return SharedComputation(f)
+
+
+def depends_on(*computations):
+    """
+    @depends_on(c1, c2, ...)
+    def f(data_point, v1, v2, ...): ...
+
+    Declare that f uses the results of the computations c1, c2, ... on the
+    data point, which are given to f as additional arguments. Computations
+    are functions of a data point (converted with `shared`), and can depend
+    on other computations too, making a small graph where each computation
+    is done once per data point by the evaluators, no matter how many
+    features use it.
+    """
+    computations = tuple(map(shared, computations))
+
+    def decorate(f):
+        @wraps(f)
+        def evaluate(data_point):
+            return f(data_point, *[c(data_point) for c in computations])
+        evaluate._dependencies = computations
+        return evaluate
+    return decorate
+
+
+def has_dependencies(f):
+    """Returns True if the feature `f` uses shared computations"""
+    return bool(getattr(f, "_dependencies", None) or
+                getattr(getattr(f, "_evaluate", None), "_dependencies", None))
+
+
 def feature_name(name):
     """
     @feature_name("name")
@@ -1,16 +1,100 @@
 # -*- coding: utf-8 -*-
 import array
-from collections import Counter
+from collections import Counter, defaultdict, deque, namedtuple
+import copy
+from functools import partial
+from itertools import chain, islice
 import logging
+import numbers
+import os
+import pickle
+import zlib
 
-from future.builtins import map, range, str
+from future.builtins import map, str
 import numpy
 from schema import Schema, SchemaError, Use
-from scipy.sparse import csr_matrix
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, vstack
+
+from featureforge import storage, vocabulary
+from featureforge.compiled_schema import CompiledSchema
+from featureforge.evaluator import _WorkerPool, _effective_n_jobs, _no_scope
+from featureforge.validation_policy import make_policy
 
 
 logger = logging.getLogger(__name__)
 
+# Rows allocated for dense results when the amount of rows is not known in
+# advance. The buffer doubles its size each time it gets full (see _DenseRows)
+DENSE_INITIAL_ROWS = 1024
+
+# Default amount of tuples transformed into each block by transform_chunks
+TRANSFORM_CHUNK_SIZE = 10000
+
+# Amount of tuples sent to a worker process on each task when fitting in
+# parallel
+FIT_CHUNK_SIZE = 10000
+
+# Formats of sparse results, the first one is used for sparse=True
+SPARSE_FORMATS = ("csr", "csc", "coo")
+
+# Supported types for the values and the indices of the output matrices,
+# with their array module typecodes
+DTYPES = {numpy.dtype(numpy.float32): "f", numpy.dtype(numpy.float64): "d"}
+INDEX_DTYPES = {numpy.dtype(numpy.int32): "i", numpy.dtype(numpy.int64): "q"}
+_INT32_MAX = numpy.iinfo(numpy.int32).max
+
+# File with the state of a saved flattener, besides its vocabulary
+FLATTENER_FILE = "flattener.pickle"
+
+# Description of a column of a hashed feature, see
+# FeatureMappingFlattener.column_info
+HashedValue = namedtuple("HashedValue", ["bucket"])
+
+
+class _OtherValues(object):
+    """
+    Value describing the column that gathers the values pruned from the
+    vocabulary of a feature (see FeatureMappingFlattener.column_info)
+    """
+
+    def __eq__(self, other):
+        return isinstance(other, _OtherValues)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return 0x07e5
+
+    def __repr__(self):
+        return "OTHER"
+
+
+OTHER = _OtherValues()
+
+
+def _canonical(value):
+    # Text describing `value` that is the same on every python process (the
+    # order of sets and the hash of strings inside tuples are not)
+    if isinstance(value, str):
+        return value
+    if isinstance(value, tuple):
+        return u"(%s)" % u",".join(map(_canonical, value))
+    if isinstance(value, frozenset):
+        return u"{%s}" % u",".join(sorted(map(_canonical, value)))
+    if type(value).__repr__ is object.__repr__:
+        # The default repr has the address of the object, the hash is as good
+        return u"#%d" % hash(value)
+    return u"%s:%r" % (type(value).__name__, value)
+
+
+def _hash(value):
+    # crc32 so results don't depend on hash randomization, which changes the
+    # built-in hash of strings (even inside tuples) on each python process.
+    if not isinstance(value, str):
+        value = u"\0" + _canonical(value)
+    return zlib.crc32(value.encode("utf-8")) & 0xffffffff
+
 
 class FeatureMappingFlattener(object):
     """
@@ -59,19 +143,111 @@ class FeatureMappingFlattener(object):
     After fitting the instance is ready to transform new feature tuples into
     numpy/scipy matrices as long as they comply with the schema inferred during
     fitting.
+
+    Validation of the feature tuples can be skipped for trusted data using a
+    validation policy (see featureforge.validation_policy).
+
+    With hashing enabled, strings and bag values are not learned during
+    fitting. Instead, each of those tuple positions gets a fixed block of
+    output columns, and every value is mapped to a column of its block using
+    a hash function, so the memory needed doesn't depend on the amount of
+    distinct values. Different values may share the same column.
+
+    The vocabulary of strings and bags can also be limited to its most
+    frequent values (see `min_count`, `max_columns_per_feature` and
+    `max_total_columns`). Values are counted once per tuple where they
+    appear, and pruning is done at the end of fitting, keeping the columns
+    of the surviving values in the order they were first seen.
     """
 
-    def __init__(self, sparse=True):
+    def __init__(self, sparse=True, validation=None, hashing=None,
+                 alternate_sign=True, min_count=1,
+                 max_columns_per_feature=None, max_total_columns=None,
+                 other_bucket=False, dtype=numpy.float64,
+                 index_dtype=numpy.int32, n_jobs=1):
         """
         If `sparse` is `True` the transform/fit_transform methods generate a
-        `scipy.sparse.csr_matrix` matrix.
+        `scipy.sparse.csr_matrix` matrix. `sparse` can also be "csr", "csc"
+        or "coo" to generate matrices in that format (converted from the
+        rows collected, with the same cost as converting a CSR result).
         Else the transform/fit_transform generate `numpy.array` (dense).
+
+        `validation` is the validation policy deciding which feature tuples
+        are validated (the default policy if None).
+
+        If `hashing` is a number N, strings and bags are hashed into N columns
+        each instead of one-hot/bag-of-words encoded. If `alternate_sign` is
+        `True` the hash also decides the sign of the value added to the
+        column, so collisions tend to cancel out instead of accumulating.
+        Non-string values in bags are hashed through their `repr()` (or
+        `hash()` for objects with the default repr, which should then be
+        stable between python processes).
+
+        Strings and bag values appearing in less than `min_count` tuples are
+        pruned from the vocabulary. `max_columns_per_feature` keeps only that
+        many of the most frequent values for each tuple position, and
+        `max_total_columns` limits the amount of string/bag columns in total
+        (numeric columns are always kept). Ties are broken keeping the values
+        seen first. If `other_bucket` is `True`, an additional column for each
+        string/bag tuple position counts its pruned and unseen values.
+
+        `dtype` is the type of the values of the output matrices (float32 or
+        float64), and `index_dtype` the type of the indices of sparse
+        matrices (int32 or int64). 32 bit indices are promoted to 64 bits
+        when there are too many non-zero values to fit in them.
+
+        `n_jobs` is the amount of processes learning the vocabulary of
+        strings and bags when fitting (see `fit`), -1 meaning one for each
+        CPU.
         """
+        if sparse not in (True, False) + SPARSE_FORMATS:
+            raise ValueError("sparse must be a boolean or one of {}".format(
+                             ", ".join(SPARSE_FORMATS)))
+        if hashing is not None and not 0 < hashing < 2 ** 31:
+            raise ValueError("hashing must be a positive number of columns")
+        if hashing is not None and (min_count > 1 or other_bucket or
+                                    max_columns_per_feature is not None or
+                                    max_total_columns is not None):
+            raise ValueError("Vocabulary pruning can't be used with hashing")
+        if numpy.dtype(dtype) not in DTYPES:
+            raise ValueError("dtype must be float32 or float64")
+        if numpy.dtype(index_dtype) not in INDEX_DTYPES:
+            raise ValueError("index_dtype must be int32 or int64")
         self.sparse = sparse
+        self.validation = (None if validation is None
+                           else make_policy(validation))
+        self.hashing = hashing
+        self.alternate_sign = alternate_sign
+        self.min_count = min_count
+        self.max_columns_per_feature = max_columns_per_feature
+        self.max_total_columns = max_total_columns
+        self.other_bucket = other_bucket
+        self.dtype = numpy.dtype(dtype)
+        self.index_dtype = numpy.dtype(index_dtype)
+        self.n_jobs = n_jobs
+
+    @property
+    def _pruning(self):
+        return (self.min_count > 1 or self.other_bucket or
+                self.max_columns_per_feature is not None or
+                self.max_total_columns is not None)
+
+    @property
+    def policy(self):
+        """The ValidationPolicy in use (the default one if none was given)"""
+        return make_policy(self.validation)
 
     def fit(self, X, y=None):
         """Learns a mapping between feature tuples and matrix row indexes.
 
+        With `n_jobs` > 1 the vocabulary is learned by a pool of processes,
+        each one on chunks of FIT_CHUNK_SIZE tuples, and the vocabularies of
+        the chunks are merged in order, so the columns are the same as when
+        fitting in a single process. The validation policy decides once for
+        each chunk. The pool is started on the first fit and reused by the
+        next ones, until `close` is called or the flattener is garbage
+        collected.
+
         Parameters
         ----------
         X : List, sequence or iterable of tuples but not a single tuple
@@ -83,22 +259,49 @@ class FeatureMappingFlattener(object):
         """
         return self._wrapcall(self._fit, X)
 
-    def transform(self, X, y=None):
+    def partial_fit(self, X, y=None):
+        """Extends the mapping learned by previous calls to fit/partial_fit
+        with the feature tuples in X.
+
+        Columns already learned keep their indexes, and values not seen
+        before get new columns at the end. Tuples are validated against the
+        schema inferred when first fitted. If the flattener wasn't fitted
+        yet, this is the same as `fit`. Can't be used with vocabulary
+        pruning.
+
+        Parameters
+        ----------
+        X : List, sequence or iterable of tuples but not a single tuple
+        y : (ignored)
+
+        Returns
+        -------
+        self
+        """
+        return self._wrapcall(self._partial_fit, X)
+
+    def transform(self, X, y=None, out=None):
         """Transform feature tuples to a numpy or sparse matrix.
 
         Parameters
         ----------
         X : List, sequence or iterable of tuples but not a single tuple
         y : (ignored)
+        out : (dense only) A 2-d numpy array with one column per output
+              column, and at least as many rows as tuples in X. When given,
+              the result is written there instead of in a new array.
 
         Returns
         -------
-        Z : A numpy or sparse matrix
+        Z : A numpy or sparse matrix. When `out` is given, Z is a view of its
+            first len(X) rows.
         """
         if self.sparse:
+            if out is not None:
+                raise ValueError("out is only supported for dense results")
             return self._wrapcall(self._sparse_transform, X)
         else:
-            return self._wrapcall(self._transform, X)
+            return self._wrapcall(self._transform, X, out=out)
 
     def fit_transform(self, X, y=None):
         """Learns a mapping between feature tuples and matrix row indexes and
@@ -118,17 +321,430 @@ class FeatureMappingFlattener(object):
         else:
             return self._wrapcall(self._fit_transform, X)
 
-    def _wrapcall(self, method, X):
+    def fused_transform(self, X, functions, unchecked=None, out=None,
+                        scope=None):
+        """Transform data points to a numpy or sparse matrix, computing their
+        feature tuples on the fly.
+
+        This is equivalent to
+        `transform([tuple(f(x) for f in functions) for x in X])`, but no
+        tuple is built: the value computed for each tuple position is
+        validated on its own and written straight into the output matrix by
+        a writer specialized for that position when fitting.
+
+        Parameters
+        ----------
+        X : Iterable of data points
+        functions : Sequence of functions, the i-th one computing the i-th
+                    tuple value of a data point
+        unchecked : Functions used instead of `functions` (for example,
+                    skipping their own validation) when the validation
+                    policy decides not to validate a data point. Each
+                    data point accounts for one validation per function and
+                    one for its tuple.
+        out : (dense only) Same as in `transform`
+        scope : Function of a data point returning a context manager, which
+                is entered while the functions are computed on it (for
+                example, an evaluator's `shared_scope()`)
+
+        Returns
+        -------
+        Z : A numpy or sparse matrix
+        """
+        if len(functions) != self.validator.N:
+            raise ValueError("Expecting {} functions, but got {}".format(
+                             self.validator.N, len(functions)))
+        if self.sparse and out is not None:
+            raise ValueError("out is only supported for dense results")
+        return self._wrapcall(self._fused_transform, X, functions=functions,
+                              unchecked=unchecked or functions, out=out,
+                              scope=scope)
+
+    def row_transformer(self, functions, unchecked=None):
+        """Returns a function transforming a single data point with the
+        least possible overhead, for low latency scoring.
+
+        The function takes a data point x (and optionally a 1-d `out` array
+        where the dense row is written) and computes its feature tuple on the
+        fly, like `fused_transform([x], functions, unchecked)`, but it
+        doesn't build any matrix: it returns a 1-d numpy array for dense
+        results, or a pair of arrays (indices, values) with the non-zero
+        cells for sparse results. Validation follows the policy, as in
+        `fused_transform`. The writers of each tuple position are prepared
+        once, so the function must not be used after fitting again.
+
+        Parameters
+        ----------
+        functions : Same as in `fused_transform`
+        unchecked : Same as in `fused_transform`
+
+        Returns
+        -------
+        A function x, out=None -> numpy array or (indices, values) pair
+        """
+        if len(functions) != self.validator.N:
+            raise ValueError("Expecting {} functions, but got {}".format(
+                             self.validator.N, len(functions)))
+        if self.sparse:
+            return _SparseRowTransformer(self, functions, unchecked)
+        return _DenseRowTransformer(self, functions, unchecked)
+
+    def transform_chunks(self, X, chunk_size=TRANSFORM_CHUNK_SIZE):
+        """Transform feature tuples to a sequence of numpy or sparse matrices.
+
+        X is consumed lazily, `chunk_size` tuples at a time, so the memory
+        used doesn't depend on the size of X. Stacking the blocks generated
+        gives the same matrix as `transform(X)`.
+
+        Parameters
+        ----------
+        X : List, sequence or iterable of tuples but not a single tuple
+        chunk_size : Maximum amount of rows of each block
+
+        Returns
+        -------
+        A generator of numpy or sparse matrices, with `chunk_size` rows each
+        except (possibly) the last one.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be a positive number")
+        return self._transform_chunks(iter(X), chunk_size)
+
+    def _transform_chunks(self, X, chunk_size):
+        while True:
+            chunk = list(islice(X, chunk_size))
+            if not chunk:
+                return
+            yield self.transform(chunk)
+
+    def transform_to_disk(self, X, path, chunk_size=TRANSFORM_CHUNK_SIZE):
+        """Transform feature tuples to a matrix stored in disk.
+
+        The matrix is written block by block (see `transform_chunks`) into
+        the directory `path`: as a .npy file for dense results, or as the
+        `data`, `indices` and `indptr` arrays of its CSR representation for
+        sparse results. It can be opened again with
+        featureforge.storage.load_matrix. Only the "csr" sparse format can
+        be written, as the blocks of the others can't be appended.
+
+        Parameters
+        ----------
+        X : List, sequence or iterable of tuples but not a single tuple
+        path : Directory where the matrix is written (created if needed)
+        chunk_size : Amount of tuples transformed in memory at once
+
+        Returns
+        -------
+        Z : A numpy.memmap, or a sparse matrix backed by memory-mapped arrays
+        """
+        if self.sparse and self.sparse_format != "csr":
+            raise ValueError("Only csr sparse results can be written to "
+                             "disk, not %s" % self.sparse_format)
+        blocks = self.transform_chunks(X, chunk_size)
+        if self.sparse:
+            storage.write_sparse(blocks, path, self.n_columns, self.dtype)
+        else:
+            storage.write_dense(blocks, path, self.n_columns, self.dtype)
+        return storage.load_matrix(path)
+
+    def transform_columns(self, X, y=None, out=None):
+        """Transform chunks of feature columns to a numpy or sparse matrix.
+
+        This is equivalent to `transform`, but takes the feature values
+        grouped by tuple position, which allows numeric columns to be
+        written at once instead of value by value.
+
+        Parameters
+        ----------
+        X : Iterable of chunks. Each chunk is a sequence of columns (one for
+            each tuple position) of the same length, so that transposing it
+            gives a list of feature tuples.
+        y : (ignored)
+        out : (dense only) Same as in `transform`
+
+        Returns
+        -------
+        Z : A numpy or sparse matrix
+        """
+        if self.sparse and out is not None:
+            raise ValueError("out is only supported for dense results")
+        return self._wrapcall(self._columns_transform, X, out=out)
+
+    def save(self, path):
+        """Saves the fitted flattener in the directory `path`.
+
+        The vocabulary is stored as tables of flat arrays (see
+        featureforge.vocabulary), so it can be loaded quickly with `load`.
+
+        Parameters
+        ----------
+        path : Directory where the flattener is saved (created if needed)
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, FLATTENER_FILE), "wb") as f:
+            pickle.dump(self._saved_state(path), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a flattener saved with `save`.
+
+        Parameters
+        ----------
+        path : Directory where the flattener was saved
+        mmap : If True, the vocabulary is memory-mapped instead of read, so
+               loading is instantaneous and processes loading the same
+               flattener share its memory. Fitting the flattener again
+               (partial_fit) reads the whole vocabulary.
+
+        Returns
+        -------
+        The flattener loaded
+        """
+        with open(os.path.join(path, FLATTENER_FILE), "rb") as f:
+            state = pickle.load(f)
+        return cls._from_saved_state(state, path, mmap)
+
+    def _saved_state(self, path):
+        # Saves the vocabulary in `path`, and returns the rest of the state
+        if not hasattr(self, "vocabularies"):
+            raise ValueError("The flattener must be fitted before saving")
+        vocabulary.save_vocabularies(self.vocabularies, path)
+        state = self.__getstate__()
+        del state["vocabularies"]
+        return state
+
+    @classmethod
+    def _from_saved_state(cls, state, path, mmap):
+        result = cls.__new__(cls)
+        result.__dict__.update(state)
+        result.vocabularies = vocabulary.load_vocabularies(path, mmap)
+        return result
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_keys", None)
+        state.pop("_workers", None)
+        return state
+
+    def __setstate__(self, state):
+        if "indexes" in state:
+            # Pickled when the vocabulary was a single dictionary, maybe by a
+            # version without the options and fitted attributes added since,
+            # which get their default values
+            reverse = state.pop("reverse")
+            del state["indexes"]
+            self.__dict__.update(FeatureMappingFlattener().__dict__)
+            self.other_indexes = {}
+            self._counts = None
+            self.hashed_indexes = []
+            self.hashed_base = {}
+            self.__dict__.update(state)
+            self.validator = TupleValidator(self.schema)
+            self._set_keys(reverse)
+        else:
+            self.__dict__.update(state)
+
+    @property
+    def indexes(self):
+        """
+        Read only mapping from (tuple index, value) keys (as described in
+        `column_info`) to the columns learned when fitting
+        """
+        blocks = {}
+        for i, base in self.bases.items():
+            type_ = self.schema[i]
+            if isinstance(type_, NumberSequenceValidator):
+                blocks[i] = (base, type_.size)
+            else:
+                blocks[i] = (base, None)
+        return vocabulary.Indexes(self.vocabularies, blocks)
+
+    @property
+    def reverse(self):
+        """
+        List with the (tuple index, value) key of each learned column. It's
+        built on each access; use `column_info` for a few columns.
+        """
+        return self.indexes.reverse()
+
+    def _set_keys(self, keys):
+        # Rebuilds the columns learned from their (tuple index, value) keys
+        self.bases = {}
+        self.vocabularies = dict((i, {}) for i in
+                                 self.str_tuple_indexes + self.bag_indexes)
+        self.column_positions = array.array("i")
+        self._keys = None
+        for j, (i, value) in enumerate(keys):
+            if i in self.vocabularies:
+                self.vocabularies[i][value] = j
+            elif i not in self.bases:
+                self.bases[i] = j
+            self.column_positions.append(i)
+
+    def _column_keys(self):
+        # The `reverse` list, kept until columns are added
+        keys = getattr(self, "_keys", None)
+        if keys is None or len(keys) != len(self.column_positions):
+            keys = self._keys = self.reverse
+        return keys
+
+    def _wrapcall(self, method, X, **kwargs):
         try:
-            return method(X)
+            return method(X, **kwargs)
         except SchemaError as e:
             raise ValueError(*e.args)
 
+    @property
+    def n_columns(self):
+        """Amount of columns of the output matrix"""
+        hashed_columns = len(self.hashed_indexes) * (self.hashing or 0)
+        return len(self.column_positions) + hashed_columns
+
+    def column_info(self, j):
+        """
+        Returns a tuple (i, value) describing the j-th output column, where i
+        is the tuple index that originates the column, and value is None for
+        numbers, the position for number sequences, the string or bag element
+        for one-hot and bag-of-words columns and a HashedValue with the bucket
+        number for hashed columns.
+        """
+        if not 0 <= j < self.n_columns:
+            raise IndexError("Column index out of range")
+        learned = len(self.column_positions)
+        if j < learned:
+            i = self.column_positions[j]
+            if i in self.bases:
+                if isinstance(self.schema[i], NumberSequenceValidator):
+                    return i, j - self.bases[i]
+                return i, None
+            values = self.vocabularies[i]
+            if isinstance(values, vocabulary.MappedVocabulary):
+                # Found in the tables, without loading every value
+                return i, values.value(j)
+            return self._column_keys()[j]
+        k, bucket = divmod(j - learned, self.hashing)
+        return self.hashed_indexes[k], HashedValue(bucket)
+
+    def fill_tuple(self, value=float("nan")):
+        """
+        Returns a feature tuple that can stand for missing feature values:
+        `value` for numbers, a sequence of `value` for number sequences, an
+        empty string for strings and an empty bag for bags.
+        """
+        result = []
+        for type_ in self.schema:
+            if isinstance(type_, NumberSequenceValidator):
+                result.append([value] * type_.size)
+            elif isinstance(type_, BagValidator):
+                result.append(())
+            elif type_ is str:
+                result.append(u"")
+            else:
+                result.append(value)
+        return tuple(result)
+
+    def _hashed_column(self, i, value):
+        """Returns (column, sign) for value at tuple index i when hashing"""
+        h = _hash(value)
+        sign = -1.0 if self.alternate_sign and h & 0x80000000 else 1.0
+        return self.hashed_base[i] + h % self.hashing, sign
+
+    def _str_column(self, i, value):
+        """
+        Returns (column, value) of the cell to set for string value at tuple
+        index i, or None if there is none (a value not seen when fitting)
+        """
+        if self.hashing:
+            return self._hashed_column(i, value)
+        j = self.vocabularies[i].get(value, self.other_indexes.get(i))
+        if j is not None:
+            return j, 1.0
+
+    def _bag_columns(self, i, bag):
+        """
+        Returns a list of (column, value) pairs with the non-zero cells for
+        the bag at tuple index i
+        """
+        if self.hashing:
+            cells = defaultdict(float)
+            for word in bag:
+                j, sign = self._hashed_column(i, word)
+                cells[j] += sign
+            return [(j, v) for j, v in cells.items() if v != 0.0]
+        cells = []
+        other = 0
+        lookup = self.vocabularies[i].get
+        for word, count in Counter(bag).items():
+            # "word" because bag-of-words, but remember that can
+            # be other hashable type
+            j = lookup(word)
+            if j is not None:
+                cells.append((j, count))
+            else:
+                other += count
+        if other and i in self.other_indexes:
+            cells.append((self.other_indexes[i], other))
+        return cells
+
     def _add_column(self, i, value):
-        key = (i, value)
-        if key not in self.indexes:
-            self.indexes[key] = len(self.indexes)
-            self.reverse.append(key)
+        values = self.vocabularies[i]
+        if value not in values:
+            values[value] = len(self.column_positions)
+            self.column_positions.append(i)
+        if self._counts is not None:
+            self._counts[(i, value)] += 1
+
+    def _add_block(self, i, size):
+        # Adds the consecutive columns of a numeric tuple position
+        self.bases[i] = len(self.column_positions)
+        self.column_positions.extend([i] * size)
+
+    def _prune(self):
+        """
+        Drops the least frequent string and bag values from the vocabulary
+        according to the pruning options, adding the "other" columns if
+        needed. Returns an array mapping each column before pruning to its
+        new column, or -1 if it was dropped.
+        """
+        counts = self._counts
+        self._counts = None
+        old_keys = self.reverse
+        candidates = defaultdict(list)
+        for j, (i, value) in enumerate(old_keys):
+            if i in self.vocabularies and \
+                    counts[(i, value)] >= self.min_count:
+                candidates[i].append(j)
+
+        def most_frequent(columns, limit):
+            if limit is None:
+                return columns
+            return sorted(columns,
+                          key=lambda j: (-counts[old_keys[j]], j))[:limit]
+
+        kept = []
+        for columns in candidates.values():
+            kept.extend(most_frequent(columns, self.max_columns_per_feature))
+        kept = set(most_frequent(kept, self.max_total_columns))
+
+        keys = [key for j, key in enumerate(old_keys)
+                if key[0] not in self.vocabularies or j in kept]
+        if self.other_bucket:
+            for i in sorted(self.vocabularies):
+                self.other_indexes[i] = len(keys)
+                keys.append((i, OTHER))
+        self._set_keys(keys)
+
+        remap = numpy.empty(len(old_keys), dtype=numpy.intp)
+        for j, (i, value) in enumerate(old_keys):
+            if i in self.vocabularies:
+                remap[j] = self.vocabularies[i].get(
+                    value, self.other_indexes.get(i, -1))
+            else:
+                remap[j] = j  # Numeric columns come first and are kept
+        logger.debug("Pruned vocabulary from %s to %s columns" %
+                     (len(old_keys), len(keys)))
+        return remap
 
     def _fit_first(self, first):
         # Check for a tuples of numbers, strings or "sequences" or "bags".
@@ -140,18 +756,28 @@ class FeatureMappingFlattener(object):
             raise ValueError("Cannot fit with no empty features")
 
         # Build validation schema using the first data point
-        self.indexes = {}  # Tuple index to matrix column mapping
-        self.reverse = []  # Matrix column to tuple index mapping
+        self.bases = {}  # Numeric tuple index to its first matrix column
+        self.vocabularies = {}  # Tuple index to its value -> column mapping
+        self.column_positions = array.array("i")  # Tuple index by column
+        self.other_indexes = {}  # Tuple index to its "other" column
+        self._keys = None
+        # Tuples where each value was seen, only needed for pruning
+        self._counts = Counter() if self._pruning else None
         self.schema = [None] * len(first)
         self.str_tuple_indexes = []
         self.bag_indexes = []
+        self.hashed_indexes = []
         for i, data in enumerate(first):
             if isinstance(data, (int, float)):
                 type_ = Use(float)  # ints and floats are all mapped to float
-                self._add_column(i, None)
+                self._add_block(i, 1)
             elif isinstance(data, str):
                 type_ = str  # One-hot encoded indexes are added last
-                self.str_tuple_indexes.append(i)
+                if self.hashing:
+                    self.hashed_indexes.append(i)
+                else:
+                    self.str_tuple_indexes.append(i)
+                    self.vocabularies[i] = {}
             else:
                 # It's an iterable, maybe of numbers, maybe of hashables.
                 # Given that we don't allow empty number-sequences, if empty
@@ -163,13 +789,21 @@ class FeatureMappingFlattener(object):
                     elem = None  # Will evaluate as Not-number, which is fine.
                 if type(elem) in (int, float):
                     type_ = NumberSequenceValidator(data)
-                    for j in range(type_.size):
-                        self._add_column(i, j)
+                    self._add_block(i, type_.size)
                 else:
                     type_ = BagValidator(data)
-                    self.bag_indexes.append(i)
+                    if self.hashing:
+                        self.hashed_indexes.append(i)
+                    else:
+                        self.bag_indexes.append(i)
+                        self.vocabularies[i] = {}
             self.schema[i] = type_
         assert None not in self.schema
+        # Hashed columns go last, in blocks of `hashing` columns
+        self.hashed_base = {}
+        for k, i in enumerate(self.hashed_indexes):
+            self.hashed_base[i] = len(self.column_positions) + \
+                k * self.hashing
         self.schema = tuple(self.schema)
         self.validator = TupleValidator(self.schema)
 
@@ -178,24 +812,130 @@ class FeatureMappingFlattener(object):
             self._add_column(i, datapoint[i])
         for i in self.bag_indexes:
             # no matter if it's a list, a tuple or a set, we need to
-            # register each value only once
-            for elem in set(datapoint[i]):
-                self._add_column(i, elem)
+            # register each value only once (in order of appearance, so
+            # columns don't depend on string hashing)
+            seen = set()
+            for elem in datapoint[i]:
+                if elem not in seen:
+                    seen.add(elem)
+                    self._add_column(i, elem)
             # schema fitting
             self.schema[i].fit_step(datapoint[i])
+        for i in self.hashed_indexes:
+            if isinstance(self.schema[i], BagValidator):
+                self.schema[i].fit_step(datapoint[i])
+
+    def _untyped_hashed_bags(self):
+        # Tuple indexes of hashed bags whose element type isn't known yet
+        return [i for i in self.hashed_indexes
+                if isinstance(self.schema[i], BagValidator) and
+                self.schema[i].elem_type is None]
+
+    def _fit_hashed_bags(self, X):
+        # When hashing there is no vocabulary to learn, but the element type
+        # of bags is learned from their first non-empty value, as usual, so
+        # only the tuples until all of them are found are needed
+        pending = self._untyped_hashed_bags()
+        for datapoint in self._iter_valid(X, fitting=True):
+            for i in pending:
+                self.schema[i].fit_step(datapoint[i])
+            pending = self._untyped_hashed_bags()
+            if not pending:
+                break
 
-    def _iter_valid(self, X, first=None):
+    def _fit_vocabulary(self, X):
+        # Learns the strings and bag values of the tuples in X
+        n_jobs = _effective_n_jobs(self.n_jobs)
+        if n_jobs == 1:
+            for datapoint in self._iter_valid(X, fitting=True):
+                self._fit_step(datapoint)
+            return
+        # Each worker gets a copy of the flattener without its vocabulary,
+        # and learns the new values of a chunk in order of appearance. Those
+        # are added here in the order of the chunks, so the columns are the
+        # ones of a serial fit.
+        worker = copy.copy(self)
+        worker.vocabularies = dict((i, {}) for i in self.vocabularies)
+        worker.bases = {}
+        worker.column_positions = array.array("i")
+        worker._keys = None
+        worker.__dict__.pop("_workers", None)
+        # The pool is kept for later fits, so the worker is sent along with
+        # each chunk instead of set up once per process
+        workers = self._worker_pool
+        pool = workers.get(n_jobs)
+        pending = deque()
+        try:
+            for chunk in _chunks(X, FIT_CHUNK_SIZE):
+                validate = self.policy.should_validate(True, len(chunk))
+                pending.append((chunk, validate, pool.apply_async(
+                    _fit_chunk, (worker, chunk, validate))))
+                if len(pending) >= 2 * n_jobs:
+                    self._merge_chunk(*pending.popleft())
+            while pending:
+                self._merge_chunk(*pending.popleft())
+        finally:
+            # When some chunk fails, the ones still pending are abandoned
+            # with their pool
+            if pending:
+                workers.close()
+
+    @property
+    def _worker_pool(self):
+        # The processes fitting in parallel, kept between fits
+        workers = self.__dict__.get("_workers")
+        if workers is None:
+            workers = self._workers = _WorkerPool()
+        return workers
+
+    def close(self):
+        """
+        Terminates the worker processes kept for fitting in parallel
+        (`n_jobs` > 1). They are started again if needed.
+        """
+        workers = self.__dict__.get("_workers")
+        if workers is not None:
+            workers.close()
+
+    def _merge_chunk(self, chunk, validate, result):
+        # Adds the vocabulary learned from `chunk` by a worker
+        keys, counts, elem_types = result.get()
+        for i, elem_type in elem_types.items():
+            known = self.schema[i].elem_type
+            if elem_type is not None and known is not None and \
+                    elem_type is not known:
+                # The worker inferred the type of the bag elements from the
+                # chunk, but they should have been validated with the type
+                # inferred before it
+                for datapoint in chunk:
+                    if validate:
+                        datapoint = self.validator.validate(datapoint)
+                    self._fit_step(datapoint)
+                return
+        for i, elem_type in elem_types.items():
+            if self.schema[i].elem_type is None:
+                self.schema[i].elem_type = elem_type
+        for i, value in keys:
+            values = self.vocabularies[i]
+            if value not in values:
+                values[value] = len(self.column_positions)
+                self.column_positions.append(i)
+        if self._counts is not None:
+            self._counts.update(counts)
+
+    def _iter_valid(self, X, first=None, fitting=False):
+        policy = self.policy
+        validate = self.validator.validate
         if first is not None:
-            yield self.validator.validate(first)
+            X = chain([first], X)
         for datapoint in X:
-            yield self.validator.validate(datapoint)
+            if policy.should_validate(fitting):
+                yield validate(datapoint)
+            else:
+                yield datapoint
 
     def _fit(self, X):
-        X = iter(X)
-        try:
-            first = next(X)
-        except (TypeError, StopIteration):
-            raise ValueError("Cannot fit with an empty dataset")
+        first, X = _first_tuple(X)
         logger.debug("Starting flattener.fit")
         # Build basic schema
         self._fit_first(first)
@@ -203,86 +943,213 @@ class FeatureMappingFlattener(object):
         if self.str_tuple_indexes or self.bag_indexes:
             # Is there anything to one-hot encode or bag-of-words encode?
             # See all datapoints looking for one-hot encodeable feature values
-            for datapoint in self._iter_valid(X, first=first):
-                self._fit_step(datapoint)
+            self._fit_vocabulary(chain([first], X))
+            if self._pruning:
+                self._prune()
+        elif self._untyped_hashed_bags():
+            self._fit_hashed_bags(chain([first], X))
 
         logger.debug("Finished flattener.fit")
         logger.debug("Input tuple size %s, output vector size %s" %
-                    (len(first), len(self.indexes)))
+                    (len(first), self.n_columns))
         return self
 
-    def _transform_step(self, datapoint):
-        vector = numpy.zeros(len(self.indexes), dtype=float)
+    def _partial_fit(self, X):
+        if self._pruning:
+            raise ValueError("partial_fit can't be used with vocabulary "
+                             "pruning")
+        if not hasattr(self, "vocabularies"):
+            return self._fit(X)
+        if any(isinstance(v, vocabulary.MappedVocabulary)
+               for v in self.vocabularies.values()):
+            # Loaded from disk, the vocabulary becomes regular dictionaries
+            self._set_keys(self.reverse)
+        logger.debug("Starting flattener.partial_fit")
+        columns = self.n_columns
+        self._fit_vocabulary(X)
+        logger.debug("Finished flattener.partial_fit, added %s columns" %
+                     (self.n_columns - columns))
+        return self
+
+    def _transform_step(self, datapoint, vector=None):
+        # Writes the row for `datapoint` into `vector`, which must be zeroed
+        if vector is None:
+            vector = numpy.zeros(self.n_columns, dtype=self.dtype)
         for i, data in enumerate(datapoint):
-            if isinstance(data, float):
-                j = self.indexes[(i, None)]
-                vector[j] = data
+            if isinstance(data, numbers.Number):
+                # Usually a float, but may be any number if not validated
+                vector[self.bases[i]] = data
             elif isinstance(data, str):
-                if (i, data) in self.indexes:
-                    j = self.indexes[(i, data)]
-                    vector[j] = 1.0
+                cell = self._str_column(i, data)
+                if cell is not None:
+                    vector[cell[0]] = cell[1]
             else:
                 # ok, it's a sequence. Not sure if a Bag or a NumSeq
                 if isinstance(self.schema[i], NumberSequenceValidator):
-                    j = self.indexes[(i, 0)]
-                    assert self.indexes[(i, len(data) - 1)] == \
-                        j + len(data) - 1
+                    j = self.bases[i]
+                    assert len(data) <= self.schema[i].size
                     vector[j:j + len(data)] = data
                 else:
-                    for word in data:
-                        # "word" because bag-of-words, but remember that can
-                        # be other hashable type
-                        if (i, word) in self.indexes:
-                            j = self.indexes[(i, word)]
-                            vector[j] += 1.0
+                    for j, value in self._bag_columns(i, data):
+                        vector[j] = value
         return vector
 
-    def _transform(self, X):
-        logger.debug("Starting flattener.transform")
-        matrix = []
+    def _dense_writers(self):
+        """
+        Returns a function for each tuple position, which writes a value of
+        that position into a zeroed dense row, as _transform_step does
+        """
+        writers = []
+        for i, type_ in enumerate(self.schema):
+            if isinstance(type_, NumberSequenceValidator):
+                writers.append(_slice_writer(self.bases[i], type_.size))
+            elif isinstance(type_, BagValidator):
+                writers.append(_cells_writer(partial(self._bag_columns, i)))
+            elif type_ is str:
+                if self.hashing:
+                    writers.append(_cells_writer(
+                        lambda value, i=i: [self._hashed_column(i, value)]))
+                else:
+                    writers.append(_lookup_writer(
+                        self.vocabularies[i], self.other_indexes.get(i)))
+            else:
+                writers.append(_number_writer(self.bases[i]))
+        return writers
 
-        for datapoint in self._iter_valid(X):
-            vector = self._transform_step(datapoint)
-            matrix.append(vector.reshape((1, -1)))
+    def _sparse_writers(self):
+        """
+        Returns a function for each tuple position, which gives the (column,
+        value) pairs of the non-zero cells for a value of that position, as
+        _sparse_transform_step does
+        """
+        writers = []
+        for i, type_ in enumerate(self.schema):
+            if isinstance(type_, NumberSequenceValidator):
+                writers.append(_slice_cells(self.bases[i]))
+            elif isinstance(type_, BagValidator):
+                writers.append(partial(self._bag_columns, i))
+            elif type_ is str:
+                writers.append(_str_cells(partial(self._str_column, i)))
+            else:
+                writers.append(_number_cells(self.bases[i]))
+        return writers
+
+    def _fused_transform(self, X, functions, unchecked, out=None,
+                         scope=None):
+        logger.debug("Starting flattener.fused_transform")
+        policy = self.policy
+        count = len(functions) + 1
+        if self._numeric_only:
+            chunks = self._fused_chunks(X, functions, unchecked, scope)
+            return self._numeric_transform(X, out, chunks=chunks)
+        validators = [schema.validate for schema in self.validator.tt]
+        if self.sparse:
+            rows = self._sparse_rows()
+            writers = self._sparse_writers()
+        else:
+            try:
+                size = len(X)
+            except TypeError:
+                size = None
+            rows = _DenseRows(self.n_columns, size, out, self.dtype)
+            writers = self._dense_writers()
+        checked = list(zip(functions, validators, writers))
+        fast = list(zip(unchecked, writers))
+
+        def add_row(x):
+            validate = policy.should_validate(False, count)
+            if self.sparse:
+                if validate:
+                    cells = [w(v(f(x))) for f, v, w in checked]
+                else:
+                    cells = [w(f(x)) for f, w in fast]
+                rows.add_row(chain.from_iterable(cells))
+            else:
+                row = rows.next_row()
+                if validate:
+                    for f, v, w in checked:
+                        w(v(f(x)), row)
+                else:
+                    for f, w in fast:
+                        w(f(x), row)
 
-        if not matrix:
-            result = numpy.zeros((0, len(self.indexes)))
+        if scope is None or scope is _no_scope:
+            for x in X:
+                add_row(x)
         else:
-            result = numpy.concatenate(matrix)
+            for x in X:
+                with scope(x):
+                    add_row(x)
 
-        logger.debug("Finished flattener.transform")
+        if self.sparse:
+            result = self._sparse_matrix(*rows.arrays())
+        else:
+            result = rows.result()
+        logger.debug("Finished flattener.fused_transform")
         logger.debug("Matrix has size %sx%s" % result.shape)
         return result
 
-    def _fit_transform(self, X):
+    def _fused_chunks(self, X, functions, unchecked, scope):
+        """
+        Yields the (tuples, validate) pairs of `_numeric_transform` for the
+        data points X, evaluated as X is consumed. The policy decides once
+        for each chunk whether to validate its tuples (with `functions`,
+        and as arrays) or not (with `unchecked`), accounting for one
+        validation per function and one for the tuple of each data point.
+        """
+        count = TRANSFORM_CHUNK_SIZE * (len(functions) + 1)
+        if scope is None:
+            scope = _no_scope
         X = iter(X)
+        while True:
+            rows = []
+            for x in X:
+                if not rows:
+                    validate = self.policy.should_validate(False, count)
+                    fs = functions if validate else unchecked
+                with scope(x):
+                    rows.append(tuple([f(x) for f in fs]))
+                if len(rows) == TRANSFORM_CHUNK_SIZE:
+                    break
+            if not rows:
+                return
+            yield rows, validate
+
+    def _transform(self, X, out=None):
+        if self._numeric_only:
+            return self._numeric_transform(X, out)
+        logger.debug("Starting flattener.transform")
         try:
-            first = next(X)
-        except (TypeError, StopIteration):
-            raise ValueError("Cannot fit with an empty dataset")
-        logger.debug("Starting flattener.fit_transform")
-
-        self._fit_first(first)
-
-        matrix = []
-        for datapoint in self._iter_valid(X, first=first):
-            self._fit_step(datapoint)
-            vector = self._transform_step(datapoint)
-            matrix.append(vector.reshape((1, -1)))
+            size = len(X)
+        except TypeError:
+            size = None
+        rows = _DenseRows(self.n_columns, size, out, self.dtype)
+        for datapoint in self._iter_valid(X):
+            self._transform_step(datapoint, rows.next_row())
+        result = rows.result()
 
-        N = len(self.indexes)
-        for i, vector in enumerate(matrix):
-            if len(vector) == N:
-                break
-            # This works because one-hot encoded features go at the end
-            vector = numpy.array(vector)
-            vector.resize((1, N))
-            matrix[i] = vector
+        logger.debug("Finished flattener.transform")
+        logger.debug("Matrix has size %sx%s" % result.shape)
+        return result
 
-        if not matrix:
-            result = numpy.zeros((0, N))
+    def _fit_transform(self, X):
+        first, X = _first_tuple(X)
+        logger.debug("Starting flattener.fit_transform")
+        self._fit_first(first)
+        if self._numeric_only:
+            return self._numeric_transform(chain([first], X), fitting=True)
+        # The rows are collected as sparse triplets while the output width is
+        # still growing, and the dense matrix is built once at the end with
+        # its final width.
+        data, indices, indptr = self._fit_triplets(first, X)
+        n, N = len(indptr) - 1, self.n_columns
+        result = numpy.zeros((n, N), dtype=self.dtype)
+        rows = numpy.repeat(numpy.arange(n), numpy.diff(indptr))
+        if self.other_indexes:
+            # The same "other" column may appear more than once in a row
+            numpy.add.at(result, (rows, indices), data)
         else:
-            result = numpy.concatenate(matrix)
+            result[rows, indices] = data
 
         logger.debug("Finished flattener.fit_transform")
         logger.debug("Matrix has size %sx%s" % result.shape)
@@ -296,89 +1163,566 @@ class FeatureMappingFlattener(object):
         that `row[i] == 0.0` (the sparseness condition).
         """
         for i, data in enumerate(datapoint):
-            if isinstance(data, float):
-                j = self.indexes[(i, None)]
+            if isinstance(data, numbers.Number):
+                # Usually a float, but may be any number if not validated
+                j = self.bases[i]
                 if data != 0.0:
                     yield j, data
             elif isinstance(data, str):
-                if (i, data) in self.indexes:
-                    j = self.indexes[(i, data)]
-                    yield j, 1.0
+                cell = self._str_column(i, data)
+                if cell is not None:
+                    yield cell
             else:
                 # ok, it's a sequence. Not sure if a Bag or a NumSeq
                 if isinstance(self.schema[i], NumberSequenceValidator):
-                    j = self.indexes[(i, 0)]
-                    assert self.indexes[(i, len(data) - 1)] == \
-                        j + len(data) - 1
+                    j = self.bases[i]
+                    assert len(data) <= self.schema[i].size
 
                     for k, data_k in enumerate(data):
                         if data_k != 0.0:
                             yield j + k, data_k
                 else:
-                    counted_data = Counter(data)
-                    for word, count in counted_data.items():
-                        # "word" because bag-of-words, but remember that can
-                        # be other hashable type
-                        if (i, word) in self.indexes:
-                            j = self.indexes[(i, word)]
-                            yield j, count
+                    for cell in self._bag_columns(i, data):
+                        yield cell
 
     def _sparse_transform(self, X):
+        if self._numeric_only:
+            return self._numeric_transform(X)
         logger.debug("Starting flattener.transform")
 
-        data = array.array("d")
-        indices = array.array("i")
-        indptr = array.array("i", [0])
-
+        rows = self._sparse_rows()
         for datapoint in self._iter_valid(X):
-            for i, value in self._sparse_transform_step(datapoint):
-                data.append(value)
-                indices.append(i)
-            indptr.append(len(data))
-
-        if len(indptr) == 0:
-            result = numpy.zeros((0, len(self.indexes)))
-        else:
-            result = csr_matrix((data, indices, indptr),
-                                dtype=float,
-                                shape=(len(indptr) - 1, len(self.indexes)))
+            rows.add_row(self._sparse_transform_step(datapoint))
+        result = self._sparse_matrix(*rows.arrays())
 
         logger.debug("Finished flattener.transform")
         logger.debug("Matrix has size %sx%s" % result.shape)
         return result
 
+    def _fit_triplets(self, first, X):
+        """
+        Fits the flattener (already fitted to the `first` tuple by
+        _fit_first) with the tuples in X, returning the rows of `first` and X
+        in CSR format as (data, indices, indptr) numpy arrays. When pruning,
+        a row may have repeated indices (of its "other" columns), which must
+        be added up.
+        """
+        rows = self._sparse_rows()
+        for datapoint in self._iter_valid(X, first=first, fitting=True):
+            self._fit_step(datapoint)
+            rows.add_row(self._sparse_transform_step(datapoint))
+
+        data, indices, indptr = rows.arrays()
+        if self._pruning:
+            remap = self._prune()
+            indices = remap[indices]
+            keep = indices >= 0
+            n = len(indptr) - 1
+            rows = numpy.repeat(numpy.arange(n), numpy.diff(indptr))[keep]
+            indptr = numpy.concatenate(
+                ([0], numpy.cumsum(numpy.bincount(rows, minlength=n))))
+            data, indices = data[keep], indices[keep]
+        return data, indices, indptr
+
+    def _sparse_rows(self):
+        return _SparseRows(self.dtype, self.index_dtype, self.n_columns)
+
+    @property
+    def sparse_format(self):
+        """Format of the sparse results ("csr", "csc" or "coo")"""
+        if self.sparse is True:
+            return SPARSE_FORMATS[0]
+        return self.sparse
+
+    def _sparse_matrix(self, data, indices, indptr):
+        """
+        Returns the sparse result in the format requested, given its rows in
+        CSR format
+        """
+        n = len(indptr) - 1
+        shape = (n, self.n_columns)
+        sparse_format = self.sparse_format
+        if sparse_format == "csr":
+            # The CSR matrix only wraps the arrays
+            result = csr_matrix((data, indices, indptr), dtype=self.dtype,
+                                shape=shape)
+            return self._index_dtype(result)
+        rows = numpy.repeat(numpy.arange(n, dtype=indices.dtype),
+                            numpy.diff(indptr))
+        if sparse_format == "coo":
+            result = coo_matrix((data, (rows, indices)), dtype=self.dtype,
+                                shape=shape)
+            return self._index_dtype(result)
+        # CSC triplets: the values are counted by column for the column
+        # pointers, and scattered in column order (keeping the row order
+        # within each column, as the sort is stable)
+        counts = numpy.bincount(indices, minlength=self.n_columns)
+        column_indptr = numpy.zeros(self.n_columns + 1, dtype=indices.dtype)
+        numpy.cumsum(counts, out=column_indptr[1:])
+        del counts
+        order = numpy.argsort(indices, kind="stable")
+        result = csc_matrix((data[order], rows[order], column_indptr),
+                            dtype=self.dtype, shape=shape)
+        return self._index_dtype(result)
+
+    def _index_dtype(self, result):
+        # Makes the indices of the sparse result of index_dtype
+        if self.index_dtype == numpy.int64:
+            # scipy downcasts indices when their values fit in 32 bits
+            if result.format == "coo":
+                coords = (result.row.astype(numpy.int64),
+                          result.col.astype(numpy.int64))
+                if hasattr(result, "coords"):
+                    result.coords = coords
+                else:  # scipy < 1.13
+                    result.row, result.col = coords
+            else:
+                result.indices = result.indices.astype(numpy.int64)
+                result.indptr = result.indptr.astype(numpy.int64)
+        return result
+
     def _sparse_fit_transform(self, X):
-        X = iter(X)
-        try:
-            first = next(X)
-        except (TypeError, StopIteration):
-            raise ValueError("Cannot fit with an empty dataset")
+        first, X = _first_tuple(X)
         logger.debug("Starting flattener.fit_transform")
-
         self._fit_first(first)
+        if self._numeric_only:
+            return self._numeric_transform(chain([first], X), fitting=True)
+        data, indices, indptr = self._fit_triplets(first, X)
+        result = self._sparse_matrix(data, indices, indptr)
+        if self.other_indexes:
+            result.sum_duplicates()
 
-        data = array.array("d")
-        indices = array.array("i")
-        indptr = array.array("i", [0])
+        logger.debug("Finished flattener.fit_transform")
+        logger.debug("Matrix has size %sx%s" % result.shape)
+        return result
 
-        for datapoint in self._iter_valid(X, first=first):
-            self._fit_step(datapoint)
-            for i, value in self._sparse_transform_step(datapoint):
-                data.append(value)
-                indices.append(i)
-            indptr.append(len(data))
+    @property
+    def _numeric_only(self):
+        # Whether every tuple position is a number or a number sequence
+        return not (self.str_tuple_indexes or self.bag_indexes or
+                    self.hashed_indexes)
 
-        if len(indptr) == 0:
-            result = numpy.zeros((0, len(self.indexes)))
+    def _numeric_transform(self, X, out=None, fitting=False, chunks=None):
+        """
+        Transforms tuples of numbers and number sequences only, building each
+        block of TRANSFORM_CHUNK_SIZE rows with numpy at once, as their
+        columns are the tuple values in order. If `chunks` is given, it
+        yields (tuples, validate) pairs with the tuples of each block and
+        whether to validate them, and X is only used for its length.
+        """
+        logger.debug("Starting flattener.numeric_transform")
+        N = self.n_columns
+        try:
+            size = len(X)
+        except TypeError:
+            size = None
+        if chunks is None:
+            chunks = ((chunk, None)
+                      for chunk in _chunks(X, TRANSFORM_CHUNK_SIZE))
+        if self.sparse:
+            blocks = []
+            for chunk, validate in chunks:
+                block = numpy.zeros((len(chunk), N), dtype=self.dtype)
+                self._numeric_rows(chunk, block, fitting, validate)
+                blocks.append(csr_matrix(block))
+            if blocks:
+                result = vstack(blocks, format="csr")
+            else:
+                result = csr_matrix((0, N))
+            result = self._sparse_matrix(result.data, result.indices,
+                                         result.indptr)
         else:
-            result = csr_matrix((data, indices, indptr),
-                                dtype=float,
-                                shape=(len(indptr) - 1, len(self.indexes)))
+            rows = _DenseRows(N, size, out, self.dtype)
+            for chunk, validate in chunks:
+                self._numeric_rows(chunk, rows.next_rows(len(chunk)),
+                                   fitting, validate)
+            result = rows.result()
 
-        logger.debug("Finished flattener.fit_transform")
+        logger.debug("Finished flattener.numeric_transform")
         logger.debug("Matrix has size %sx%s" % result.shape)
         return result
 
+    def _numeric_rows(self, X, block, fitting, validate=None):
+        """
+        Writes the list of tuples X into the zeroed `block` of rows. As in
+        `transform_columns`, the validation policy decides once for all of
+        them (unless `validate` is given), and validation is done on the
+        arrays built.
+        """
+        n = len(X)
+        if validate is None:
+            validate = self.policy.should_validate(fitting, n)
+        written = False
+        try:
+            if validate and not all(isinstance(x, tuple) and
+                                    len(x) == self.validator.N for x in X):
+                raise ValueError("Not a tuple of the fitted size")
+            if not any(isinstance(type_, NumberSequenceValidator)
+                       for type_ in self.schema):
+                values = _numbers(X, validate)
+                if values.shape != block.shape:
+                    raise ValueError("Unexpected tuple sizes")
+                block[:] = values
+                return
+            written = True
+            for i, type_ in enumerate(self.schema):
+                j = self.bases[i]
+                column = [x[i] for x in X]
+                if isinstance(type_, NumberSequenceValidator):
+                    if validate:
+                        for value in column:
+                            if not isinstance(value, (list, tuple)) and not (
+                                    isinstance(value, numpy.ndarray) and
+                                    value.dtype.kind == "f"):
+                                raise ValueError("Not a number sequence")
+                    values = _numbers(column, validate).reshape(n, -1)
+                    if values.shape[1] != type_.size:
+                        raise ValueError("Unexpected sequence sizes")
+                    block[:, j:j + type_.size] = values
+                else:
+                    block[:, j] = _numbers(column, validate)
+        except (TypeError, ValueError):
+            # Some value isn't as expected, so the tuples are written one by
+            # one, raising the same error than the general path (if any)
+            if written:
+                block.fill(0.0)
+            for x, row in zip(X, block):
+                if validate:
+                    x = self.validator.validate(x)
+                self._transform_step(x, row)
+
+    def _columns_transform_step(self, columns):
+        """
+        Returns (n, rows, cols, values) where n is the amount of rows in the
+        chunk of `columns` and the other three are arrays with the
+        coordinates and values of the non-zero cells of its matrix.
+        """
+        if len(columns) != self.validator.N:
+            raise SchemaError("Expecting {} columns, but got {}".format(
+                              self.validator.N, len(columns)), [])
+        n = len(columns[0])
+        validate = self.policy.should_validate(False, n)
+        rows, cols, values = [], [], []
+        for i, column in enumerate(columns):
+            if len(column) != n:
+                raise SchemaError("Columns have different lengths", [])
+            if validate:
+                schema = self.validator.tt[i]
+                column = [schema.validate(x) for x in column]
+            type_ = self.schema[i]
+            if isinstance(type_, NumberSequenceValidator):
+                block = numpy.vstack(column) if column else \
+                    numpy.zeros((0, type_.size))
+                r, c = numpy.nonzero(block)
+                rows.append(r)
+                cols.append(c + self.bases[i])
+                values.append(block[r, c])
+            elif isinstance(type_, BagValidator) or type_ is str:
+                if type_ is str:
+                    column = [(x,) for x in column]
+                c_rows, c_cols, c_values = [], [], []
+                for r, bag in enumerate(column):
+                    for j, value in self._bag_columns(i, bag):
+                        c_rows.append(r)
+                        c_cols.append(j)
+                        c_values.append(value)
+                rows.append(numpy.array(c_rows, dtype=int))
+                cols.append(numpy.array(c_cols, dtype=int))
+                values.append(numpy.array(c_values, dtype=self.dtype))
+            else:
+                column = numpy.asarray(column, dtype=self.dtype)
+                r = numpy.flatnonzero(column)
+                rows.append(r)
+                cols.append(numpy.repeat(self.bases[i], len(r)))
+                values.append(column[r])
+        return (n, numpy.concatenate(rows), numpy.concatenate(cols),
+                numpy.concatenate(values))
+
+    def _columns_transform(self, X, out=None):
+        logger.debug("Starting flattener.transform_columns")
+        N = self.n_columns
+        if self.sparse:
+            blocks = []
+            for columns in X:
+                n, rows, cols, values = self._columns_transform_step(columns)
+                block = coo_matrix((values, (rows, cols)), shape=(n, N),
+                                   dtype=self.dtype)
+                blocks.append(block.tocsr())
+            if blocks:
+                result = vstack(blocks, format="csr")
+            else:
+                result = csr_matrix((0, N))
+            result = self._sparse_matrix(result.data, result.indices,
+                                         result.indptr)
+        else:
+            dense = _DenseRows(N, out=out, dtype=self.dtype)
+            for columns in X:
+                n, rows, cols, values = self._columns_transform_step(columns)
+                block = dense.next_rows(n)
+                block[rows, cols] = values
+            result = dense.result()
+
+        logger.debug("Finished flattener.transform_columns")
+        logger.debug("Matrix has size %sx%s" % result.shape)
+        return result
+
+
+def _fit_chunk(worker, chunk, validate):
+    """
+    Learns the vocabulary of a chunk of tuples in a worker process, with a
+    copy of the flattener `worker` (fitted without vocabulary). Returns
+    the new (tuple index, value) keys in order of appearance, the amount of
+    tuples where each one appears (if pruning) and the type of the elements
+    of each bag inferred.
+    """
+    fitter = copy.copy(worker)
+    fitter.vocabularies = dict((i, {}) for i in fitter.vocabularies)
+    fitter.column_positions = array.array("i")
+    fitter._counts = Counter() if fitter._pruning else None
+    # Bag validators infer their type from the first non-empty bag
+    fitter.schema, fitter.validator = copy.deepcopy((fitter.schema,
+                                                     fitter.validator))
+    try:
+        for datapoint in chunk:
+            if validate:
+                datapoint = fitter.validator.validate(datapoint)
+            fitter._fit_step(datapoint)
+    except SchemaError as e:
+        # SchemaError can't be unpickled, it's raised as _wrapcall does
+        raise ValueError(*e.args)
+    keys = [None] * len(fitter.column_positions)
+    for i, values in fitter.vocabularies.items():
+        for value, j in values.items():
+            keys[j] = (i, value)
+    elem_types = dict((i, fitter.schema[i].elem_type)
+                      for i in fitter.bag_indexes)
+    return keys, fitter._counts, elem_types
+
+
+def _first_tuple(X):
+    # Returns the first tuple of X and an iterator with the rest
+    X = iter(X)
+    try:
+        first = next(X)
+    except (TypeError, StopIteration):
+        raise ValueError("Cannot fit with an empty dataset")
+    return first, X
+
+
+def _chunks(X, size):
+    # Yields lists with the next `size` elements of X
+    X = iter(X)
+    while True:
+        chunk = list(islice(X, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _numbers(values, validate):
+    # Array with the numbers in `values` (a list of numbers, or of number
+    # sequences), which must be all ints, floats or bools if validating
+    if not validate:
+        return numpy.array(values, dtype=float)
+    result = numpy.array(values)
+    if result.dtype.kind not in "biuf":
+        raise ValueError("Not numeric values")
+    return result
+
+
+def _number_writer(j):
+    def write(value, row):
+        row[j] = value
+    return write
+
+
+def _slice_writer(j, size):
+    end = j + size
+
+    def write(value, row):
+        row[j:end] = value
+    return write
+
+
+def _lookup_writer(vocabulary, other):
+    lookup = vocabulary.get
+
+    def write(value, row):
+        j = lookup(value, other)
+        if j is not None:
+            row[j] = 1.0
+    return write
+
+
+def _cells_writer(cells):
+    def write(value, row):
+        for j, v in cells(value):
+            row[j] = v
+    return write
+
+
+def _number_cells(j):
+    def cells(value):
+        return ((j, value),) if value != 0.0 else ()
+    return cells
+
+
+def _slice_cells(j):
+    def cells(value):
+        return [(j + k, v) for k, v in enumerate(value) if v != 0.0]
+    return cells
+
+
+def _str_cells(str_column):
+    def cells(value):
+        cell = str_column(value)
+        return (cell,) if cell is not None else ()
+    return cells
+
+
+class _RowTransformer(object):
+    # Base of the functions returned by row_transformer
+
+    def __init__(self, flattener, functions, unchecked=None):
+        validators = [schema.validate for schema in flattener.validator.tt]
+        if flattener.sparse:
+            writers = flattener._sparse_writers()
+        else:
+            writers = flattener._dense_writers()
+        self.checked = list(zip(functions, validators, writers))
+        self.fast = list(zip(unchecked or functions, writers))
+        self.policy = flattener.policy
+        self.count = len(functions) + 1
+        self.n_columns = flattener.n_columns
+        self.dtype = flattener.dtype
+        self.index_dtype = flattener.index_dtype
+
+
+class _DenseRowTransformer(_RowTransformer):
+
+    def __call__(self, x, out=None):
+        if out is None:
+            row = numpy.zeros(self.n_columns, dtype=self.dtype)
+        else:
+            if out.shape != (self.n_columns,):
+                raise ValueError("out must have shape ({},) but has shape "
+                                 "{}".format(self.n_columns, out.shape))
+            row = out
+            row.fill(0.0)
+        try:
+            if self.policy.should_validate(False, self.count):
+                for f, v, w in self.checked:
+                    w(v(f(x)), row)
+            else:
+                for f, w in self.fast:
+                    w(f(x), row)
+        except SchemaError as e:
+            raise ValueError(*e.args)
+        return row
+
+
+class _SparseRowTransformer(_RowTransformer):
+
+    def __call__(self, x, out=None):
+        if out is not None:
+            raise ValueError("out is only supported for dense results")
+        try:
+            if self.policy.should_validate(False, self.count):
+                cells = [w(v(f(x))) for f, v, w in self.checked]
+            else:
+                cells = [w(f(x)) for f, w in self.fast]
+        except SchemaError as e:
+            raise ValueError(*e.args)
+        cells = list(chain.from_iterable(cells))
+        if not cells:
+            return (numpy.zeros(0, dtype=self.index_dtype),
+                    numpy.zeros(0, dtype=self.dtype))
+        indices, values = zip(*cells)
+        return (numpy.array(indices, dtype=self.index_dtype),
+                numpy.array(values, dtype=self.dtype))
+
+
+class _DenseRows(object):
+    """
+    A dense matrix being filled by consecutive rows. Rows are written either
+    in a caller supplied `out` array, or in a single buffer allocated for
+    `size` rows (when known) that is grown in place when needed.
+    """
+
+    def __init__(self, columns, size=None, out=None, dtype=numpy.float64):
+        if out is not None:
+            if out.ndim != 2 or out.shape[1] != columns:
+                raise ValueError("out must have shape (n, {}) but has shape "
+                                 "{}".format(columns, out.shape))
+            self.matrix = out
+        else:
+            if size is None:
+                size = DENSE_INITIAL_ROWS
+            self.matrix = numpy.zeros((size, columns), dtype=dtype)
+        self.out = out
+        self.n = 0
+
+    def next_rows(self, count):
+        """Returns a zeroed view of the next `count` rows of the matrix"""
+        start, end = self.n, self.n + count
+        capacity, columns = self.matrix.shape
+        if end > capacity:
+            if self.out is not None:
+                raise ValueError("out has room for {} rows only".format(
+                                 capacity))
+            capacity = max(end, 2 * capacity, DENSE_INITIAL_ROWS)
+            # Grows in place, new rows are zeroed
+            self.matrix.resize((capacity, columns), refcheck=False)
+        self.n = end
+        block = self.matrix[start:end]
+        if self.out is not None:
+            block.fill(0.0)
+        return block
+
+    def next_row(self):
+        return self.next_rows(1)[0]
+
+    def result(self):
+        if self.out is not None:
+            return self.out[:self.n]
+        if self.n != self.matrix.shape[0]:
+            self.matrix.resize((self.n, self.matrix.shape[1]), refcheck=False)
+        return self.matrix
+
+
+class _SparseRows(object):
+    """
+    A sparse matrix being built by consecutive rows, as the (data, indices,
+    indptr) arrays of its CSR representation. Indices start as
+    `index_dtype`, and are promoted to 64 bits if the amount of non-zero
+    values grows too big for 32 bit indices.
+    """
+
+    def __init__(self, dtype, index_dtype, columns=0):
+        if columns > _INT32_MAX:
+            index_dtype = numpy.int64
+        typecode = INDEX_DTYPES[numpy.dtype(index_dtype)]
+        self.data = array.array(DTYPES[numpy.dtype(dtype)])
+        self.indices = array.array(typecode)
+        self.indptr = array.array(typecode, [0])
+
+    def add_row(self, cells):
+        """Adds a row with the (column, value) pairs in `cells`"""
+        data, indices = self.data, self.indices
+        for j, value in cells:
+            data.append(value)
+            indices.append(j)
+        nnz = len(data)
+        if nnz > _INT32_MAX and self.indptr.typecode == "i":
+            self.indices = array.array("q", self.indices)
+            self.indptr = array.array("q", self.indptr)
+        self.indptr.append(nnz)
+
+    def arrays(self):
+        """Returns the (data, indices, indptr) numpy arrays of the matrix"""
+        return tuple(numpy.frombuffer(a, dtype=a.typecode)
+                     for a in (self.data, self.indices, self.indptr))
+
 
 class NumberSequenceValidator(object):
     def __init__(self, sample_data_point=None):
@@ -465,7 +1809,7 @@ class BagValidator(object):
 
 class TupleValidator(object):
     def __init__(self, types_tuple):
-        self.tt = tuple(map(Schema, types_tuple))
+        self.tt = tuple(map(CompiledSchema, types_tuple))
         self.N = len(self.tt)
 
     def validate(self, x):
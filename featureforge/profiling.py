@@ -0,0 +1,210 @@
+"""
+Profiling of feature evaluations.
+
+When a vectorizer gets slow it's hard to tell which of its features is
+responsible. Evaluators created with `profile=True` time every evaluation of
+every feature, splitting the time spent validating its input and output from
+the time spent in the feature itself, and count the evaluations that raised
+an exception. The statistics are available as a dictionary or a text table
+(see `Profiler.report` and `Profiler.format_report`).
+
+When profiling is not enabled features are called directly, so there is no
+overhead at all.
+"""
+from collections import OrderedDict
+import random
+import threading
+from timeit import default_timer
+
+from schema import SchemaError
+
+# Amount of evaluation times kept for each feature to estimate percentiles
+PROFILE_SAMPLE_SIZE = 1000
+
+
+class FeatureProfile(object):
+    """
+    Statistics of the evaluations of a single feature. Percentiles are
+    estimated from a uniform sample of (at most) `sample_size` evaluation
+    times. Evaluations can be recorded from several threads at once.
+    """
+
+    def __init__(self, name, sample_size=PROFILE_SAMPLE_SIZE, seed=None):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.evaluate_time = 0.0
+        self.validation_time = 0.0
+        self.sample_size = sample_size
+        self.samples = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, evaluate_time, validation_time=0.0, calls=1):
+        """
+        Records `calls` evaluations that took `evaluate_time` seconds in the
+        feature and `validation_time` seconds validating, in total.
+        """
+        elapsed = (evaluate_time + validation_time) / calls
+        with self._lock:
+            self.calls += calls
+            self.evaluate_time += evaluate_time
+            self.validation_time += validation_time
+            # Reservoir sampling, so every evaluation is equally likely to be
+            # kept
+            if len(self.samples) < self.sample_size:
+                self.samples.append(elapsed)
+            else:
+                k = self._random.randrange(self.calls)
+                if k < self.sample_size:
+                    self.samples[k] = elapsed
+
+    def add_error(self):
+        """Records an evaluation that raised an exception"""
+        with self._lock:
+            self.errors += 1
+
+    @property
+    def total_time(self):
+        return self.evaluate_time + self.validation_time
+
+    def percentile(self, q):
+        """Estimated time of the evaluations in the q-th percentile"""
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        k = int(round(q / 100.0 * (len(samples) - 1)))
+        return samples[k]
+
+    def as_dict(self):
+        return OrderedDict([
+            ("calls", self.calls),
+            ("errors", self.errors),
+            ("total_time", self.total_time),
+            ("evaluate_time", self.evaluate_time),
+            ("validation_time", self.validation_time),
+            ("mean_time", self.total_time / self.calls if self.calls else 0.0),
+            ("p50", self.percentile(50)),
+            ("p90", self.percentile(90)),
+            ("p99", self.percentile(99)),
+        ])
+
+
+class Profiler(object):
+    """
+    Profiler() keeps a FeatureProfile for each feature, and builds wrappers
+    around the features recording their evaluations.
+    """
+
+    def __init__(self, sample_size=PROFILE_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.reset()
+
+    def reset(self):
+        self.profiles = OrderedDict()
+
+    def profile(self, feature):
+        """Returns the FeatureProfile of `feature`, creating it if needed"""
+        profile = self.profiles.get(feature)
+        if profile is None:
+            name = getattr(feature, "name", repr(feature))
+            profile = FeatureProfile(name, self.sample_size, seed=name)
+            self.profiles[feature] = profile
+        return profile
+
+    def timed(self, feature, function):
+        """
+        Returns a function equivalent to `function` (which evaluates
+        `feature` without validation) that records its evaluations
+        """
+        profile = self.profile(feature)
+        timer = default_timer
+
+        def timed(data_point):
+            start = timer()
+            try:
+                result = function(data_point)
+            except Exception:
+                profile.add_error()
+                raise
+            profile.record(timer() - start)
+            return result
+        return timed
+
+    def timed_validation(self, feature):
+        """
+        Returns a function equivalent to calling `feature` (which validates
+        its input and output), that records its evaluations timing the
+        validation apart from the evaluation itself
+        """
+        if not hasattr(feature, "input_schema"):
+            # Not a Feature, there is no validation to time
+            return self.timed(feature, feature)
+        profile = self.profile(feature)
+        timer = default_timer
+        input_schema, output_schema = feature.input_schema, \
+            feature.output_schema
+        evaluate = feature._evaluate
+
+        def timed(data_point):
+            start = timer()
+            try:
+                try:
+                    data_point = input_schema.validate(data_point)
+                except SchemaError as e:
+                    raise feature.InputValueError(e)
+                evaluate_start = timer()
+                result = evaluate(data_point)
+                evaluate_end = timer()
+                try:
+                    result = output_schema.validate(result)
+                except SchemaError as e:
+                    raise feature.OutputValueError(e)
+            except Exception:
+                profile.add_error()
+                raise
+            end = timer()
+            profile.record(evaluate_end - evaluate_start,
+                           evaluate_start - start + end - evaluate_end)
+            return result
+        return timed
+
+    def report(self):
+        """
+        Returns an ordered dictionary from feature name to a dictionary with
+        the statistics of its evaluations: amount of calls and errors, total
+        time, time in the feature and validating, mean time and the 50th, 90th
+        and 99th percentiles (all the times in seconds)
+        """
+        return OrderedDict((p.name, p.as_dict())
+                           for p in self.profiles.values())
+
+    def format_report(self):
+        """Returns the report as a text table, slowest features first"""
+        header = ("feature", "calls", "errors", "total", "evaluate",
+                  "validation", "mean", "p50", "p90", "p99")
+        rows = []
+        profiles = sorted(self.profiles.values(),
+                          key=lambda p: p.total_time, reverse=True)
+        for p in profiles:
+            stats = p.as_dict()
+            times = ("total_time", "evaluate_time", "validation_time")
+            per_call = ("mean_time", "p50", "p90", "p99")
+            rows.append((p.name, str(stats["calls"]), str(stats["errors"])) +
+                        tuple("%.6f" % stats[k] for k in times) +
+                        tuple("%.2e" % stats[k] for k in per_call))
+        widths = [max(len(row[i]) for row in [header] + rows)
+                  for i in range(len(header))]
+        lines = [u"  ".join(value.rjust(w) if i else value.ljust(w)
+                            for i, (value, w) in enumerate(zip(row, widths)))
+                 for row in [header] + rows]
+        return u"\n".join(lines)
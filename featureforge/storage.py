@@ -0,0 +1,133 @@
+"""
+Storage of feature matrices in disk.
+
+A matrix is stored in a directory, as one .npy file for dense matrices
+(`dense.npy`) or as the arrays of its CSR representation for sparse matrices
+(`data.npy`, `indices.npy`, `indptr.npy`, plus `shape.npy`). Matrices are
+written block by block, so their size is not limited by the available
+memory, and they are loaded as memory-mapped arrays, so opening them is
+instantaneous and only the parts used are read from disk.
+"""
+import os
+
+import numpy
+from numpy.lib.format import dtype_to_descr, magic
+from scipy.sparse import csr_matrix
+
+DENSE_FILE = "dense.npy"
+SPARSE_FILES = ("data.npy", "indices.npy", "indptr.npy")
+SHAPE_FILE = "shape.npy"
+
+# Sparse matrices use 64 bit indices on disk, so the amount of non zero
+# values is not limited to 2 ** 31
+INDEX_DTYPE = numpy.int64
+
+# Bytes reserved for the header of .npy files being written. The amount of
+# rows is not known until the end, so the header is written when closing
+# them, padded to this size (a multiple of 64 keeps the data aligned).
+_HEADER_SIZE = 128
+
+
+class _NpyWriter(object):
+    """
+    Writes a .npy file with an array of `dtype` that grows along its first
+    axis as values are appended. `row_shape` is the shape of each row.
+    """
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.dtype = numpy.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(path, "wb")
+        self.file.seek(_HEADER_SIZE)
+
+    def append(self, values):
+        values = numpy.ascontiguousarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        # Format 1.0: magic string, header length (2 bytes) and header
+        prefix = magic(1, 0)
+        size = _HEADER_SIZE - len(prefix) - 2
+        header = repr({"descr": dtype_to_descr(self.dtype),
+                       "fortran_order": False,
+                       "shape": (self.rows,) + self.row_shape})
+        header = header.ljust(size - 1) + "\n"
+        assert len(header) == size, "Header too long"
+        self.file.seek(0)
+        self.file.write(prefix)
+        self.file.write(numpy.array(size, dtype="<u2").tobytes())
+        self.file.write(header.encode("latin1"))
+        self.file.close()
+
+
+def _prepare_directory(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in (DENSE_FILE, SHAPE_FILE) + SPARSE_FILES:
+        filename = os.path.join(path, name)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def write_dense(blocks, path, n_columns, dtype=float):
+    """
+    Writes the dense matrix obtained stacking `blocks` (2-d arrays with
+    `n_columns` columns) into the directory `path`.
+    """
+    _prepare_directory(path)
+    writer = _NpyWriter(os.path.join(path, DENSE_FILE), dtype, (n_columns,))
+    try:
+        for block in blocks:
+            writer.append(block)
+    finally:
+        writer.close()
+
+
+def write_sparse(blocks, path, n_columns, dtype=float):
+    """
+    Writes the CSR matrix obtained stacking `blocks` (sparse matrices with
+    `n_columns` columns) into the directory `path`.
+    """
+    _prepare_directory(path)
+    data, indices, indptr = [
+        _NpyWriter(os.path.join(path, name), t)
+        for name, t in zip(SPARSE_FILES, (dtype, INDEX_DTYPE, INDEX_DTYPE))]
+    rows = 0
+    try:
+        indptr.append([0])
+        for block in blocks:
+            block = csr_matrix(block)
+            block.sum_duplicates()
+            indptr.append(block.indptr[1:].astype(INDEX_DTYPE) + data.rows)
+            data.append(block.data)
+            indices.append(block.indices)
+            rows += block.shape[0]
+    finally:
+        for writer in (data, indices, indptr):
+            writer.close()
+    numpy.save(os.path.join(path, SHAPE_FILE),
+               numpy.array([rows, n_columns], dtype=INDEX_DTYPE))
+
+
+def load_matrix(path, mode="r"):
+    """
+    Opens the matrix stored in the directory `path`, memory-mapping its
+    arrays with the given `mode` (see numpy.memmap). Returns a numpy.memmap
+    for dense matrices, and a scipy.sparse.csr_matrix backed by memory-mapped
+    arrays for sparse ones.
+    """
+    dense_path = os.path.join(path, DENSE_FILE)
+    if os.path.exists(dense_path):
+        return numpy.load(dense_path, mmap_mode=mode)
+    shape = numpy.load(os.path.join(path, SHAPE_FILE))
+    shape = tuple(int(n) for n in shape)
+    data, indices, indptr = [
+        numpy.load(os.path.join(path, name), mmap_mode=mode)
+        for name in SPARSE_FILES]
+    # The constructor of csr_matrix may copy the arrays to downcast the
+    # indices, so they are set afterwards to keep them memory-mapped.
+    result = csr_matrix(shape, dtype=data.dtype)
+    result.data, result.indices, result.indptr = data, indices, indptr
+    return result
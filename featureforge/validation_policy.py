@@ -0,0 +1,110 @@
+"""
+Policies deciding when feature values and feature tuples are validated.
+
+By default every evaluation of a feature validates its input and output, and
+every feature tuple is validated by the flattener. When the data is already
+trusted (for example when serving a model in production) that validation can
+be partially or totally skipped using one of these policies:
+
+ * `ALWAYS` validates everything (the default)
+ * `FIT_ONLY` validates when fitting (fit/fit_transform) and skips validation
+   when transforming
+ * `sample(rate)` validates a random fraction `rate` of the evaluations
+ * `NEVER` skips every validation
+
+Policies can be given to the Vectorizer (and the evaluators/flattener) as one
+of these mode names or as a `ValidationPolicy` instance. When no policy is
+given, the default one is used; it can be changed with
+`set_default_policy`. Each policy counts how many validations it allowed
+(`validated`) and how many it skipped (`skipped`).
+"""
+import random
+
+ALWAYS = 'always'
+FIT_ONLY = 'fit_only'
+SAMPLE = 'sample'
+NEVER = 'never'
+
+MODES = (ALWAYS, FIT_ONLY, SAMPLE, NEVER)
+
+
+class ValidationPolicy(object):
+    """
+    ValidationPolicy(mode, rate=None, seed=None) decides which validations
+    are done. `rate` is the fraction of validations done by the `SAMPLE`
+    mode, and `seed` allows making that sample reproducible.
+    """
+
+    def __init__(self, mode=ALWAYS, rate=None, seed=None):
+        if mode not in MODES:
+            raise ValueError("Unknown validation mode %r" % (mode,))
+        if mode == SAMPLE:
+            if rate is None or not 0.0 <= rate <= 1.0:
+                raise ValueError("Sampling rate must be between 0 and 1")
+        self.mode = mode
+        self.rate = rate
+        self._random = random.Random(seed)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.validated = 0
+        self.skipped = 0
+
+    def should_validate(self, fitting, count=1):
+        """
+        Returns True if the next `count` validations must be done. `fitting`
+        tells if those happen while fitting or while transforming.
+        """
+        mode = self.mode
+        if mode == ALWAYS:
+            result = True
+        elif mode == NEVER:
+            result = False
+        elif mode == FIT_ONLY:
+            result = fitting
+        else:
+            result = self._random.random() < self.rate
+        if result:
+            self.validated += count
+        else:
+            self.skipped += count
+        return result
+
+    def __repr__(self):
+        if self.mode == SAMPLE:
+            return '%s(%r, rate=%r)' % (type(self).__name__, self.mode,
+                                        self.rate)
+        return '%s(%r)' % (type(self).__name__, self.mode)
+
+
+def sample(rate, seed=None):
+    """Returns a policy validating a random fraction `rate` of evaluations"""
+    return ValidationPolicy(SAMPLE, rate=rate, seed=seed)
+
+
+_default_policy = ValidationPolicy(ALWAYS)
+
+
+def get_default_policy():
+    return _default_policy
+
+
+def set_default_policy(policy):
+    """
+    Sets the policy used by evaluators and flatteners not given an explicit
+    one. `policy` is a mode name or a ValidationPolicy instance.
+    """
+    global _default_policy
+    _default_policy = make_policy(policy)
+
+
+def make_policy(policy):
+    """
+    Builds a ValidationPolicy from a mode name, returning the default policy
+    for None and `policy` itself if it's already a ValidationPolicy.
+    """
+    if policy is None:
+        return _default_policy
+    if isinstance(policy, ValidationPolicy):
+        return policy
+    return ValidationPolicy(policy)
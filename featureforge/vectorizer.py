@@ -1,13 +1,24 @@
 import logging
+import os
+import pickle
 
 from future.builtins import map
+import numpy
 
-from featureforge.evaluator import FeatureEvaluator, TolerantFeatureEvaluator
-from featureforge.feature import make_feature
-from featureforge.flattener import FeatureMappingFlattener
+from featureforge.evaluator import (CONCURRENCY, FILL, RAISE,
+                                    FeatureEvaluator,
+                                    TolerantFeatureEvaluator,
+                                    _effective_n_jobs)
+from featureforge.feature import is_batch_feature, is_io_bound, make_feature
+from featureforge.flattener import (FeatureMappingFlattener,
+                                    TRANSFORM_CHUNK_SIZE)
+from featureforge.validation_policy import make_policy
 
 logger = logging.getLogger(__name__)
 
+# File with the state of a saved vectorizer, besides the flattener vocabulary
+VECTORIZER_FILE = "vectorizer.pickle"
+
 
 class Vectorizer(object):
     """
@@ -32,31 +43,337 @@ class Vectorizer(object):
     for featureforge.evaluator.TolerantFeatureEvaluator
 
     Vectorizer(features, sparse=True) changes the result data type, returning a
-    sparse numpy matrix instead of a dense matrix. See the documentation on
-    featureforge.flattener.Flattener
+    sparse numpy matrix instead of a dense matrix. `sparse` can also be
+    "csr", "csc" or "coo" to choose the format of the sparse matrix. See the
+    documentation on featureforge.flattener.Flattener
+
+    Vectorizer(features, n_jobs=N) evaluates the features on N worker
+    processes when transforming (-1 means one per CPU), and learns the
+    vocabulary of enumerated and bag of words features on N processes when
+    fitting. See the documentation for featureforge.evaluator.FeatureEvaluator
+    and featureforge.flattener.FeatureMappingFlattener
+
+    Vectorizer(features, validation=policy) decides when feature inputs,
+    outputs and feature tuples are validated. `policy` can be "always",
+    "fit_only", "never" or a featureforge.validation_policy.ValidationPolicy
+    like `sample(0.01)`. The same policy (and its counters of validations done
+    and skipped) is shared by the evaluator and the flattener. See the
+    documentation for featureforge.validation_policy
+
+    Vectorizer(features, hashing=N) maps each enumerated or bag of words
+    feature to N columns using a hash of its values, instead of one column
+    per value seen when fitting. See the documentation on
+    featureforge.flattener.FeatureMappingFlattener
+
+    Vectorizer(features, dtype=numpy.float32) builds matrices of 32 bit
+    floats (the default is float64), and `index_dtype=numpy.int64` forces
+    64 bit indices in sparse matrices (32 bit indices are used otherwise,
+    and promoted when needed). See the documentation on
+    featureforge.flattener.FeatureMappingFlattener
+
+    Vectorizer(features, profile=True) records how long each feature takes
+    to evaluate (and validate), and how many times it fails. See
+    `profile_report` and featureforge.profiling
+
+    Vectorizer(features, tolerant=True, on_transform_error=policy) also
+    tolerates failures when transforming. With "skip", data points failing
+    are left out of the matrix (use `transform(X, return_rows=True)` to know
+    which data points each row comes from). With "fill", the failing feature
+    values are replaced: numbers by `fill_value` (NaN by default), number
+    sequences by a sequence of `fill_value`, strings by an empty string and
+    bags by an empty bag. See the documentation for
+    featureforge.evaluator.TolerantFeatureEvaluator
+
+    Vectorizer(features, cache=FeatureCache(path)) keeps the feature values
+    computed in a persistent cache, and loads them from there instead of
+    evaluating the features again when possible (for example, when running
+    the same experiment again after changing some of the features). See the
+    documentation for featureforge.cache
+
+    Vectorizer(features, concurrency=N) evaluates the I/O bound features
+    (see featureforge.feature.io_bound) on at most N data points at once
+    when transforming. See the documentation for
+    featureforge.evaluator.FeatureEvaluator
     """
 
-    def __init__(self, features, tolerant=False, sparse=True):
+    def __init__(self, features, tolerant=False, sparse=True, n_jobs=1,
+                 validation=None, hashing=None, dtype=numpy.float64,
+                 index_dtype=numpy.int32, profile=False,
+                 on_transform_error=RAISE,
+                 fill_value=float("nan"), cache=None,
+                 concurrency=CONCURRENCY):
         # Upgrade `features` to `Feature` instances.
         features = list(map(make_feature, features))
+        if validation is not None:
+            validation = make_policy(validation)
+        self.on_transform_error = on_transform_error
         if tolerant:
-            self.evaluator = TolerantFeatureEvaluator(features)
+            self.evaluator = TolerantFeatureEvaluator(
+                features, n_jobs=n_jobs, validation=validation,
+                profile=profile, on_transform_error=on_transform_error,
+                cache=cache, concurrency=concurrency)
+        elif on_transform_error != RAISE:
+            raise ValueError("on_transform_error requires tolerant=True")
         else:
-            self.evaluator = FeatureEvaluator(features)
-        self.flattener = FeatureMappingFlattener(sparse=sparse)
+            self.evaluator = FeatureEvaluator(features, n_jobs=n_jobs,
+                                              validation=validation,
+                                              profile=profile, cache=cache,
+                                              concurrency=concurrency)
+        self.flattener = FeatureMappingFlattener(sparse=sparse,
+                                                 validation=validation,
+                                                 hashing=hashing,
+                                                 dtype=dtype,
+                                                 index_dtype=index_dtype,
+                                                 n_jobs=n_jobs)
+        self.fill_value = fill_value
+        self._row_transformer = None
+
+    def __getstate__(self):
+        # The row transformer is made of closures, it's rebuilt when needed
+        state = self.__dict__.copy()
+        state['_row_transformer'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Options missing in vectorizers pickled by older versions keep their
+        # default values
+        self.on_transform_error = RAISE
+        self.fill_value = float("nan")
+        self._row_transformer = None
+        self.__dict__.update(state)
+
+    def save(self, path):
+        """
+        Saves the fitted vectorizer in the directory `path` (created if
+        needed). The vocabulary of the flattener is stored as tables of flat
+        arrays, and the rest of the vectorizer (including its features,
+        which must be picklable) is pickled. See
+        FeatureMappingFlattener.save
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        state = self.__getstate__()
+        flattener_state = self.flattener._saved_state(path)
+        state["flattener"] = None
+        with open(os.path.join(path, VECTORIZER_FILE), "wb") as f:
+            # Pickled together, so the validation policy is still shared
+            pickle.dump((state, flattener_state), f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a vectorizer saved with `save`. With `mmap=True` the
+        vocabulary is memory-mapped instead of read, so loading takes
+        milliseconds no matter its size, and processes loading the same
+        vectorizer share its memory. See FeatureMappingFlattener.load
+        """
+        with open(os.path.join(path, VECTORIZER_FILE), "rb") as f:
+            state, flattener_state = pickle.load(f)
+        result = cls.__new__(cls)
+        result.__dict__.update(state)
+        result.flattener = FeatureMappingFlattener._from_saved_state(
+            flattener_state, path, mmap)
+        return result
 
     def fit(self, X, y=None):
+        self._row_transformer = None
         Xt = self.evaluator.fit_transform(X, y)
         self.flattener.fit(Xt, y)
         return self
 
+    def partial_fit(self, X, y=None):
+        """
+        Incrementally fits the vectorizer with the data points in X. Columns
+        learned by previous calls to fit/partial_fit keep their indexes, and
+        new enumerated/bag values get new columns at the end, so the cost is
+        proportional to the size of X. See
+        FeatureMappingFlattener.partial_fit
+        """
+        self._row_transformer = None
+        Xt = self.evaluator.partial_fit_transform(X, y)
+        self.flattener.partial_fit(Xt, y)
+        return self
+
     def fit_transform(self, X, y=None):
+        self._row_transformer = None
         Xt = self.evaluator.fit_transform(X, y)
         return self.flattener.fit_transform(Xt, y)
 
-    def transform(self, X):
-        Xt = self.evaluator.transform(X)
-        return self.flattener.transform(Xt)
+    def transform(self, X, out=None, return_rows=False):
+        """
+        Transforms the data points in X into a matrix. For dense results, the
+        matrix can be written into a preallocated `out` array (see
+        FeatureMappingFlattener.transform).
+
+        If `return_rows` is True, returns a tuple (matrix, rows) where rows
+        is an array with the index in X of the data point of each row (they
+        differ when data points failing are skipped, see
+        `on_transform_error`).
+        """
+        if self._tolerant_transform:
+            # Skipped data points leave no row, so only the first rows of
+            # `out` may be written
+            result = self.flattener.transform(self._evaluate(X), out=out)
+            rows = self.evaluator.transform_rows
+        else:
+            result = self._transform(X, out)
+            rows = range(result.shape[0])
+        if return_rows:
+            return result, numpy.array(rows, dtype=int)
+        return result
+
+    @property
+    def _tolerant_transform(self):
+        return self.on_transform_error != RAISE
+
+    def _evaluate(self, X):
+        # Evaluates the features on X for transforming, as tuples
+        evaluator = self.evaluator
+        if self.on_transform_error == FILL:
+            # Failing features are filled with values of their fitted type
+            values = self.flattener.fill_tuple(self.fill_value)
+            fill_value = dict(zip(evaluator.alive_features, values))
+            return evaluator.transform(X, fill_value=fill_value)
+        return evaluator.transform(X)
+
+    def _transform(self, X, out):
+        features = self.evaluator.alive_features
+        fused = not (any(map(is_batch_feature, features)) or
+                     _effective_n_jobs(self.evaluator.n_jobs) > 1 or
+                     any(map(is_io_bound, features)))
+        if out is None and not fused and not self.flattener.sparse:
+            try:
+                # Build the result in a single allocation (the flattener
+                # zeroes each row of `out` before writing it)
+                out = numpy.empty((len(X), self.flattener.n_columns),
+                                  dtype=self.flattener.dtype)
+            except TypeError:
+                pass  # Unknown length, the flattener will grow its buffer
+        if any(map(is_batch_feature, features)):
+            # Keep the values grouped by feature, see Feature._evaluate_batch
+            Xc = self.evaluator.transform_columns(X)
+            return self.flattener.transform_columns(Xc, out=out)
+        if not fused:
+            # Evaluated in parallel or concurrently by the evaluator
+            Xt = self.evaluator.transform(X)
+            return self.flattener.transform(Xt, out=out)
+        # Evaluate each feature and write its value into the matrix in a
+        # single pass, without building the tuples of feature values (the
+        # flattener allocates the result at once when the length of X is
+        # known)
+        try:
+            return self.flattener.fused_transform(
+                X, self.evaluator.feature_functions(True),
+                self.evaluator.feature_functions(False), out=out,
+                scope=self.evaluator.shared_scope())
+        finally:
+            self.evaluator.flush_cache()
+
+    def transform_one(self, x, out=None):
+        """
+        Transforms a single data point with the least possible overhead, for
+        online scoring. Returns a 1-d array with the row of the data point
+        (written into `out` if given) for dense vectorizers, and a pair of
+        arrays (indices, values) with its non-zero cells for sparse ones.
+        The values are the same as in the matrix built by `transform([x])`.
+
+        The functions evaluating the features and writing their values are
+        prepared on the first call after fitting, and reused by later calls.
+        When data points failing are skipped (see `on_transform_error`),
+        returns None for them.
+        """
+        if self._tolerant_transform:
+            return self._tolerant_one(self.transform([x]), out)
+        if self._row_transformer is None:
+            evaluator = self.evaluator
+            self._row_transformer = (
+                self.flattener.row_transformer(
+                    evaluator.feature_functions(True),
+                    evaluator.feature_functions(False)),
+                evaluator.shared_scope())
+        transform, scope = self._row_transformer
+        with scope(x):
+            return transform(x, out)
+
+    def _tolerant_one(self, matrix, out):
+        if matrix.shape[0] == 0:
+            return None
+        if self.flattener.sparse:
+            row = matrix.getrow(0)
+            return row.indices, row.data
+        if out is None:
+            return matrix[0]
+        out[:] = matrix[0]
+        return out
+
+    def transform_many(self, X, out=None):
+        """
+        Transforms a small batch of data points like `transform_one`.
+        Returns a 2-d array with a row per data point (written into `out` if
+        given) for dense vectorizers, and a list with a pair (indices,
+        values) per data point for sparse ones. For big batches, `transform`
+        is faster.
+        """
+        if not self.flattener.sparse:
+            if out is None:
+                out = numpy.zeros((len(X), self.flattener.n_columns),
+                                  dtype=self.flattener.dtype)
+            elif len(out) < len(X):
+                raise ValueError("out has room for {} rows only".format(
+                                 len(out)))
+            if self._tolerant_transform:
+                # Skipped data points leave no row
+                return self.transform(X, out=out)
+            for x, row in zip(X, out):
+                self.transform_one(x, row)
+            return out[:len(X)]
+        if out is not None:
+            raise ValueError("out is only supported for dense results")
+        return [self.transform_one(x) for x in X]
+
+    def transform_chunks(self, X, chunk_size=TRANSFORM_CHUNK_SIZE):
+        """
+        Transforms the data points in X into a sequence of matrices of (at
+        most) `chunk_size` rows each, consuming X lazily so that datasets
+        larger than the available memory can be processed. Features are
+        evaluated as X is consumed. See
+        FeatureMappingFlattener.transform_chunks
+        """
+        Xt = self._evaluate(X)
+        return self.flattener.transform_chunks(Xt, chunk_size)
+
+    def transform_to_disk(self, X, path, chunk_size=TRANSFORM_CHUNK_SIZE):
+        """
+        Transforms the data points in X into a matrix written in the
+        directory `path`, keeping at most `chunk_size` rows in memory at
+        once. Returns the matrix memory-mapped from disk; it can be opened
+        again later with featureforge.storage.load_matrix. See
+        FeatureMappingFlattener.transform_to_disk
+        """
+        Xt = self._evaluate(X)
+        return self.flattener.transform_to_disk(Xt, path, chunk_size)
+
+    def close(self):
+        """
+        Terminates the worker processes kept by the evaluator and the
+        flattener (see FeatureEvaluator.close and
+        FeatureMappingFlattener.close). They are started again if needed.
+        """
+        self.evaluator.close()
+        self.flattener.close()
+
+    def profile_report(self, table=False):
+        """
+        Returns the statistics of the feature evaluations, by feature name,
+        when profiling (see FeatureEvaluator.profile_report). If `table` is
+        True they are formatted as a text table, slowest features first.
+        """
+        return self.evaluator.profile_report(table)
+
+    @property
+    def validation_policy(self):
+        """The ValidationPolicy used by the evaluator and the flattener"""
+        return self.evaluator.policy
 
     def column_to_feature(self, i):
         """
@@ -72,7 +389,9 @@ class Vectorizer(object):
               corresponds to the one-hot encoding of that column.
             - If the feature spawns an array then `value` is the index within
               the spawned array that corresponds to that column.
+            - If the feature is hashed then `value` is a HashedValue with
+              the number of the column among the feature columns.
         """
-        j, value = self.flattener.reverse[i]
+        j, value = self.flattener.column_info(i)
         feature = self.evaluator.alive_features[j]
         return feature, value
@@ -0,0 +1,288 @@
+"""
+Array storage of the vocabulary of saved flatteners.
+
+The vocabulary maps each string (or bag element) seen when fitting to its
+column. Fitted flatteners keep it as a dictionary for each tuple position,
+and unpickling one rebuilds those dictionaries, which is slow for big
+vocabularies. Saved flatteners store it instead as one table for each
+tuple position, made of flat arrays:
+
+ * `pool`: the UTF-8 encoded strings, concatenated in sorted order
+ * `offsets`: where each string starts in the pool (plus the end of the last)
+ * `columns`: the column of each string
+
+Tables are loaded memory-mapped, so loading takes the same time no matter
+their size, only the pages used are read from disk, and processes serving
+the same model share them. Strings are looked up by binary search on the
+sorted pool, and the columns found are remembered (up to `LOOKUP_CACHE_SIZE`
+values per table), so lookups are slower than with dictionaries. Columns
+are absolute (the columns of a tuple position are numbered in order of
+appearance, so they aren't contiguous), and the string of a column is
+found through the column order of the table, computed when first needed.
+
+Values that are not strings (bag elements of other types, the "other"
+columns) are few, and are stored in a regular dictionary.
+"""
+from bisect import bisect_left
+import os
+import pickle
+
+from future.builtins import str
+import numpy
+
+# Amount of values whose column is remembered by each table
+LOOKUP_CACHE_SIZE = 100000
+
+EXTRA_FILE = "vocabulary.pickle"
+TABLE_FILES = ("vocabulary_%d_pool.npy", "vocabulary_%d_offsets.npy",
+               "vocabulary_%d_columns.npy")
+
+
+class _Keys(object):
+    # Sequence of the encoded strings of a table, for bisect
+    def __init__(self, pool, offsets):
+        self.pool = pool
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        return self.pool[self.offsets[k]:self.offsets[k + 1]].tobytes()
+
+
+class VocabularyTable(object):
+    """
+    VocabularyTable(pool, offsets, columns) maps the strings of a tuple
+    position to their columns (see the module documentation).
+    """
+
+    def __init__(self, pool, offsets, columns):
+        self.pool = pool
+        self.offsets = offsets
+        self.columns = columns
+        self._keys = _Keys(pool, offsets)
+        self._cache = {}
+        self._order = None
+
+    @classmethod
+    def build(cls, items):
+        """Builds a table from (string, column) pairs"""
+        items = sorted((value.encode("utf-8"), j) for value, j in items)
+        lengths = numpy.array([len(key) for key, _ in items],
+                              dtype=numpy.int64)
+        offsets = numpy.zeros(len(items) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        # A trailing byte, so the pool is never empty (empty files can't be
+        # memory-mapped)
+        pool = numpy.frombuffer(b"".join(key for key, _ in items) + b"\0",
+                                dtype=numpy.uint8)
+        columns = numpy.array([j for _, j in items], dtype=numpy.int64)
+        return cls(pool, offsets, columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def key(self, k):
+        """The k-th string of the table, in sorted order"""
+        return self._keys[k].decode("utf-8")
+
+    def get(self, value, default=None):
+        try:
+            result = self._cache[value]
+        except KeyError:
+            key = value.encode("utf-8")
+            k = bisect_left(self._keys, key)
+            if k < len(self.columns) and self._keys[k] == key:
+                result = int(self.columns[k])
+            else:
+                result = None
+            if len(self._cache) >= LOOKUP_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[value] = result
+        return default if result is None else result
+
+    def value(self, column):
+        """The string of `column`, or None if it isn't in the table"""
+        if self._order is None:
+            self._order = numpy.argsort(self.columns, kind="stable")
+        n = numpy.searchsorted(self.columns, column, sorter=self._order)
+        if n < len(self.columns):
+            k = self._order[n]
+            if self.columns[k] == column:
+                return self.key(k)
+        return None
+
+    def items(self):
+        for k in range(len(self)):
+            yield self.key(k), int(self.columns[k])
+
+    def save(self, path, i):
+        for name, array in zip(TABLE_FILES,
+                               (self.pool, self.offsets, self.columns)):
+            numpy.save(os.path.join(path, name % i), array)
+
+    @classmethod
+    def load(cls, path, i, mmap=True):
+        mode = "r" if mmap else None
+        return cls(*[numpy.load(os.path.join(path, name % i), mmap_mode=mode)
+                     for name in TABLE_FILES])
+
+
+class MappedVocabulary(object):
+    """
+    Read only mapping from value to column for a tuple position, like the
+    vocabularies of a fitted flattener, made of a VocabularyTable for its
+    strings and a dictionary for the rest.
+    """
+
+    def __init__(self, table, extra):
+        self.table = table
+        self.extra = extra
+
+    def get(self, value, default=None):
+        if isinstance(value, str) and self.table is not None:
+            return self.table.get(value, default)
+        return self.extra.get(value, default)
+
+    def __getitem__(self, value):
+        result = self.get(value)
+        if result is None:
+            raise KeyError(value)
+        return result
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def __len__(self):
+        strings = len(self.table) if self.table is not None else 0
+        return strings + len(self.extra)
+
+    def items(self):
+        for item in self.extra.items():
+            yield item
+        if self.table is not None:
+            for item in self.table.items():
+                yield item
+
+    def __iter__(self):
+        for value, _ in self.items():
+            yield value
+
+    def value(self, column):
+        """The value of `column`, or None if it isn't in the vocabulary"""
+        for value, j in self.extra.items():
+            if j == column:
+                return value
+        if self.table is not None:
+            return self.table.value(column)
+        return None
+
+
+class Indexes(object):
+    """
+    Read only mapping from (tuple index, value) to column, like the
+    `indexes` of a fitted flattener. `vocabularies` maps each one-hot or bag
+    tuple position to the mapping from its values to their columns, and
+    `blocks` maps each numeric tuple position to a pair (first column, size),
+    where size is None for numbers and the length for number sequences.
+    """
+
+    def __init__(self, vocabularies, blocks):
+        self.vocabularies = vocabularies
+        self.blocks = blocks
+
+    def get(self, key, default=None):
+        i, value = key
+        vocabulary = self.vocabularies.get(i)
+        if vocabulary is not None:
+            return vocabulary.get(value, default)
+        if i in self.blocks:
+            base, size = self.blocks[i]
+            if size is None and value is None:
+                return base
+            if size is not None and isinstance(value, int) and \
+                    0 <= value < size:
+                return base + value
+        return default
+
+    def __getitem__(self, key):
+        result = self.get(key)
+        if result is None:
+            raise KeyError(key)
+        return result
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return (sum(len(v) for v in self.vocabularies.values()) +
+                sum(size or 1 for _, size in self.blocks.values()))
+
+    def items(self):
+        for i, (base, size) in self.blocks.items():
+            if size is None:
+                yield (i, None), base
+            else:
+                for k in range(size):
+                    yield (i, k), base + k
+        for i, vocabulary in self.vocabularies.items():
+            for value, j in vocabulary.items():
+                yield (i, value), j
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def reverse(self):
+        """
+        Returns the list of (tuple index, value) keys, by column. It holds
+        every value, even for memory-mapped vocabularies.
+        """
+        result = [None] * len(self)
+        for key, j in self.items():
+            result[j] = key
+        return result
+
+
+def save_vocabularies(vocabularies, path):
+    """
+    Saves the vocabularies of a flattener (a mapping from value to column
+    for each tuple position) in the directory `path`, with a VocabularyTable
+    for the strings of each tuple position
+    """
+    strings, extra = [], {}
+    for i, vocabulary in vocabularies.items():
+        items = []
+        extra[i] = {}
+        for value, j in vocabulary.items():
+            if isinstance(value, str):
+                items.append((value, j))
+            else:
+                extra[i][value] = j
+        if items:
+            VocabularyTable.build(items).save(path, i)
+            strings.append(i)
+    with open(os.path.join(path, EXTRA_FILE), "wb") as f:
+        pickle.dump((strings, extra), f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_vocabularies(path, mmap=True):
+    """
+    Loads the vocabularies saved in the directory `path` as a dictionary of
+    MappedVocabulary by tuple position, with the tables memory-mapped if
+    `mmap` is True
+    """
+    with open(os.path.join(path, EXTRA_FILE), "rb") as f:
+        strings, extra = pickle.load(f)
+    result = {}
+    for i, values in extra.items():
+        table = VocabularyTable.load(path, i, mmap) if i in strings else None
+        result[i] = MappedVocabulary(table, values)
+    return result
@@ -0,0 +1,180 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+
+from featureforge.cache import FeatureCache, feature_fingerprint
+from featureforge.evaluator import FeatureEvaluator, TolerantFeatureEvaluator
+from featureforge.feature import Feature, depends_on, make_feature
+
+
+def words(d):
+    return d["text"].split()
+
+
+def make_counter(calls, offset=0):
+    @make_feature
+    def count(d):
+        calls.append(d["pk"])
+        return len(d["text"]) + offset
+    return count
+
+
+class TestFingerprint(TestCase):
+
+    def test_changes_with_code(self):
+        f1 = make_feature(lambda d: d + 1)
+        f2 = make_feature(lambda d: d + 1)
+        f3 = make_feature(lambda d: d + 2)
+        self.assertEqual(feature_fingerprint(f1), feature_fingerprint(f2))
+        self.assertNotEqual(feature_fingerprint(f1), feature_fingerprint(f3))
+
+    def test_closures_and_dependencies(self):
+        self.assertNotEqual(feature_fingerprint(make_counter([], 0)),
+                            feature_fingerprint(make_counter([], 1)))
+
+        @depends_on(words)
+        def count(d, words):
+            return len(words)
+
+        def other_words(d):
+            return d["text"].split(",")
+
+        @depends_on(other_words)
+        def count2(d, words):
+            return len(words)
+        self.assertNotEqual(feature_fingerprint(make_feature(count)),
+                            feature_fingerprint(make_feature(count2)))
+
+    def test_globals(self):
+        source = (u"STOPWORDS = {stopwords}\n"
+                  u"def tokenize(text):\n"
+                  u"    return [w for w in text.{split} "
+                  u"if w not in STOPWORDS]\n"
+                  u"def feature(d):\n"
+                  u"    return len(tokenize(d))\n")
+
+        def fingerprint(stopwords=u"set(['a', 'the'])", split=u"split()"):
+            # Each call compiles the source as a new module would be
+            namespace = {}
+            exec(source.format(stopwords=stopwords, split=split), namespace)
+            return feature_fingerprint(make_feature(namespace["feature"]))
+        self.assertEqual(fingerprint(), fingerprint())
+        self.assertEqual(fingerprint(), fingerprint(u"set(['the', 'a'])"))
+        # Changing a global helper or constant invalidates the values
+        self.assertNotEqual(fingerprint(), fingerprint(u"set(['the'])"))
+        self.assertNotEqual(fingerprint(), fingerprint(split=u"split(',')"))
+
+    def test_version(self):
+        class Versioned(Feature):
+            version = 3
+
+            def _evaluate(self, d):
+                return d
+        self.assertEqual(feature_fingerprint(Versioned()), u"v3")
+
+
+class TestFeatureCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.db")
+        self.data = [{"pk": i, "text": u"x" * i} for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_and_set(self):
+        cache = FeatureCache(self.path)
+        self.assertIsNone(cache.get("f", 1))
+        cache.set("f", 1, [1, 2])
+        cache.set("f", "1", u"one")
+        self.assertEqual(cache.get("f", 1), [1, 2])
+        self.assertEqual(cache.get("f", "1"), u"one")
+        self.assertEqual(len(cache), 2)
+        cache.close()
+        # Values are persistent
+        self.assertEqual(FeatureCache(self.path).get("f", 1), [1, 2])
+
+    def test_least_recently_used_are_evicted(self):
+        cache = FeatureCache(self.path, max_entries=2)
+        cache.set("f", 1, 1)
+        cache.set("f", 2, 2)
+        cache.get("f", 1)
+        cache.set("f", 3, 3)
+        cache.flush()
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("f", 2))
+        self.assertEqual(cache.get("f", 1), 1)
+
+    def test_values_are_counted_when_opened(self):
+        cache = FeatureCache(self.path)
+        cache.set("f", 1, 1)
+        cache.close()
+        cache = FeatureCache(self.path, max_entries=2)
+        cache.set("f", 1, 2)  # Replaced, still a single value
+        cache.set("f", 2, 2)
+        statements = []
+        cache._connection.set_trace_callback(statements.append)
+        cache.flush()
+        self.assertFalse([s for s in statements if "COUNT" in s])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("f", 1), 2)
+        cache.set("f", 3, 3)
+        cache.flush()
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("f", 2))
+
+    def test_pickle(self):
+        cache = FeatureCache(self.path)
+        cache.set("f", 1, 1)
+        cache = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(cache.get("f", 1), 1)
+
+    def test_evaluator_uses_cache(self):
+        calls = []
+        feature = make_counter(calls)
+        ev = FeatureEvaluator([feature], cache=FeatureCache(self.path))
+        first = list(ev.fit_transform(self.data))
+        self.assertEqual(calls, list(range(5)))
+        # A new evaluator (as in a new run) loads the values
+        ev = FeatureEvaluator([feature], cache=FeatureCache(self.path))
+        ev.fit(self.data)
+        self.assertEqual(list(ev.transform(self.data)), first)
+        self.assertEqual(list(ev.transform_columns(self.data)),
+                         [(list(v for v, in first),)])
+        self.assertEqual(calls, list(range(5)))
+        self.assertEqual(ev.cache.hits, 10)
+        # Changing the feature invalidates its values
+        changed = make_counter(calls, offset=1)
+        ev = FeatureEvaluator([changed], cache=FeatureCache(self.path))
+        result = list(ev.fit_transform(self.data))
+        self.assertEqual(result, [(v + 1,) for v, in first])
+        self.assertEqual(calls, list(range(5)) * 2)
+
+    def test_data_points_without_key_are_not_cached(self):
+        calls = []
+
+        @make_feature
+        def length(d):
+            calls.append(d)
+            return len(d)
+        cache = FeatureCache(self.path)
+        for _ in range(2):
+            ev = FeatureEvaluator([length], cache=cache)
+            list(ev.fit_transform([u"a", u"bb"]))
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(cache), 0)
+
+    def test_failures_are_not_cached(self):
+        @make_feature
+        def inverse(d):
+            return 1.0 / d["pk"]
+        cache = FeatureCache(self.path)
+        ev = TolerantFeatureEvaluator([inverse, make_counter([])],
+                                      cache=cache)
+        ev.FEATURE_STRICT_UNTIL = 0
+        result = list(ev.fit_transform(self.data))
+        self.assertEqual(len(result), 4)
+        self.assertEqual(len(cache), 2 * 4)
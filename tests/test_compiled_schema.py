@@ -0,0 +1,111 @@
+import pickle
+from unittest import TestCase
+
+import schema
+from schema import And, Optional, Or, Schema, SchemaError, Use
+
+from featureforge.compiled_schema import CompiledSchema, compile_schema
+from featureforge.feature import ObjectSchema, soft_schema
+
+
+def positive(x):
+    return x > 0
+
+
+class Data(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+# Pairs of (schema, list of data points to validate with it)
+CASES = [
+    (int, [1, 1.5, "x", None, True]),
+    (object, [1, None, "x"]),
+    ("hello", ["hello", "bye", 3]),
+    (positive, [1, -1, "x"]),
+    (lambda x: x.upper(), ["a", "", 3]),
+    ([int], [[1, 2], [1, "x"], [], (1,), "x"]),
+    ((int, str), [(1, "a"), (1, None), [1]]),
+    ({"a": int, "b": str}, [{"a": 1, "b": "x"}, {"a": 1}, {"a": "x", "b": "x"},
+                            {"a": 1, "b": "x", "c": 3}, [], {}]),
+    ({"a": int, Optional(str): object}, [{"a": 1, "c": None}, {"c": None},
+                                         {"a": 1, 2: 3}, {"a": None}]),
+    ({str: int}, [{"x": 1, "y": 2}, {"x": "y"}, {1: 1}, {}]),
+    (And(int, positive), [1, -1, "x"]),
+    (And(int, positive, error="custom"), [1, -1, "x"]),
+    (Or(int, str), [1, "x", None]),
+    (Or(int, None, error="custom"), [1, None, "x"]),
+    (Use(float), [1, "1.5", "x", None]),
+    (Use(int, error="custom"), ["3", "x"]),
+    (Schema(int), [1, "x"]),
+    (Schema(int, error="custom"), [1, "x"]),
+    (Schema({"a": [Or(int, None)]}, error="outer"),
+     [{"a": [1, None]}, {"a": [1, "x"]}, {"b": []}]),
+    (ObjectSchema(a=int, b=str),
+     [Data(a=1, b="x"), Data(a=1), Data(a="x", b="x")]),
+]
+
+
+class TestCompiledSchemaEquivalence(TestCase):
+
+    def check_equivalent(self, s, data):
+        try:
+            expected = Schema(s).validate(data)
+        except SchemaError as e:
+            with self.assertRaises(SchemaError) as cm:
+                CompiledSchema(s).validate(data)
+            self.assertEqual(str(cm.exception), str(e))
+            self.assertEqual(cm.exception.code, e.code)
+        else:
+            result = CompiledSchema(s).validate(data)
+            self.assertEqual(result, expected)
+            self.assertEqual(type(result), type(expected))
+
+    def test_same_results_and_errors(self):
+        for s, data_points in CASES:
+            for data in data_points:
+                self.check_equivalent(s, data)
+
+    def test_nested_compiled_schemas(self):
+        for s, data_points in CASES:
+            for data in data_points:
+                self.check_equivalent(Schema(CompiledSchema(s)), data)
+                self.check_equivalent(And(CompiledSchema(s), object), data)
+
+    def test_compile_schema_with_error(self):
+        with self.assertRaises(SchemaError) as cm:
+            compile_schema(int, error="custom")("x")
+        self.assertEqual(cm.exception.code, "custom")
+
+    def test_dict_schemas_return_new_dicts(self):
+        data = {"a": 1}
+        result = CompiledSchema({"a": int}).validate(data)
+        self.assertEqual(result, data)
+        self.assertIsNot(result, data)
+
+
+class TestCompiledSchemaUsage(TestCase):
+
+    def test_soft_schema_is_compiled(self):
+        s = soft_schema(a=int, b={"c": str})
+        self.assertIsInstance(s, CompiledSchema)
+        s.validate({"a": 1, "b": {"c": "x", "d": 3}, "e": None})
+        with self.assertRaises(SchemaError):
+            s.validate({"a": 1, "b": {"c": 1}})
+
+    def test_pickle(self):
+        s = CompiledSchema({"a": And(int, Use(float))})
+        s2 = pickle.loads(pickle.dumps(s))
+        self.assertEqual(s2.validate({"a": 1}), {"a": 1.0})
+        with self.assertRaises(SchemaError):
+            s2.validate({"a": "x"})
+        o = pickle.loads(pickle.dumps(ObjectSchema(a=int)))
+        with self.assertRaises(SchemaError):
+            o.validate(Data(a="x"))
+
+    def test_schema_priority_is_respected(self):
+        # A key matching a literal is never tried with other key schemas
+        s = {"a": int, str: str}
+        self.assertEqual(CompiledSchema(s).validate({"a": 1, "b": "x"}),
+                         Schema(s).validate({"a": 1, "b": "x"}))
+        self.assertEqual(schema.priority("a"), 1)
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+import mock
+import numpy
+
+from featureforge.evaluator import (FeatureEvaluator,
+                                    TolerantFeatureEvaluator)
+from featureforge.feature import (
+    depends_on, input_schema, io_bound, is_io_bound, make_feature,
+    output_schema
+)
+from featureforge.vectorizer import Vectorizer
+
+DELAY = 0.05
+
+
+class Tracker(object):
+    # Counts the evaluations running at once
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def stop(self):
+        with self.lock:
+            self.running -= 1
+
+
+class TestConcurrentFeatures(TestCase):
+
+    def setUp(self):
+        self.tracker = tracker = Tracker()
+
+        @io_bound
+        @input_schema(int)
+        def slow_double(x):
+            tracker.start()
+            time.sleep(DELAY)
+            tracker.stop()
+            return 2 * x
+
+        @make_feature
+        @output_schema(int)
+        async def slow_square(x):
+            tracker.start()
+            await asyncio.sleep(DELAY)
+            tracker.stop()
+            return x * x
+        self.slow_double, self.slow_square = slow_double, slow_square
+
+    def test_features_are_io_bound(self):
+        self.assertTrue(is_io_bound(self.slow_double))
+        self.assertTrue(is_io_bound(self.slow_square))
+        self.assertFalse(is_io_bound(make_feature(len)))
+        # Coroutine features still work when called directly
+        self.assertEqual(self.slow_square(3), 9)
+
+    def test_threaded_evaluation(self):
+        ev = FeatureEvaluator([self.slow_double, make_feature(str)],
+                              concurrency=4)
+        ev.fit([])
+        data = list(range(8))
+        threads = threading.active_count()
+        start = time.time()
+        result = list(ev.transform(data))
+        self.assertLess(time.time() - start, len(data) * DELAY / 2)
+        self.assertEqual(result, [(2 * x, str(x)) for x in data])
+        self.assertEqual(self.tracker.max_running, 4)
+        # The threads are gone once the result is consumed
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_threaded_shared_computations(self):
+        calls = []
+
+        def digits(x):
+            calls.append(x)
+            return str(x)
+
+        @depends_on(digits)
+        def count(x, digits):
+            return len(digits)
+
+        @io_bound
+        @depends_on(digits, count)
+        def first(x, digits, count):
+            return digits[0] * count
+
+        ev = FeatureEvaluator([first], concurrency=4)
+        ev.fit([])
+        self.assertEqual(list(ev.transform([5, 12])), [(u"5",), (u"11",)])
+        self.assertEqual(sorted(calls), [5, 12])
+
+    def test_awaited_evaluation(self):
+        ev = FeatureEvaluator([self.slow_square, self.slow_double],
+                              concurrency=5, chunk_size=7)
+        ev.fit([])
+        data = list(range(10))
+        start = time.time()
+        self.assertEqual(list(ev.transform(data)),
+                         [(x * x, 2 * x) for x in data])
+        self.assertLess(time.time() - start, len(data) * DELAY / 2)
+        self.assertLessEqual(self.tracker.max_running, 10)
+
+    def test_validation(self):
+        ev = FeatureEvaluator([self.slow_double])
+        ev.fit([])
+        with self.assertRaises(self.slow_double.InputValueError):
+            list(ev.transform([1, u"2"]))
+        ev = FeatureEvaluator([self.slow_square])
+        ev.fit([])
+        with self.assertRaises(self.slow_square.OutputValueError):
+            list(ev.transform([1, 1.5]))
+        # Without validation the values are kept as they are
+        ev = FeatureEvaluator([self.slow_square], validation="never")
+        ev.fit([])
+        self.assertEqual(list(ev.transform([1.5])), [(2.25,)])
+
+    def test_event_loop_is_reused(self):
+        ev = TolerantFeatureEvaluator([self.slow_square])
+        data = list(range(4))
+        with mock.patch("asyncio.new_event_loop",
+                        side_effect=asyncio.new_event_loop) as new_event_loop:
+            self.assertEqual(list(ev.fit_transform(data)),
+                             [(x * x,) for x in data])
+            self.assertEqual(new_event_loop.call_count, 1)
+            list(ev.transform(data))
+            self.assertEqual(new_event_loop.call_count, 2)
+
+    def test_vectorizer(self):
+        v = Vectorizer([self.slow_double, self.slow_square], sparse=False)
+        v.fit([1, 2])
+        self.assertTrue(numpy.array_equal(v.transform([1, 2, 3]),
+                                          [[2, 1], [4, 4], [6, 9]]))
+
+    def test_profiling(self):
+        ev = FeatureEvaluator([self.slow_square, self.slow_double],
+                              concurrency=4, chunk_size=5, profile=True)
+        data = list(range(6))
+        list(ev.fit_transform(data))
+        list(ev.transform(data))
+        report = ev.profile_report()
+        for name in ["slow_square", "slow_double"]:
+            self.assertEqual(report[name]["calls"], 2 * len(data))
+            self.assertEqual(report[name]["errors"], 0)
+            self.assertGreaterEqual(report[name]["evaluate_time"],
+                                    2 * len(data) * DELAY * 0.9)
+        ev = FeatureEvaluator([self.slow_square], profile=True)
+        ev.fit([])
+        with self.assertRaises(self.slow_square.OutputValueError):
+            list(ev.transform([1.5]))
+        with self.assertRaises(TypeError):
+            list(ev.transform([u"2"]))
+        self.assertEqual(ev.profile_report()["slow_square"]["errors"], 2)
@@ -4,7 +4,8 @@ import schema
 
 from featureforge.feature import (
     Feature, ObjectSchema, make_feature, input_schema, output_schema,
-    feature_name
+    feature_name, batch_feature, is_batch_feature, depends_on,
+    has_dependencies, memoize_shared, shared
 )
 
 
@@ -126,6 +127,157 @@ class TestFeatureBuilding(TestCase):
         self.assertEqual(f({'key': 42, 'another': 37}), 42)
 
 
+class TestBatchFeature(TestCase):
+
+    def test_batch_feature_basic(self):
+        calls = []
+
+        @input_schema(str)
+        @output_schema(int)
+        def lengths(data_points):
+            calls.append(list(data_points))
+            return [len(d) for d in data_points]
+        f = batch_feature(lengths)
+
+        self.assertIsInstance(f, Feature)
+        self.assertTrue(is_batch_feature(f))
+        self.assertEqual(f.name, "lengths")
+        # The whole batch is evaluated with a single call
+        self.assertEqual(f.evaluate_batch(["a", "bb", ""]), [1, 2, 0])
+        self.assertEqual(calls, [["a", "bb", ""]])
+        # It's still usable as a regular feature
+        self.assertEqual(f("xyz"), 3)
+
+    def test_batch_feature_validation(self):
+        @input_schema(str)
+        @output_schema(int)
+        def bad_output(data_points):
+            return ["x" for d in data_points]
+        f = batch_feature(bad_output)
+        with self.assertRaises(f.InputValueError):
+            f.evaluate_batch(["a", 1])
+        with self.assertRaises(f.OutputValueError):
+            f.evaluate_batch(["a"])
+
+        def wrong_length(data_points):
+            return []
+        f = batch_feature(wrong_length)
+        with self.assertRaises(f.OutputValueError):
+            f.evaluate_batch(["a"])
+
+    def test_evaluate_batch_without_batch_support(self):
+        f = make_feature(lambda d: d * 2)
+        self.assertFalse(is_batch_feature(f))
+        self.assertEqual(f.evaluate_batch([1, 2]), [2, 4])
+
+
+class TestSharedComputations(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def tokens(data_point):
+            self.calls.append(data_point)
+            return data_point.split()
+        self.tokens = shared(tokens)
+
+        @make_feature
+        @input_schema(str)
+        @depends_on(self.tokens)
+        def count(data_point, tokens):
+            return len(tokens)
+
+        @make_feature
+        @depends_on(tokens)  # Plain functions are shared too
+        @output_schema(str)
+        def first(data_point, tokens):
+            return tokens[0]
+        self.count, self.first = count, first
+
+    def test_dependencies_are_arguments(self):
+        self.assertEqual(self.count("a b c"), 3)
+        self.assertEqual(self.first("a b c"), "a")
+        self.assertEqual(self.count.name, "count")
+        self.assertTrue(has_dependencies(self.count))
+        self.assertFalse(has_dependencies(make_feature(len)))
+        # Decorators used in any order keep working
+        with self.assertRaises(self.count.InputValueError):
+            self.count(1)
+
+    def test_not_memoized_outside_scope(self):
+        self.count("a b")
+        self.first("a b")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_memoized_once_per_data_point(self):
+        for d in ["a b", "c d e"]:
+            with memoize_shared(d):
+                self.assertEqual(self.count(d), len(d.split()))
+                self.assertEqual(self.first(d), d[0])
+        self.assertEqual(self.calls, ["a b", "c d e"])
+        # Values are forgotten when leaving the scope
+        with memoize_shared("c d e"):
+            self.count("c d e")
+        self.assertEqual(len(self.calls), 3)
+
+    def test_memoized_with_validated_copies(self):
+        # Dictionary schemas validate into a new dictionary for each feature
+        def tokens(data_point):
+            self.calls.append(data_point)
+            return data_point['text'].split()
+
+        @make_feature
+        @input_schema({'text': str})
+        @depends_on(tokens)
+        def count(data_point, tokens):
+            return len(tokens)
+
+        @make_feature
+        @input_schema({'text': str})
+        @depends_on(tokens)
+        def first(data_point, tokens):
+            return tokens[0]
+        for d in [{'text': "a b"}, {'text': "c d e"}]:
+            with memoize_shared(d):
+                self.assertEqual(count(d), len(d['text'].split()))
+                self.assertEqual(first(d), d['text'][0])
+        self.assertEqual(self.calls, [{'text': "a b"}, {'text': "c d e"}])
+
+    def test_nested_scopes(self):
+        with memoize_shared("a b"):
+            self.count("a b")
+            with memoize_shared("a b"):
+                self.first("a b")
+            with memoize_shared("c d e"):
+                self.assertEqual(self.count("c d e"), 3)
+            self.assertEqual(self.count("a b"), 2)
+        self.assertEqual(self.calls, ["a b", "c d e"])
+
+    def test_memoized_by_argument(self):
+        @make_feature
+        def words(d):
+            return len(self.tokens(d["title"])) + len(self.tokens(d["body"]))
+        d = {"title": "a b", "body": "c d e"}
+        with memoize_shared(d):
+            self.assertEqual(words(d), 5)
+            self.assertEqual(words(d), 5)
+        self.assertEqual(self.calls, ["a b", "c d e"])
+
+    def test_nested_dependencies(self):
+        @depends_on(self.tokens)
+        def lengths(data_point, tokens):
+            return [len(t) for t in tokens]
+
+        @make_feature
+        @depends_on(self.tokens, lengths)
+        def longest(data_point, tokens, lengths):
+            return tokens[lengths.index(max(lengths))]
+        with memoize_shared("a bbb cc"):
+            self.assertEqual(longest("a bbb cc"), "bbb")
+            self.assertEqual(self.count("a bbb cc"), 3)
+        self.assertEqual(self.calls, ["a bbb cc"])
+
+
 class TestObjectSchema(TestCase):
 
     def setUp(self):
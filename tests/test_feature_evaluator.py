@@ -1,10 +1,14 @@
 from future.builtins import str
 import mock
+import multiprocessing
+import pickle
 import types
 from unittest import TestCase
 
 from featureforge.evaluator import FeatureEvaluator, TolerantFeatureEvaluator
-from featureforge.feature import make_feature, input_schema, output_schema
+from featureforge.feature import (
+    batch_feature, depends_on, make_feature, input_schema, output_schema
+)
 
 
 @make_feature
@@ -42,6 +46,12 @@ def BrokenFeature(data_point):
     raise RuntimeError()
 
 
+@batch_feature
+@input_schema({'description': str})
+def DescriptionLengthFeature(data_points):
+    return [len(d['description']) for d in data_points]
+
+
 SAMPLES = [
     {'pk': 1, 'description': u'nice'},
     {'pk': 2, 'description': u'awesome moment with friends'},
@@ -87,6 +97,230 @@ class SimpleEvaluatorTests(TestCase):
         self.assertListEqual(list(Xt_1), list(Xt_2))
 
 
+class ValidationPolicyEvaluatorTests(TestCase):
+
+    def test_never_skips_feature_validation(self):
+        ev = FeatureEvaluator([AgeFeature], validation='never')
+        # AgeFeature output schema is str, but it returns ints
+        result = list(ev.fit_transform([{'age': 3}]))
+        self.assertEqual(result, [(3,)])
+        self.assertEqual(ev.policy.skipped, 1)
+        self.assertEqual(ev.policy.validated, 0)
+
+    def test_fit_only_validates_only_when_fitting(self):
+        ev = FeatureEvaluator([AgeFeature], validation='fit_only')
+        with self.assertRaises(ValueError):
+            list(ev.fit_transform([{'age': 3}]))
+        self.assertEqual(list(ev.transform([{'age': 3}])), [(3,)])
+
+    def test_tolerant_fit_uses_policy(self):
+        ev = TolerantFeatureEvaluator([AgeFeature, DumbFeatureA],
+                                      validation='never')
+        ev.fit([{'age': 3}])
+        # AgeFeature would have been excluded when validating its output
+        self.assertIn(AgeFeature, ev.alive_features)
+        self.assertEqual(ev.policy.skipped, 2)
+
+
+class BatchEvaluatorTests(TestCase):
+
+    def test_batch_features_are_evaluated_by_chunks(self):
+        calls = []
+
+        @batch_feature
+        def batch(data_points):
+            calls.append(len(data_points))
+            return DescriptionLengthFeature.evaluate_batch(data_points)
+        ev = FeatureEvaluator([DescriptionFeature, batch], chunk_size=2)
+        ev.fit(SAMPLES)
+        result = list(ev.transform(SAMPLES))
+        expected = [(s['description'], len(s['description']))
+                    for s in SAMPLES]
+        self.assertListEqual(result, expected)
+        self.assertEqual(calls, [2, 2, 1])
+
+    def test_transform_columns(self):
+        ev = FeatureEvaluator([DescriptionFeature, DescriptionLengthFeature],
+                              chunk_size=3)
+        ev.fit(SAMPLES)
+        chunks = list(ev.transform_columns(SAMPLES))
+        self.assertEqual(len(chunks), 2)
+        descriptions, lengths = chunks[0]
+        self.assertEqual(list(descriptions),
+                         [s['description'] for s in SAMPLES[:3]])
+        self.assertEqual(list(lengths),
+                         [len(s['description']) for s in SAMPLES[:3]])
+
+
+class SharedComputationEvaluatorTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def words(data_point):
+            self.calls.append(data_point['pk'])
+            return data_point['description'].split()
+
+        # Dictionary schemas validate into a new dictionary for each feature
+        @make_feature
+        @input_schema({'description': str})
+        @depends_on(words)
+        def first_word(data_point, words):
+            return words[0] if words else u''
+
+        @make_feature
+        @input_schema({'description': str})
+        @depends_on(words)
+        def word_count(data_point, words):
+            return len(words)
+        self.features = [first_word, word_count, DescriptionFeature]
+        self.samples = [dict(s, pk=i) for i, s in enumerate(SAMPLES)]
+        self.expected = [
+            ((s['description'].split() or [u''])[0],
+             len(s['description'].split()), s['description'])
+            for s in self.samples]
+
+    def test_shared_computation_once_per_data_point(self):
+        ev = FeatureEvaluator(self.features)
+        ev.fit(self.samples)
+        self.assertListEqual(list(ev.transform(self.samples)), self.expected)
+        self.assertEqual(self.calls, list(range(len(self.samples))))
+
+    def test_shared_computation_by_columns(self):
+        ev = FeatureEvaluator(self.features, chunk_size=3)
+        ev.fit(self.samples)
+        columns = list(ev.transform_columns(self.samples))
+        self.assertEqual(list(zip(*columns[0])), self.expected[:3])
+        self.assertEqual(self.calls, list(range(len(self.samples))))
+
+    def test_shared_computation_with_batch_features(self):
+        ev = FeatureEvaluator(self.features + [DescriptionLengthFeature],
+                              chunk_size=3)
+        ev.fit(self.samples)
+        result = [r[:3] for r in ev.transform(self.samples)]
+        self.assertListEqual(result, self.expected)
+        self.assertEqual(self.calls, list(range(len(self.samples))))
+
+    def test_tolerant_shared_computation(self):
+        ev = TolerantFeatureEvaluator(self.features)
+        result = list(ev.fit_transform(self.samples))
+        self.assertListEqual(result, self.expected)
+        self.assertEqual(self.calls, list(range(len(self.samples))))
+
+    def test_reused_data_point_object(self):
+        # Sources may modify the same dictionary for each data point
+        def reusing(samples):
+            buf = {}
+            for s in samples:
+                buf.clear()
+                buf.update(s)
+                yield buf
+
+        ev = FeatureEvaluator(self.features)
+        ev.fit(self.samples)
+        result = [tuple(r) for r in ev.transform(reusing(self.samples))]
+        self.assertListEqual(result, self.expected)
+        # Evaluated by columns, data points are kept until their chunk ends
+        ev = FeatureEvaluator(self.features, chunk_size=1)
+        ev.fit(self.samples)
+        columns = ev.transform_columns(reusing(self.samples))
+        rows = [r for c in columns for r in zip(*c)]
+        self.assertListEqual(rows, self.expected)
+        ev = TolerantFeatureEvaluator(self.features)
+        result = list(ev.fit_transform(reusing(self.samples)))
+        self.assertListEqual(result, self.expected)
+        result = list(ev.transform(reusing(self.samples)))
+        self.assertListEqual(result, self.expected)
+
+
+class ParallelEvaluatorTests(TestCase):
+
+    def test_parallel_transform_preserves_order(self):
+        samples = SAMPLES * 7
+        ev = FeatureEvaluator([DescriptionFeature, EntireSampleFeature],
+                              n_jobs=2, chunk_size=3)
+        ev.fit(samples)
+        Xt = ev.transform(samples)
+        self.assertIsInstance(Xt, types.GeneratorType)
+        expected = [(s['description'], s) for s in samples]
+        self.assertListEqual(list(Xt), expected)
+
+    def test_pool_is_reused(self):
+        samples = SAMPLES * 3
+        ev = FeatureEvaluator([DescriptionFeature], n_jobs=2, chunk_size=3)
+        ev.fit(samples)
+        expected = [(s['description'],) for s in samples]
+        with mock.patch('multiprocessing.Pool',
+                        side_effect=multiprocessing.Pool) as Pool:
+            self.assertListEqual(list(ev.transform(samples)), expected)
+            self.assertListEqual(list(ev.transform(samples)), expected)
+            self.assertListEqual(
+                [r for c in ev.transform_columns(samples) for r in zip(*c)],
+                expected)
+            self.assertEqual(Pool.call_count, 1)
+            # A pool whose chunks were abandoned isn't reused
+            Xt = ev.transform(samples)
+            next(Xt)
+            Xt.close()
+            self.assertListEqual(list(ev.transform(samples)), expected)
+            self.assertEqual(Pool.call_count, 2)
+        ev.close()
+        self.assertIsNone(ev._workers.pool)
+        # Pickled without its pool
+        ev = FeatureEvaluator([make_feature(len)], n_jobs=2)
+        ev.fit([])
+        self.assertEqual(list(ev.transform([u"ab"])), [(2,)])
+        copy = pickle.loads(pickle.dumps(ev))
+        self.assertIsNone(copy._workers.pool)
+        self.assertEqual(list(copy.transform([u"abc"])), [(3,)])
+        copy.close()
+        ev.close()
+
+    def test_parallel_transform_raises_feature_errors(self):
+        ev = FeatureEvaluator([BrokenFeature], n_jobs=2, chunk_size=2)
+        ev.fit(SAMPLES)
+        with self.assertRaises(RuntimeError):
+            list(ev.transform(SAMPLES))
+
+    def test_invalid_n_jobs(self):
+        ev = FeatureEvaluator([DumbFeatureA], n_jobs=0)
+        ev.fit(SAMPLES)
+        with self.assertRaises(ValueError):
+            list(ev.transform(SAMPLES))
+
+
+class ProfilingEvaluatorTests(TestCase):
+
+    def test_profile_report(self):
+        ev = FeatureEvaluator([DescriptionFeature, DescriptionLengthFeature],
+                              profile=True)
+        list(ev.fit_transform(SAMPLES))
+        list(ev.transform(SAMPLES))
+        report = ev.profile_report()
+        self.assertEqual(list(report),
+                         ['DescriptionFeature', 'DescriptionLengthFeature'])
+        for stats in report.values():
+            self.assertEqual(stats['calls'], 2 * len(SAMPLES))
+            self.assertEqual(stats['errors'], 0)
+        self.assertIn('DescriptionFeature', ev.profile_report(table=True))
+
+    def test_errors_are_counted(self):
+        ev = TolerantFeatureEvaluator([DescriptionFeature, AgeFeature],
+                                      profile=True)
+        list(ev.fit_transform(SAMPLES))
+        report = ev.profile_report()
+        self.assertEqual(report['AgeFeature']['errors'], 1)
+        self.assertEqual(report['DescriptionFeature']['errors'], 0)
+        self.assertEqual(report['DescriptionFeature']['calls'], len(SAMPLES))
+
+    def test_profiling_disabled(self):
+        ev = FeatureEvaluator([DescriptionFeature])
+        ev.fit(SAMPLES)
+        self.assertIsNone(ev.profiler)
+        self.assertEqual(ev.feature_functions(), (DescriptionFeature,))
+        self.assertRaises(ValueError, ev.profile_report)
+
+
 class TolerantFittingCases(object):
     fit_method_name = ''
 
@@ -228,6 +462,24 @@ class TolerantEvaluatorFitTransformTests(TestCase, TolerantFittingCases):
         # EntireSampleFeature is the last, so is the last value per tuple
         self.assertIn(nodescription, [r[-1] for r in result])
 
+    def test_retried_samples_are_not_evaluated_again(self):
+        # Features that evaluated fine with a sample before it failed are
+        # not evaluated again when the sample is retried
+        description = mock.Mock(wraps=DescriptionFeature,
+                                spec=DescriptionFeature)
+        self.ev = TolerantFeatureEvaluator([description, AgeFeature,
+                                            EntireSampleFeature])
+        self.ev.FEATURE_STRICT_UNTIL = 0
+        self.ev.FEATURE_MAX_ERRORS_ALLOWED = 1
+        result = list(self.ev.fit_transform(SAMPLES))
+        self.assertEqual(self.ev.alive_features,
+                         (description, EntireSampleFeature))
+        self.assertEqual(description.call_count, len(SAMPLES))
+        # Samples that failed are at the end, after being retried
+        self.assertEqual(sorted(r[1]['pk'] for r in result),
+                         [s['pk'] for s in SAMPLES])
+        self.assertEqual([r[1]['pk'] for r in result][-2:], [1, 2])
+
     def test_consumable_is_consumed_only_once(self):
         samples = (s for s in SAMPLES)  # can be consumed once only
         self.ev = TolerantFeatureEvaluator([EntireSampleFeature])
@@ -235,6 +487,21 @@ class TolerantEvaluatorFitTransformTests(TestCase, TolerantFittingCases):
         self.assertEqual(len(SAMPLES), len(result))
 
 
+class TolerantEvaluatorPartialFitTests(TestCase):
+
+    def test_later_calls_discard_failing_samples(self):
+        self.ev = TolerantFeatureEvaluator([DescriptionFeature, DumbFeatureA])
+        result = list(self.ev.partial_fit_transform(SAMPLES))
+        self.assertEqual(len(result), len(SAMPLES))
+        bad = {'pk': 'bad'}
+        result = list(self.ev.partial_fit_transform([bad] + SAMPLES))
+        self.assertEqual(len(result), len(SAMPLES))
+        # Features are not excluded any more
+        self.assertEqual(self.ev.alive_features,
+                         (DescriptionFeature, DumbFeatureA))
+        self.assertIn('bad', self.ev._fit_failure_stats['discarded_samples'])
+
+
 class TolerantEvaluatorTransformTests(TestCase):
 
     def test_errors_are_raised(self):
@@ -244,3 +511,31 @@ class TolerantEvaluatorTransformTests(TestCase):
         def transform():
             list(self.ev.transform(SAMPLES))  # force generation
         self.assertRaises(RuntimeError, transform)
+
+    def test_skip_failing_samples(self):
+        self.ev = TolerantFeatureEvaluator([DumbFeatureA, DescriptionFeature],
+                                           on_transform_error='skip')
+        self.ev.fit(SAMPLES)
+        samples = SAMPLES[:2] + [{'pk': 'bad'}] + SAMPLES[2:]
+        result = list(self.ev.transform(samples))
+        self.assertEqual(result, [(u'a', s['description']) for s in SAMPLES])
+        self.assertEqual(self.ev.transform_rows, [0, 1, 3, 4, 5])
+        [(i, feature, error)] = self.ev.transform_failures
+        self.assertEqual((i, feature), (2, DescriptionFeature))
+        self.assertIsInstance(error, ValueError)
+
+    def test_fill_failing_values(self):
+        self.ev = TolerantFeatureEvaluator(
+            [DescriptionFeature, DumbFeatureA], on_transform_error='fill',
+            fill_value={DescriptionFeature: u'missing'})
+        self.ev.fit(SAMPLES)
+        result = list(self.ev.transform([{'pk': 'bad'}] + SAMPLES[:1]))
+        self.assertEqual(result, [(u'missing', u'a'), (u'nice', u'a')])
+        self.assertEqual(self.ev.transform_rows, [0, 1])
+        self.assertEqual(len(self.ev.transform_failures), 1)
+        result = self.ev.transform([{'pk': 'bad'}], fill_value=u'other')
+        self.assertEqual(list(result), [(u'other', u'a')])
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, TolerantFeatureEvaluator, [DumbFeatureA],
+                          on_transform_error='ignore')
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 from collections import Counter
+from operator import itemgetter
+import multiprocessing
+import os
+import pickle
 import random
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from future.builtins import range, str
+import mock
 
 import numpy
 import scipy
+from schema import Schema, Use
 
+from featureforge import flattener
 from featureforge.flattener import FeatureMappingFlattener
 
 
@@ -208,6 +219,93 @@ class TestFeatureMappingFlattener(unittest.TestCase):
             self.assertEqual(A.indexes, B.indexes)
             self.assertEqual(A.reverse, B.reverse)
 
+    def test_dense_fit_transform_with_growing_vocabulary(self):
+        # Every row adds new columns, so early rows are shorter than the
+        # final width of the matrix
+        X = [(float(i), u"value %d" % i, [u"w%d" % i, u"w%d" % (i // 2)])
+             for i in range(50)]
+        A = FeatureMappingFlattener(sparse=False)
+        YA = A.fit_transform(X)
+        B = FeatureMappingFlattener(sparse=False)
+        B.fit(X)
+        self.assertEqual(YA.shape, (50, 1 + 50 + 50))
+        self.assertTrue(numpy.array_equal(YA, B.transform(X)))
+
+    def test_partial_fit(self):
+        X1 = [(1.0, u"a", [u"x"]), (2.0, u"b", [u"y", u"x"])]
+        X2 = [(3.0, u"c", [u"x", u"z"]), (4.0, u"a", [])]
+        for sparse in [True, False]:
+            A = FeatureMappingFlattener(sparse=sparse)
+            A.partial_fit(X1)
+            old_reverse = list(A.reverse)
+            A.partial_fit(iter(X2))
+            # Old columns are kept, new ones appended
+            self.assertEqual(A.reverse[:len(old_reverse)], old_reverse)
+            self.assertEqual(A.reverse[len(old_reverse):],
+                             [(1, u"c"), (2, u"z")])
+            # Same vocabulary than fitting everything at once
+            B = FeatureMappingFlattener(sparse=sparse)
+            B.fit(X1 + X2)
+            self.assertEqual(A.indexes, B.indexes)
+
+    def test_vocabularies_by_tuple_position(self):
+        X = [(1.0, u"a", [u"x"], [1, 2]), (2.0, u"b", [u"y", u"x"], [3, 4])]
+        V = FeatureMappingFlattener()
+        V.fit(X)
+        self.assertEqual(V.bases, {0: 0, 3: 1})
+        self.assertEqual(V.vocabularies, {1: {u"a": 3, u"b": 5},
+                                          2: {u"x": 4, u"y": 6}})
+        self.assertEqual(list(V.column_positions), [0, 3, 3, 1, 2, 1, 2])
+        self.assertEqual(V.reverse, [(0, None), (3, 0), (3, 1), (1, u"a"),
+                                     (2, u"x"), (1, u"b"), (2, u"y")])
+        self.assertEqual(V.indexes, dict((key, j) for j, key in
+                                         enumerate(V.reverse)))
+
+    def test_unpickle_single_dictionary_state(self):
+        # State of a flattener fitted by the first versions, with a single
+        # dictionary as vocabulary and none of the later options
+        X = [(1.0, u"a", [u"x"], [1, 2]), (2.0, u"b", [u"y", u"x"], [3, 4])]
+        reverse = [(0, None), (3, 0), (3, 1), (1, u"a"), (2, u"x"),
+                   (1, u"b"), (2, u"y")]
+        schema = (Use(float), str, flattener.BagValidator([u"x"]),
+                  flattener.NumberSequenceValidator([1, 2]))
+        validator = flattener.TupleValidator(schema)
+        validator.tt = tuple(map(Schema, schema))
+        state = {
+            "sparse": True,
+            "indexes": dict((key, j) for j, key in enumerate(reverse)),
+            "reverse": reverse,
+            "schema": schema,
+            "str_tuple_indexes": [1],
+            "bag_indexes": [2],
+            "validator": validator,
+        }
+        W = FeatureMappingFlattener.__new__(FeatureMappingFlattener)
+        W.__setstate__(state)
+        V = FeatureMappingFlattener()
+        V.fit(X)
+        self.assertEqual(W.vocabularies, V.vocabularies)
+        self.assertEqual(W.bases, V.bases)
+        self.assertEqual(W.n_columns, V.n_columns)
+        for sparse in ["csr", False]:
+            W.sparse = V.sparse = sparse
+            A, B = W.transform(X), V.transform(X)
+            if sparse:
+                A, B = A.toarray(), B.toarray()
+            self.assertTrue(numpy.array_equal(A, B))
+        W.partial_fit([(3.0, u"c", [u"z"], [5, 6])])
+        self.assertEqual(W.reverse, reverse + [(1, u"c"), (2, u"z")])
+
+    def test_partial_fit_validates_with_fitted_schema(self):
+        V = FeatureMappingFlattener()
+        V.partial_fit([(1.0, u"a")])
+        self.assertRaises(ValueError, V.partial_fit, [(u"b", u"a")])
+        self.assertRaises(ValueError, V.partial_fit, [(1.0, u"a", 3)])
+        self.assertRaises(ValueError, FeatureMappingFlattener().partial_fit,
+                          [])
+        V = FeatureMappingFlattener(min_count=2)
+        self.assertRaises(ValueError, V.partial_fit, [(1.0, u"a")])
+
     def test_fit_transform_consumes_data_only_once(self):
         random.seed("a kiss to build a dream on")
         X = list(self._get_random_tuples())
@@ -232,6 +330,144 @@ class TestFeatureMappingFlattener(unittest.TestCase):
 
         self.assertTrue(numpy.array_equal(YA, YB))
 
+    def test_transform_columns_is_equivalent(self):
+        random.seed("columns and rows")
+        X = list(self._get_random_tuples())
+        chunks = [list(zip(*X[i:i + 30])) for i in range(0, len(X), 30)]
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            V.fit(X)
+            A = V.transform(X)
+            B = V.transform_columns(chunks)
+            if sparse:
+                self.assertIsInstance(B, scipy.sparse.csr_matrix)
+                A, B = A.todense(), B.todense()
+            self.assertTrue(numpy.array_equal(A, B))
+            self.assertEqual(V.transform_columns([]).shape,
+                             (0, len(V.indexes)))
+
+    def test_transform_chunks_is_equivalent(self):
+        random.seed("chunks")
+        X = list(self._get_random_tuples())
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            V.fit(X)
+            A = V.transform(X)
+            blocks = list(V.transform_chunks(iter(X), 30))
+            self.assertEqual([b.shape[0] for b in blocks[:-1]],
+                             [30] * (len(blocks) - 1))
+            self.assertTrue(0 < blocks[-1].shape[0] <= 30)
+            if sparse:
+                self.assertIsInstance(blocks[0], scipy.sparse.csr_matrix)
+                A = A.todense()
+                B = scipy.sparse.vstack(blocks).todense()
+            else:
+                B = numpy.vstack(blocks)
+            self.assertTrue(numpy.array_equal(A, B))
+            self.assertEqual(list(V.transform_chunks([], 30)), [])
+        self.assertRaises(ValueError, V.transform_chunks, X, 0)
+
+    def test_transform_chunks_is_lazy(self):
+        V = FeatureMappingFlattener()
+        V.fit([(1.0, u"a")])
+        consumed = []
+
+        def data():
+            for i in range(10):
+                consumed.append(i)
+                yield (float(i), u"a")
+
+        blocks = V.transform_chunks(data(), 4)
+        self.assertEqual(next(blocks).shape, (4, 2))
+        self.assertEqual(len(consumed), 4)
+        self.assertEqual([b.shape[0] for b in blocks], [4, 2])
+
+    def test_transform_to_disk(self):
+        random.seed("disk")
+        X = list(self._get_random_tuples())
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            V.fit(X)
+            A = V.transform(X)
+            B = V.transform_to_disk(iter(X), path, chunk_size=7)
+            self.assertEqual(A.shape, B.shape)
+            if sparse:
+                A, B = A.todense(), B.todense()
+            self.assertTrue(numpy.array_equal(A, B))
+        for sparse in ["csc", "coo"]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            V.fit(X)
+            self.assertRaises(ValueError, V.transform_to_disk, iter(X), path)
+
+    def test_transform_columns_bad_values(self):
+        random.seed("columns and rows")
+        X = list(self._get_random_tuples())
+        V = FeatureMappingFlattener()
+        V.fit(X)
+        columns = list(zip(*X))
+        self.assertRaises(ValueError, V.transform_columns, [columns[:-1]])
+        bad = [columns[0][:-1]] + columns[1:]
+        self.assertRaises(ValueError, V.transform_columns, [bad])
+        bad = [[u"a"] * len(X)] + columns[1:]
+        self.assertRaises(ValueError, V.transform_columns, [bad])
+
+    def test_dense_transform_of_unknown_length(self):
+        random.seed("grow")
+        X = list(self._get_random_tuples())
+        V = FeatureMappingFlattener(sparse=False)
+        V.fit(X)
+        expected = V.transform(X)
+        old_initial_rows = flattener.DENSE_INITIAL_ROWS
+        flattener.DENSE_INITIAL_ROWS = 7
+        try:
+            Z = V.transform(x for x in X)
+        finally:
+            flattener.DENSE_INITIAL_ROWS = old_initial_rows
+        self.assertEqual(Z.shape, expected.shape)
+        self.assertTrue(numpy.array_equal(Z, expected))
+
+    def test_dense_transform_into_out(self):
+        random.seed("in place")
+        X = list(self._get_random_tuples())
+        V = FeatureMappingFlattener(sparse=False)
+        V.fit(X)
+        expected = V.transform(X)
+        out = numpy.empty((len(X) + 3, len(V.indexes)))
+        out.fill(numpy.nan)
+        Z = V.transform(X, out=out)
+        self.assertTrue(numpy.array_equal(Z, expected))
+        self.assertTrue(numpy.array_equal(out[:len(X)], expected))
+        self.assertTrue(numpy.isnan(out[len(X):]).all())
+        # out is too small
+        out = numpy.zeros((len(X) - 1, len(V.indexes)))
+        self.assertRaises(ValueError, V.transform, X, out=out)
+        # out has the wrong amount of columns
+        out = numpy.zeros((len(X), len(V.indexes) + 1))
+        self.assertRaises(ValueError, V.transform, X, out=out)
+        # out is not supported on sparse results
+        V.sparse = True
+        out = numpy.zeros((len(X), len(V.indexes)))
+        self.assertRaises(ValueError, V.transform, X, out=out)
+
+    def test_transform_without_validation(self):
+        random.seed("trust me")
+        X = list(self._get_random_tuples())
+        for sparse in [True, False]:
+            A = FeatureMappingFlattener(sparse=sparse)
+            B = FeatureMappingFlattener(sparse=sparse, validation="fit_only")
+            YA = A.fit_transform(X)
+            YB = B.fit_transform(X)
+            ZA = A.transform(X)
+            ZB = B.transform(X)
+            if sparse:
+                YA, YB, ZA, ZB = [M.todense() for M in (YA, YB, ZA, ZB)]
+            self.assertTrue(numpy.array_equal(YA, YB))
+            self.assertTrue(numpy.array_equal(ZA, ZB))
+            self.assertEqual(B.policy.validated, len(X))
+            self.assertEqual(B.policy.skipped, len(X))
+
     def test_sparse_single_zero(self):
         random.seed("something about us")
         V = FeatureMappingFlattener(sparse=True)
@@ -246,6 +482,196 @@ class TestFeatureMappingFlattener(unittest.TestCase):
         self.assertEqual(X.shape[0], 1)
 
 
+class TestNumericTransform(unittest.TestCase):
+    X = [(1, [1.0, 0.0], 2.5),
+         (0.0, (3, 4), -1.0),
+         (2.5, numpy.array([0.5, 0.0]), 0.0)]
+    EXPECTED = [[1.0, 1.0, 0.0, 2.5],
+                [0.0, 3.0, 4.0, -1.0],
+                [2.5, 0.5, 0.0, 0.0]]
+
+    def transform(self, V, X, **kwargs):
+        result = V.transform(X, **kwargs)
+        return result.toarray() if V.sparse else result
+
+    def test_numbers_are_transformed_at_once(self):
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            with mock.patch.object(V, "_transform_step") as step:
+                Z = V.fit_transform(self.X)
+                if sparse:
+                    self.assertIsInstance(Z, scipy.sparse.csr_matrix)
+                    self.assertEqual(Z.nnz, 8)
+                    Z = Z.toarray()
+                self.assertTrue(numpy.array_equal(Z, self.EXPECTED))
+                Z = self.transform(V, iter(self.X[::-1]))
+                self.assertTrue(numpy.array_equal(Z, self.EXPECTED[::-1]))
+                self.assertFalse(step.called)
+
+    def test_same_result_as_general_path(self):
+        # Values converted by validation, or written as they are without it
+        for validation, x in [("always", (u"1.5", [2, 3], True)),
+                              ("never", (numpy.int64(2), (True, 3), 1))]:
+            V = FeatureMappingFlattener(sparse=False, validation=validation)
+            V.fit(self.X)
+            X = self.X + [x]
+            expected = numpy.zeros((len(X), V.n_columns))
+            for x, row in zip(X, expected):
+                if validation == "always":
+                    x = V.validator.validate(x)
+                V._transform_step(x, row)
+            self.assertTrue(numpy.array_equal(V.transform(X), expected))
+
+    def test_bad_values(self):
+        V = FeatureMappingFlattener()
+        V.fit(self.X)
+        for x in [(1.0, [1.0, 2.0]), [1.0, [1.0, 2.0], 3.0],
+                  (None, [1.0, 2.0], 3.0),
+                  (u"a", [1.0, 2.0], 3.0), (1.0, [1.0], 3.0),
+                  (1.0, [1.0, u"2"], 3.0), (1.0, numpy.array([1, 2]), 3.0)]:
+            with self.assertRaises(ValueError) as raised:
+                V.transform(self.X + [x])
+            with self.assertRaises(Exception) as expected:
+                V.validator.validate(x)
+            self.assertEqual(raised.exception.args, expected.exception.args)
+
+    def test_out(self):
+        V = FeatureMappingFlattener(sparse=False)
+        V.fit(self.X)
+        out = numpy.ones((4, 4))
+        Z = V.transform(self.X, out=out)
+        self.assertTrue(numpy.array_equal(out[:3], self.EXPECTED))
+        self.assertEqual(Z.shape, (3, 4))
+        self.assertRaises(ValueError, V.transform, self.X * 2, out=out)
+
+
+class TestFusedTransform(unittest.TestCase):
+    X = [(1, u"a", [u"x", u"y", u"x"], [1.0, 0.0]),
+         (0.0, u"b", [], [0.0, 2.5]),
+         (2.5, u"c", [u"y", u"z"], (3, 4)),
+         (4.0, u"a", [u"w"], [0.0, 0.0])]
+    functions = [itemgetter(i) for i in range(4)]
+    OPTIONS = [{}, {"hashing": 8}, {"min_count": 2, "other_bucket": True}]
+
+    def test_same_result_as_transform(self):
+        for options in self.OPTIONS:
+            for sparse in [True, False]:
+                V = FeatureMappingFlattener(sparse=sparse, **options)
+                V.fit(self.X[:3])
+                A = V.transform(self.X)
+                B = V.fused_transform(iter(self.X), self.functions)
+                if sparse:
+                    self.assertIsInstance(B, scipy.sparse.csr_matrix)
+                    A, B = A.toarray(), B.toarray()
+                self.assertTrue(numpy.array_equal(A, B))
+
+    def test_bad_values(self):
+        V = FeatureMappingFlattener()
+        V.fit(self.X)
+        self.assertRaises(ValueError, V.fused_transform, self.X,
+                          self.functions[:3])
+        bad = [(u"a", u"a", [], [1.0, 2.0])]
+        self.assertRaises(ValueError, V.fused_transform, bad, self.functions)
+        bad = [(1.0, u"a", [], [1.0])]
+        self.assertRaises(ValueError, V.fused_transform, bad, self.functions)
+
+    def test_unchecked_functions(self):
+        def double(x):
+            return 2 * x[0]
+
+        V = FeatureMappingFlattener(sparse=False, validation="never")
+        V.fit(self.X)
+        skipped = V.policy.skipped
+        functions = [lambda x: 1 / 0] + self.functions[1:]
+        Z = V.fused_transform(self.X, functions,
+                              [double] + self.functions[1:])
+        self.assertEqual(Z[:, 0].tolist(), [2.0, 0.0, 5.0, 8.0])
+        # One validation per function and one per tuple
+        self.assertEqual(V.policy.skipped - skipped, 5 * len(self.X))
+
+
+class TestDtypes(unittest.TestCase):
+    X = [(1.0, u"a", [u"x", u"y"]),
+         (2.0, u"b", []),
+         (0.0, u"a", [u"y"])]
+
+    def transforms(self, V):
+        yield V.fit_transform(self.X)
+        yield V.transform(self.X)
+        yield V.transform_columns([list(zip(*self.X))])
+        yield next(V.transform_chunks(self.X, 2))
+
+    def test_dtype(self):
+        expected = FeatureMappingFlattener(sparse=False).fit_transform(self.X)
+        for sparse in [True, False]:
+            for dtype in [numpy.float32, numpy.float64]:
+                V = FeatureMappingFlattener(sparse=sparse, dtype=dtype)
+                for Z in self.transforms(V):
+                    self.assertEqual(Z.dtype, dtype)
+                    if sparse:
+                        Z = Z.toarray()
+                    self.assertTrue(numpy.array_equal(Z, expected[:len(Z)]))
+
+    def test_index_dtype(self):
+        for index_dtype in [numpy.int32, numpy.int64]:
+            V = FeatureMappingFlattener(index_dtype=index_dtype)
+            for Z in self.transforms(V):
+                self.assertEqual(Z.indices.dtype, index_dtype)
+                self.assertEqual(Z.indptr.dtype, index_dtype)
+
+    def test_bad_dtypes(self):
+        self.assertRaises(ValueError, FeatureMappingFlattener, dtype=int)
+        self.assertRaises(ValueError, FeatureMappingFlattener,
+                          index_dtype=numpy.int16)
+
+    def test_sparse_formats(self):
+        functions = [itemgetter(i) for i in range(3)]
+        numeric = [(x, [x, 0.0]) for x, _, _ in self.X]
+        for options in [{}, {"min_count": 2, "other_bucket": True}]:
+            for index_dtype in [numpy.int32, numpy.int64]:
+                for sparse_format in ["csr", "csc", "coo"]:
+                    V = FeatureMappingFlattener(sparse=sparse_format,
+                                                index_dtype=index_dtype,
+                                                **options)
+                    W = FeatureMappingFlattener(sparse=False, **options)
+                    expected = W.fit_transform(self.X)
+                    results = [(Z, expected) for Z in self.transforms(V)]
+                    results.append((V.fused_transform(self.X, functions),
+                                    expected))
+                    results.append((V.fit_transform(numeric),
+                                    W.fit_transform(numeric)))
+                    for Z, expected in results:
+                        self.assertEqual(Z.format, sparse_format)
+                        if sparse_format == "coo":
+                            indices = [Z.row, Z.col]
+                        else:
+                            indices = [Z.indices, Z.indptr]
+                        for array in indices:
+                            self.assertEqual(array.dtype, index_dtype)
+                        if sparse_format == "csc":
+                            self.assertTrue(Z.has_sorted_indices)
+                        self.assertTrue(numpy.array_equal(
+                            Z.toarray(), expected[:Z.shape[0]]))
+        self.assertEqual(FeatureMappingFlattener().sparse_format, "csr")
+        self.assertRaises(ValueError, FeatureMappingFlattener, sparse="dok")
+
+    def test_indices_are_promoted(self):
+        rows = flattener._SparseRows(numpy.float64, numpy.int32)
+        rows.add_row([(0, 1.0), (3, 2.0)])
+        self.assertEqual(rows.indptr.typecode, "i")
+        # Pretend the limit of 32 bit indices was reached
+        original = flattener._INT32_MAX
+        flattener._INT32_MAX = 2
+        try:
+            rows.add_row([(1, 3.0)])
+        finally:
+            flattener._INT32_MAX = original
+        data, indices, indptr = rows.arrays()
+        self.assertEqual(indices.dtype, numpy.int64)
+        self.assertEqual(indptr.tolist(), [0, 2, 3])
+        self.assertEqual(indices.tolist(), [0, 3, 1])
+
+
 class TestBagOfWordsFit(unittest.TestCase):
 
     def make_every_list_(self, X, what):
@@ -367,3 +793,278 @@ class TestBagOfWordsTransform(unittest.TestCase):
         B = FeatureMappingFlattener(sparse=False)
         YB = B.fit_transform(X)
         self.assertTrue(numpy.array_equal(YA, YB))
+
+    def test_transform_columns_is_equivalent(self):
+        random.seed("the man who sold the world")
+        X = list(self._get_random_tuples())
+        V = FeatureMappingFlattener(sparse=False)
+        V.fit(X)
+        Z = V.transform_columns([list(zip(*X))])
+        self.assertTrue(numpy.array_equal(V.transform(X), Z))
+
+
+class TestHashingFlattener(unittest.TestCase):
+    X = [(1.5, u"red", [u"a", u"b", u"a"]),
+         (2.0, u"green", []),
+         (0.0, u"blue", [u"c"])]
+
+    def test_shape_does_not_depend_on_vocabulary(self):
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse, hashing=16)
+            Z = V.fit_transform(self.X)
+            self.assertEqual(Z.shape, (3, 1 + 16 + 16))
+            self.assertEqual(V.indexes, {(0, None): 0})
+            Z = V.transform([(3.0, u"never seen", [u"x", u"y"])])
+            self.assertEqual(Z.shape, (1, 1 + 16 + 16))
+
+    def test_fit_only_needs_the_first_tuple(self):
+        V = FeatureMappingFlattener(hashing=8)
+        X = iter(self.X)
+        V.fit(X)
+        self.assertEqual(len(list(X)), 2)
+
+    def test_values(self):
+        V = FeatureMappingFlattener(sparse=False, hashing=1024,
+                                    alternate_sign=False)
+        Z = V.fit_transform(self.X)
+        self.assertEqual(Z[:, 0].tolist(), [1.5, 2.0, 0.0])
+        # One-hot: a single 1 in the block
+        self.assertEqual(Z[:, 1:1025].sum(axis=1).tolist(), [1.0] * 3)
+        # Bag: counts add up to the bag size
+        self.assertEqual(Z[:, 1025:].sum(axis=1).tolist(), [3.0, 0.0, 1.0])
+        self.assertEqual(Z[0, 1025:].max(), 2.0)
+
+    def test_alternate_sign(self):
+        V = FeatureMappingFlattener(sparse=False, hashing=1024)
+        Z = V.fit_transform([(u"v%d" % i,) for i in range(200)])
+        self.assertEqual(set(numpy.abs(Z).sum(axis=1)), set([1.0]))
+        self.assertTrue((Z < 0).any())
+        self.assertTrue((Z > 0).any())
+
+    def test_sparse_is_equivalent(self):
+        for alternate_sign in [True, False]:
+            A = FeatureMappingFlattener(sparse=True, hashing=4,
+                                        alternate_sign=alternate_sign)
+            B = FeatureMappingFlattener(sparse=False, hashing=4,
+                                        alternate_sign=alternate_sign)
+            YA = A.fit_transform(self.X).todense()
+            self.assertTrue(numpy.array_equal(YA, B.fit_transform(self.X)))
+            Z = B.transform_columns([list(zip(*self.X))])
+            self.assertTrue(numpy.array_equal(YA, Z))
+
+    def test_column_info(self):
+        V = FeatureMappingFlattener(hashing=16)
+        V.fit(self.X)
+        self.assertEqual(V.column_info(0), (0, None))
+        self.assertEqual(V.column_info(1), (1, flattener.HashedValue(0)))
+        self.assertEqual(V.column_info(20), (2, flattener.HashedValue(3)))
+        self.assertRaises(IndexError, V.column_info, 33)
+
+    def test_invalid_hashing(self):
+        self.assertRaises(ValueError, FeatureMappingFlattener, hashing=0)
+
+    def test_hash_is_the_same_on_every_process(self):
+        values = [u"a", (u"a", 1), frozenset([u"x", u"y", u"z"]), 2.5]
+        code = ("from featureforge.flattener import _hash; "
+                "print([_hash(v) for v in %r])" % (values,))
+        root = os.path.dirname(os.path.dirname(flattener.__file__))
+        outputs = set()
+        for seed in ["1", "2", "3"]:
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+            outputs.add(subprocess.check_output([sys.executable, "-c", code],
+                                                env=env))
+        self.assertEqual(len(outputs), 1)
+        self.assertEqual(outputs.pop().decode("ascii").strip(),
+                         str([flattener._hash(v) for v in values]))
+
+    def test_bag_element_type_is_learned(self):
+        X = [(1.0, []), (2.0, [u"a"]), (3.0, [1])]
+        V = FeatureMappingFlattener(hashing=8)
+        V.fit(X)
+        self.assertIs(V.schema[1].elem_type, str)
+        self.assertRaises(ValueError, V.transform, [(1.0, [1])])
+        self.assertRaises(ValueError, V.fit_transform, X)
+
+
+class TestVocabularyPruning(unittest.TestCase):
+    X = [(1.0, u"a", [u"x", u"y"]),
+         (2.0, u"b", [u"x"]),
+         (3.0, u"a", [u"x", u"z", u"z"]),
+         (4.0, u"c", [u"y"]),
+         (5.0, u"a", [u"w"])]
+
+    def columns(self, V):
+        return [V.column_info(j) for j in range(V.n_columns)]
+
+    def test_min_count(self):
+        V = FeatureMappingFlattener(min_count=2)
+        V.fit(self.X)
+        self.assertEqual(self.columns(V),
+                         [(0, None), (1, u"a"), (2, u"x"), (2, u"y")])
+
+    def test_max_columns_per_feature(self):
+        V = FeatureMappingFlattener(max_columns_per_feature=1)
+        V.fit(self.X)
+        self.assertEqual(self.columns(V), [(0, None), (1, u"a"), (2, u"x")])
+
+    def test_max_total_columns(self):
+        V = FeatureMappingFlattener(max_total_columns=3)
+        V.fit(self.X)
+        # a and x appear 3 times, y twice and comes before b (also twice)
+        self.assertEqual(self.columns(V),
+                         [(0, None), (1, u"a"), (2, u"x"), (2, u"y")])
+
+    def test_other_bucket(self):
+        V = FeatureMappingFlattener(sparse=False, min_count=2,
+                                    other_bucket=True)
+        Z = V.fit_transform(self.X)
+        self.assertEqual(self.columns(V)[-2:],
+                         [(1, flattener.OTHER), (2, flattener.OTHER)])
+        # columns: number, a, x, y, other string, other bag
+        self.assertEqual(Z.tolist(), [[1, 1, 1, 1, 0, 0],
+                                      [2, 0, 1, 0, 1, 0],
+                                      [3, 1, 1, 0, 0, 2],
+                                      [4, 0, 0, 1, 1, 0],
+                                      [5, 1, 0, 0, 0, 1]])
+        Z = V.transform([(0.0, u"new", [u"new", u"x", u"z"])])
+        self.assertEqual(Z.tolist(), [[0, 0, 1, 0, 1, 2]])
+
+    def test_fit_transform_equivalent(self):
+        options = [dict(min_count=2), dict(max_columns_per_feature=2),
+                   dict(max_total_columns=2, other_bucket=True),
+                   dict(min_count=3, other_bucket=True)]
+        for kwargs in options:
+            for sparse in [True, False]:
+                A = FeatureMappingFlattener(sparse=sparse, **kwargs)
+                YA = A.fit_transform(self.X)
+                B = FeatureMappingFlattener(sparse=sparse, **kwargs)
+                B.fit(self.X)
+                YB = B.transform(self.X)
+                if sparse:
+                    YA, YB = YA.todense(), YB.todense()
+                self.assertEqual(A.reverse, B.reverse)
+                self.assertTrue(numpy.array_equal(YA, YB))
+
+    def test_pruning_and_hashing_are_exclusive(self):
+        self.assertRaises(ValueError, FeatureMappingFlattener, hashing=8,
+                          min_count=2)
+
+
+class TestParallelFit(unittest.TestCase):
+
+    def setUp(self):
+        random.seed("paranoid android")
+        words = [u"w%s" % k for k in range(30)]
+        self.X = [(random.random(), random.choice(words),
+                   random.sample(words, random.randint(0, 3)),
+                   [random.choice(PEOPLE)])
+                  for _ in range(200)]
+        patcher = mock.patch.object(flattener, "FIT_CHUNK_SIZE", 7)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertSameFit(self, A, B):
+        self.assertEqual(A.reverse, B.reverse)
+        self.assertEqual(A.other_indexes, B.other_indexes)
+        self.assertEqual([type_.elem_type for type_ in A.schema[2:]],
+                         [type_.elem_type for type_ in B.schema[2:]])
+        self.assertTrue(numpy.array_equal(A.transform(self.X).toarray(),
+                                          B.transform(self.X).toarray()))
+
+    def test_same_columns_as_serial_fit(self):
+        for options in [{}, {"min_count": 3, "other_bucket": True},
+                        {"max_total_columns": 10}]:
+            A = FeatureMappingFlattener(**options)
+            A.fit(self.X)
+            for n_jobs in [2, 3]:
+                B = FeatureMappingFlattener(n_jobs=n_jobs, **options)
+                B.fit(iter(self.X))
+                self.assertSameFit(A, B)
+
+    def test_partial_fit(self):
+        A = FeatureMappingFlattener()
+        A.fit(self.X)
+        B = FeatureMappingFlattener(n_jobs=2)
+        with mock.patch("multiprocessing.Pool",
+                        side_effect=multiprocessing.Pool) as Pool:
+            B.partial_fit(self.X[:50])
+            B.partial_fit(self.X[50:])
+        self.assertSameFit(A, B)
+        # The pool is kept between fits, but not pickled
+        self.assertEqual(Pool.call_count, 1)
+        self.assertNotIn("_workers", pickle.loads(pickle.dumps(B)).__dict__)
+        B.close()
+        self.assertIsNone(B._workers.pool)
+
+    def test_bag_element_type(self):
+        # Empty bags until the first chunk with elements fixes their type
+        X = [(1.0, u"a", [], [])] * 10 + self.X
+        A, B = FeatureMappingFlattener(), FeatureMappingFlattener(n_jobs=2)
+        A.fit(X)
+        B.fit(X)
+        self.assertSameFit(A, B)
+        # Elements of another type in a later chunk are rejected
+        X = X + [(1.0, u"a", [1, 2], [])]
+        self.assertRaises(ValueError, A.fit, X)
+        self.assertRaises(ValueError, B.fit, X)
+
+    def test_bad_values(self):
+        bad = (1.0, u"a", [u"w1"], [PEOPLE[0]], 3.0)
+        X = self.X[:100] + [bad] + self.X[100:]
+        A, B = FeatureMappingFlattener(), FeatureMappingFlattener(n_jobs=2)
+        with self.assertRaises(ValueError) as serial:
+            A.fit(X)
+        with self.assertRaises(ValueError) as parallel:
+            B.fit(X)
+        self.assertEqual(serial.exception.args, parallel.exception.args)
+
+
+class TestSaveLoad(unittest.TestCase):
+    X = [(1.0, u"a", [u"x", u"ñ"], [1.0, 2.0], [PEOPLE[0], PEOPLE[1]]),
+         (2.0, u"", [u"x"], [0.0, 1.0], []),
+         (3.0, u"b", [], [1.0, 1.0], [PEOPLE[2]])]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_save_load(self):
+        new = [(4.0, u"c", [u"ñ", u"y"], [2.0, 0.0], PEOPLE[2:])]
+        for sparse in [True, False]:
+            V = FeatureMappingFlattener(sparse=sparse)
+            V.fit(self.X)
+            V.save(self.path)
+            for mmap in [True, False]:
+                W = FeatureMappingFlattener.load(self.path, mmap=mmap)
+                self.assertEqual(W.n_columns, V.n_columns)
+                self.assertEqual([W.column_info(j)
+                                  for j in range(W.n_columns)],
+                                 [V.column_info(j)
+                                  for j in range(V.n_columns)])
+                # Found in the tables, without building the reverse list
+                self.assertIsNone(getattr(W, "_keys", None))
+                A, B = V.transform(self.X + new), W.transform(self.X + new)
+                if sparse:
+                    A, B = A.toarray(), B.toarray()
+                self.assertTrue(numpy.array_equal(A, B))
+            # Can still be fitted further
+            V.partial_fit(new)
+            W.partial_fit(new)
+            self.assertEqual(W.indexes, V.indexes)
+            self.assertEqual(W.reverse, V.reverse)
+
+    def test_save_load_other_bucket(self):
+        V = FeatureMappingFlattener(sparse=False, min_count=2,
+                                    other_bucket=True)
+        V.fit(self.X)
+        V.save(self.path)
+        W = FeatureMappingFlattener.load(self.path)
+        self.assertEqual([W.column_info(j) for j in range(W.n_columns)],
+                         [V.column_info(j) for j in range(V.n_columns)])
+        new = [(4.0, u"c", [u"x", u"y"], [2.0, 0.0], PEOPLE[2:])]
+        self.assertTrue(numpy.array_equal(V.transform(new),
+                                          W.transform(new)))
+
+    def test_save_unfitted(self):
+        V = FeatureMappingFlattener()
+        self.assertRaises(ValueError, V.save, self.path)
@@ -0,0 +1,92 @@
+import pickle
+import threading
+from unittest import TestCase
+
+from featureforge.feature import input_schema, make_feature
+from featureforge.profiling import FeatureProfile, Profiler
+
+
+@input_schema(int)
+def double(x):
+    return 2 * x
+
+
+def fails_on_zero(x):
+    return 1.0 / x
+
+
+class TestFeatureProfile(TestCase):
+
+    def test_record(self):
+        p = FeatureProfile("f")
+        p.record(1.0, 0.5)
+        p.record(3.0, 0.5, calls=2)
+        stats = p.as_dict()
+        self.assertEqual(stats["calls"], 3)
+        self.assertEqual(stats["evaluate_time"], 4.0)
+        self.assertEqual(stats["validation_time"], 1.0)
+        self.assertEqual(stats["total_time"], 5.0)
+        self.assertAlmostEqual(stats["mean_time"], 5.0 / 3)
+        self.assertEqual(p.percentile(0), 1.5)
+        self.assertEqual(p.percentile(100), 1.75)
+
+    def test_sample_is_bounded(self):
+        p = FeatureProfile("f", sample_size=10, seed=1)
+        for i in range(1000):
+            p.record(float(i))
+        self.assertEqual(len(p.samples), 10)
+        self.assertEqual(p.calls, 1000)
+        self.assertTrue(100 < p.percentile(50) < 900)
+
+    def test_record_from_threads(self):
+        p = FeatureProfile("f", sample_size=10)
+
+        def record():
+            for i in range(10000):
+                p.record(1.0)
+                p.add_error()
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual((p.calls, p.errors), (40000, 40000))
+        self.assertEqual(p.evaluate_time, 40000.0)
+        q = pickle.loads(pickle.dumps(p))
+        q.record(1.0)
+        self.assertEqual(q.calls, 40001)
+
+
+class TestProfiler(TestCase):
+
+    def test_timed_validation(self):
+        profiler = Profiler()
+        feature = make_feature(double)
+        timed = profiler.timed_validation(feature)
+        self.assertEqual(timed(3), 6)
+        self.assertRaises(feature.InputValueError, timed, "x")
+        stats = profiler.report()["double"]
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["errors"], 1)
+        self.assertTrue(stats["validation_time"] > 0)
+
+    def test_timed(self):
+        profiler = Profiler()
+        feature = make_feature(fails_on_zero)
+        timed = profiler.timed(feature, feature._evaluate)
+        self.assertEqual(timed(2), 0.5)
+        self.assertRaises(ZeroDivisionError, timed, 0)
+        stats = profiler.report()["fails_on_zero"]
+        self.assertEqual((stats["calls"], stats["errors"]), (1, 1))
+        self.assertEqual(stats["validation_time"], 0.0)
+
+    def test_format_report(self):
+        profiler = Profiler()
+        profiler.profile(make_feature(double)).record(0.5)
+        profiler.profile(make_feature(fails_on_zero)).record(2.0)
+        lines = profiler.format_report().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("feature"))
+        # Slowest first
+        self.assertTrue(lines[1].startswith("fails_on_zero"))
+        self.assertTrue(lines[2].startswith("double"))
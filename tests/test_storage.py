@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+from scipy.sparse import csr_matrix, vstack
+
+from featureforge import storage
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_dense_roundtrip(self):
+        blocks = [numpy.arange(6.0).reshape(2, 3), numpy.ones((1, 3))]
+        storage.write_dense(iter(blocks), self.path, 3)
+        Z = storage.load_matrix(self.path)
+        self.assertIsInstance(Z, numpy.memmap)
+        self.assertTrue(numpy.array_equal(Z, numpy.vstack(blocks)))
+        # Standard .npy files, readable without featureforge
+        Z = numpy.load(os.path.join(self.path, storage.DENSE_FILE))
+        self.assertEqual(Z.shape, (3, 3))
+
+    def test_sparse_roundtrip(self):
+        blocks = [csr_matrix([[0.0, 1.0, 0.0], [2.0, 0.0, 3.0]]),
+                  csr_matrix((2, 3)),
+                  csr_matrix([[0.0, 0.0, 4.0]])]
+        storage.write_sparse(iter(blocks), self.path, 3)
+        Z = storage.load_matrix(self.path)
+        self.assertIsInstance(Z, csr_matrix)
+        self.assertIsInstance(Z.indices, numpy.memmap)
+        self.assertEqual(Z.indices.dtype, storage.INDEX_DTYPE)
+        self.assertEqual(Z.shape, (5, 3))
+        self.assertTrue(numpy.array_equal(Z.toarray(),
+                                          vstack(blocks).toarray()))
+        self.assertTrue(numpy.array_equal(Z.dot(numpy.ones(3)),
+                                          [1.0, 5.0, 0.0, 0.0, 4.0]))
+
+    def test_empty_matrices(self):
+        storage.write_sparse([], self.path, 4)
+        self.assertEqual(storage.load_matrix(self.path).shape, (0, 4))
+        storage.write_dense([], self.path, 4)
+        self.assertEqual(storage.load_matrix(self.path).shape, (0, 4))
+
+    def test_overwrites_previous_matrix(self):
+        storage.write_dense([numpy.ones((2, 2))], self.path, 2)
+        storage.write_sparse([csr_matrix(numpy.eye(2))], self.path, 2)
+        Z = storage.load_matrix(self.path)
+        self.assertTrue(numpy.array_equal(Z.toarray(), numpy.eye(2)))
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from featureforge import validation_policy
+from featureforge.validation_policy import (
+    ALWAYS, FIT_ONLY, NEVER, ValidationPolicy, make_policy, sample
+)
+
+
+class TestValidationPolicy(TestCase):
+
+    def test_modes(self):
+        for fitting in [True, False]:
+            self.assertTrue(ValidationPolicy(ALWAYS).should_validate(fitting))
+            self.assertFalse(ValidationPolicy(NEVER).should_validate(fitting))
+        policy = ValidationPolicy(FIT_ONLY)
+        self.assertTrue(policy.should_validate(True))
+        self.assertFalse(policy.should_validate(False))
+
+    def test_counters(self):
+        policy = ValidationPolicy(FIT_ONLY)
+        policy.should_validate(True, 3)
+        policy.should_validate(False)
+        policy.should_validate(False, 2)
+        self.assertEqual((policy.validated, policy.skipped), (3, 3))
+        policy.reset_counters()
+        self.assertEqual((policy.validated, policy.skipped), (0, 0))
+
+    def test_sample(self):
+        policy = sample(0.25, seed=42)
+        for _ in range(4000):
+            policy.should_validate(False)
+        self.assertTrue(800 < policy.validated < 1200)
+        self.assertEqual(policy.validated + policy.skipped, 4000)
+        self.assertRaises(ValueError, sample, 1.5)
+        self.assertRaises(ValueError, ValidationPolicy, "sample")
+
+    def test_make_policy(self):
+        self.assertRaises(ValueError, make_policy, "sometimes")
+        self.assertEqual(make_policy("never").mode, NEVER)
+        policy = sample(0.5)
+        self.assertIs(make_policy(policy), policy)
+        old_default = validation_policy.get_default_policy()
+        try:
+            validation_policy.set_default_policy("fit_only")
+            self.assertEqual(make_policy(None).mode, FIT_ONLY)
+        finally:
+            validation_policy.set_default_policy(old_default)
+        self.assertIs(make_policy(None), old_default)
@@ -1,9 +1,28 @@
+import shutil
+import tempfile
 from unittest import TestCase
 
 import mock
 
+import numpy
+
 from featureforge import vectorizer
-from featureforge.feature import Feature
+from featureforge.feature import (
+    Feature, batch_feature, depends_on, input_schema
+)
+from featureforge.storage import load_matrix
+
+
+def word_count(d):
+    return len(d.split())
+
+
+def first_word(d):
+    return d.split()[0]
+
+
+def words(d):
+    return d.split()
 
 
 class TestVectorizer(TestCase):
@@ -36,7 +55,388 @@ class TestVectorizer(TestCase):
         feature = lambda x: 1
         with mock.patch('featureforge.vectorizer.FeatureMappingFlattener') as FMF:
             vectorizer.Vectorizer([feature], sparse=False)
-            FMF.assert_called_once_with(sparse=False)
+            FMF.assert_called_once_with(sparse=False, validation=None,
+                                        hashing=None, dtype=numpy.float64,
+                                        index_dtype=numpy.int32, n_jobs=1)
             FMF.reset_mock()
             vectorizer.Vectorizer([feature], sparse=True)
-            FMF.assert_called_once_with(sparse=True)
+            FMF.assert_called_once_with(sparse=True, validation=None,
+                                        hashing=None, dtype=numpy.float64,
+                                        index_dtype=numpy.int32, n_jobs=1)
+
+    def test_batch_features_produce_same_matrix(self):
+        data = [u"a", u"bbb", u"", u"cc"]
+
+        def length(d):
+            return len(d)
+
+        def identity(d):
+            return d
+
+        @batch_feature
+        def batch_length(data_points):
+            return numpy.array([len(d) for d in data_points], dtype=float)
+
+        for sparse in [True, False]:
+            expected = vectorizer.Vectorizer([length, identity], sparse=sparse)
+            expected.fit(data)
+            v = vectorizer.Vectorizer([batch_length, identity], sparse=sparse)
+            v.fit(data)
+            A, B = expected.transform(data), v.transform(data)
+            if sparse:
+                A, B = A.todense(), B.todense()
+            self.assertTrue(numpy.array_equal(A, B))
+
+    def test_validation_policy(self):
+        calls = []
+
+        @input_schema(int)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        v = vectorizer.Vectorizer([double], validation="fit_only")
+        v.fit_transform([1, 2])
+        policy = v.validation_policy
+        self.assertEqual(policy.skipped, 0)
+        validated = policy.validated
+        self.assertTrue(validated > 0)
+        # Invalid input is not detected when transforming
+        Z = v.transform([3.5])
+        self.assertEqual(Z.todense().tolist(), [[7.0]])
+        self.assertEqual(policy.validated, validated)
+        self.assertTrue(policy.skipped > 0)
+
+        v = vectorizer.Vectorizer([double], validation="always")
+        v.fit([1, 2])
+        with self.assertRaises(ValueError):
+            v.transform([3.5])
+
+    def test_column_to_feature_with_hashing(self):
+        def color(x):
+            return x["color"]
+
+        def size(x):
+            return x["size"]
+
+        v = vectorizer.Vectorizer([color, size], hashing=8)
+        Z = v.fit_transform([{"color": u"red", "size": 3}])
+        self.assertEqual(Z.shape, (1, 9))
+        feature, value = v.column_to_feature(0)
+        self.assertEqual((feature.name, value), ("size", None))
+        feature, value = v.column_to_feature(5)
+        self.assertEqual((feature.name, value.bucket), ("color", 4))
+
+    def test_partial_fit(self):
+        def color(x):
+            return x["color"]
+
+        v = vectorizer.Vectorizer([color], sparse=False)
+        v.partial_fit([{"color": u"red"}, {"color": u"blue"}])
+        first = v.transform([{"color": u"red"}, {"color": u"green"}])
+        self.assertEqual(first.tolist(), [[1.0, 0.0], [0.0, 0.0]])
+        v.partial_fit(iter([{"color": u"green"}]))
+        Z = v.transform([{"color": u"red"}, {"color": u"green"}])
+        self.assertEqual(Z.tolist(), [[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+
+    def test_transform_chunks(self):
+        def length(d):
+            return len(d)
+
+        def identity(d):
+            return d
+
+        data = [u"a", u"bbb", u"", u"cc", u"a"]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([length, identity], sparse=sparse)
+            v.fit(data)
+            blocks = list(v.transform_chunks(iter(data), 2))
+            self.assertEqual([b.shape[0] for b in blocks], [2, 2, 1])
+            A = v.transform(data)
+            if sparse:
+                A = A.todense()
+                blocks = [b.todense() for b in blocks]
+            self.assertTrue(numpy.array_equal(A, numpy.vstack(blocks)))
+
+    def test_transform_to_disk(self):
+        def length(d):
+            return len(d)
+
+        data = [u"a", u"bbb", u"", u"cc", u"a"]
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        v = vectorizer.Vectorizer([length], sparse=False)
+        v.fit(data)
+        Z = v.transform_to_disk(iter(data), path, chunk_size=2)
+        self.assertEqual(Z.tolist(), [[1.0], [3.0], [0.0], [2.0], [1.0]])
+        self.assertEqual(load_matrix(path).tolist(), Z.tolist())
+
+    def test_numeric_features_are_written_by_blocks(self):
+        def length(d):
+            return len(d)
+
+        data = [u"a", u"bbb", u""]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([length, word_count], sparse=sparse)
+            v.fit(data)
+            rows = v.flattener._numeric_rows
+            with mock.patch.object(v.flattener, "_numeric_rows",
+                                   side_effect=rows) as numeric_rows:
+                A = v.transform(iter(data))
+            self.assertEqual(numeric_rows.call_count, 1)
+            if sparse:
+                A = A.toarray()
+            self.assertEqual(A.tolist(), [[1, 1], [3, 1], [0, 0]])
+        out = numpy.full((4, 2), 9.0)
+        self.assertIs(v.transform(data, out=out).base, out)
+        self.assertEqual(out.tolist(), [[1, 1], [3, 1], [0, 0], [9, 9]])
+
+    def test_dtype(self):
+        def length(d):
+            return len(d)
+
+        data = [u"a", u"bbb", u""]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([length], sparse=sparse,
+                                      dtype=numpy.float32)
+            v.fit(data)
+            self.assertEqual(v.transform(data).dtype, numpy.float32)
+            self.assertEqual(v.fit_transform(data).dtype, numpy.float32)
+
+    def test_single_pass_transform_is_equivalent(self):
+        def length(d):
+            return len(d)
+
+        def identity(d):
+            return d
+
+        def letters(d):
+            return list(d)
+
+        data = [u"a", u"bbb", u"", u"cc", u"a", u"dd"]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([length, identity, letters],
+                                      sparse=sparse)
+            v.fit(data[:4])
+            A = v.transform(data)
+            B = v.flattener.transform(v.evaluator.transform(data))
+            if sparse:
+                A, B = A.todense(), B.todense()
+            self.assertTrue(numpy.array_equal(A, B))
+
+    def test_shared_computations(self):
+        calls = []
+
+        def letters(d):
+            calls.append(d)
+            return list(d)
+
+        @depends_on(letters)
+        def length(d, letters):
+            return len(letters)
+
+        @depends_on(letters)
+        def distinct(d, letters):
+            return len(set(letters))
+
+        data = [u"a", u"bbb", u"", u"cc"]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([length, distinct], sparse=sparse)
+            v.fit(data)
+            del calls[:]
+            A = v.transform(data)
+            if sparse:
+                A = A.todense()
+            self.assertEqual(A.tolist(), [[1, 1], [3, 1], [0, 0], [2, 1]])
+            self.assertEqual(calls, data)
+
+    def test_shared_computations_reused_data_point(self):
+        calls = []
+
+        def words(d):
+            calls.append(d["text"])
+            return d["text"].split()
+
+        # Dictionary schemas validate into a new dictionary for each feature
+        @input_schema({"text": str})
+        @depends_on(words)
+        def count(d, words):
+            return len(words)
+
+        @input_schema({"text": str})
+        @depends_on(words)
+        def distinct(d, words):
+            return len(set(words))
+
+        texts = [u"a b c", u"x", u"y y y y"]
+
+        def reusing():
+            # A source modifying the same dictionary for each data point
+            buf = {}
+            for text in texts:
+                buf["text"] = text
+                yield buf
+
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([count, distinct], sparse=sparse)
+            v.fit([{"text": t} for t in texts])
+            del calls[:]
+            A = v.transform(reusing())
+            if sparse:
+                A = A.todense()
+            self.assertEqual(A.tolist(), [[3, 3], [1, 1], [4, 1]])
+            self.assertEqual(calls, texts)
+        # v is dense
+        self.assertEqual(v.transform_one({"text": u"b b"}).tolist(), [2, 1])
+        self.assertEqual(calls, texts + [u"b b"])
+
+    def test_profile_report(self):
+        def length(d):
+            return len(d)
+
+        data = [u"a", u"bbb", u""]
+        v = vectorizer.Vectorizer([length], profile=True)
+        v.fit_transform(data)
+        v.transform(data)
+        report = v.profile_report()
+        self.assertEqual(report["length"]["calls"], 2 * len(data))
+        self.assertTrue(v.profile_report(table=True).startswith("feature"))
+
+    def test_tolerant_transform(self):
+        def length(d):
+            return len(d["text"])
+
+        def first(d):
+            return d["text"][0]
+
+        def words(d):
+            return d["text"].split()
+
+        data = [{"text": u"a b"}, {"text": u"bbb"}, {"text": u"cc"}]
+        bad = [data[0], {"text": None}, data[1]]
+        v = vectorizer.Vectorizer([length, first, words], sparse=False,
+                                  tolerant=True, on_transform_error="skip")
+        v.fit(data)
+        Z, rows = v.transform(bad, return_rows=True)
+        self.assertEqual(rows.tolist(), [0, 2])
+        self.assertTrue(numpy.array_equal(Z, v.transform(data[:2])))
+        out = numpy.ones((3, Z.shape[1]))
+        self.assertIs(v.transform(bad, out=out).base, out)
+        self.assertTrue(numpy.array_equal(out[:2], Z))
+
+        v = vectorizer.Vectorizer([length, first, words], sparse=False,
+                                  tolerant=True, on_transform_error="fill")
+        v.fit(data)
+        Z, rows = v.transform(bad, return_rows=True)
+        self.assertEqual(rows.tolist(), [0, 1, 2])
+        self.assertTrue(numpy.isnan(Z[1, 0]))
+        self.assertEqual(Z[1, 1:].tolist(), [0.0] * (Z.shape[1] - 1))
+        self.assertTrue(numpy.array_equal(Z[[0, 2]], v.transform(data[:2])))
+        # The fill values are given on each call, not kept by the evaluator
+        self.assertTrue(numpy.isnan(v.evaluator.fill_value))
+
+    def test_tolerant_transform_needs_tolerant(self):
+        self.assertRaises(ValueError, vectorizer.Vectorizer, [len],
+                          on_transform_error="skip")
+
+    def test_transform_one(self):
+        def length(d):
+            return len(d)
+
+        def first(d):
+            return d[0] if d else u""
+
+        def letters(d):
+            return list(d)
+
+        data = [u"ab", u"bbb", u"", u"cac"]
+        for sparse in [True, "csc", False]:
+            v = vectorizer.Vectorizer([length, first, letters],
+                                      sparse=sparse)
+            v.fit(data[:3])
+            Z = v.transform(data)
+            if sparse:
+                self.assertEqual(Z.format, v.flattener.sparse_format)
+                Z = Z.toarray()
+            for x, expected in zip(data, Z):
+                result = v.transform_one(x)
+                if sparse:
+                    indices, values = result
+                    result = numpy.zeros(len(expected))
+                    result[indices] = values
+                self.assertTrue(numpy.array_equal(result, expected))
+            many = v.transform_many(data)
+            if not sparse:
+                self.assertTrue(numpy.array_equal(many, Z))
+            else:
+                self.assertEqual(len(many), len(data))
+            # Refitting prepares the row transformer again
+            v.partial_fit([u"d"])
+            self.assertEqual(v.transform(data).shape[1], Z.shape[1] + 2)
+            if not sparse:
+                self.assertEqual(len(v.transform_one(u"d")), Z.shape[1] + 2)
+        out = numpy.ones(v.flattener.n_columns)
+        self.assertIs(v.transform_one(u"a", out=out), out)
+        self.assertEqual(out.sum(), 1 + 1 + 1)
+        self.assertRaises(ValueError, v.transform_one, u"a",
+                          out=numpy.zeros(2))
+
+    def test_transform_one_skipped(self):
+        def length(d):
+            return len(d)
+
+        v = vectorizer.Vectorizer([length], tolerant=True,
+                                  on_transform_error="skip", sparse=False)
+        v.fit([u"a", u"bb"])
+        self.assertEqual(v.transform_one(u"abc").tolist(), [3])
+        self.assertIsNone(v.transform_one(None))
+        self.assertEqual(v.transform_many([u"a", None, u"bb"]).tolist(),
+                         [[1], [2]])
+        v = vectorizer.Vectorizer([length, length], tolerant=True,
+                                  on_transform_error="skip", sparse="csc")
+        v.fit([u"a", u"bb"])
+        indices, values = v.transform_one(u"abc")
+        self.assertEqual(indices.tolist(), [0, 1])
+        self.assertEqual(values.tolist(), [3, 3])
+
+    def test_save_load(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        data = [u"a b", u"c d e", u"b a"]
+        new = data + [u"a z", u"z z"]
+        for sparse in [True, False]:
+            v = vectorizer.Vectorizer([word_count, first_word, words],
+                                      sparse=sparse, validation="fit_only")
+            v.fit(data)
+            v.save(path)
+            w = vectorizer.Vectorizer.load(path)
+            A, B = v.transform(new), w.transform(new)
+            if sparse:
+                A, B = A.toarray(), B.toarray()
+            self.assertTrue(numpy.array_equal(A, B))
+            self.assertEqual(w.column_to_feature(2)[1],
+                             v.column_to_feature(2)[1])
+            self.assertIs(w.validation_policy, w.flattener.policy)
+
+    def test_unpickle_old_state(self):
+        # State of vectorizers and evaluators pickled by the first versions,
+        # without the options added later
+        data = [u"a b", u"c d e", u"b a"]
+        for tolerant in [False, True]:
+            v = vectorizer.Vectorizer([word_count, first_word, words],
+                                      tolerant=tolerant)
+            v.fit(data)
+            evaluator = type(v.evaluator).__new__(type(v.evaluator))
+            evaluator.__setstate__({
+                "features": v.evaluator.features,
+                "alive_features": v.evaluator.alive_features,
+                "fitted": True,
+            })
+            w = vectorizer.Vectorizer.__new__(vectorizer.Vectorizer)
+            w.__setstate__({"evaluator": evaluator,
+                            "flattener": v.flattener})
+            self.assertTrue(numpy.array_equal(w.transform(data).toarray(),
+                                              v.transform(data).toarray()))
+            indices, values = w.transform_one(data[0])
+            self.assertEqual(len(indices), len(values))
+            w.fit(data)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+from unittest import TestCase
+
+from featureforge.flattener import OTHER
+from featureforge.vocabulary import (
+    Indexes, MappedVocabulary, VocabularyTable, load_vocabularies,
+    save_vocabularies
+)
+
+
+class TestVocabularyTable(TestCase):
+
+    def test_lookup(self):
+        items = [(u"pepsi", 3), (u"coca", 1), (u"", 7), (u"ñandú", 2)]
+        table = VocabularyTable.build(items)
+        self.assertEqual(len(table), 4)
+        for value, j in items:
+            self.assertEqual(table.get(value), j)
+            # Found again in the cache of lookups
+            self.assertEqual(table.get(value), j)
+        self.assertIsNone(table.get(u"fanta"))
+        self.assertEqual(table.get(u"fanta", -1), -1)
+        self.assertEqual(sorted(table.items()), sorted(items))
+
+
+class TestIndexes(TestCase):
+
+    def test_lookup(self):
+        indexes = Indexes({1: {u"a": 1, u"b": 4}, 2: {u"a": 5, 5: 6}},
+                          {0: (0, None), 3: (2, 2)})
+        expected = {(0, None): 0, (1, u"a"): 1, (3, 0): 2, (3, 1): 3,
+                    (1, u"b"): 4, (2, u"a"): 5, (2, 5): 6}
+        self.assertEqual(len(indexes), len(expected))
+        self.assertEqual(indexes, expected)
+        for key, j in expected.items():
+            self.assertEqual(indexes[key], j)
+        for key in [(0, 0), (3, None), (3, 2), (1, u"c"), (4, None)]:
+            self.assertNotIn(key, indexes)
+        self.assertRaises(KeyError, indexes.__getitem__, (1, u"c"))
+        self.assertEqual(indexes.reverse(),
+                         sorted(expected, key=expected.get))
+
+
+class TestMappedVocabulary(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_save_load(self):
+        vocabularies = {1: {u"a": 1, u"b": 4, OTHER: 5},
+                        2: {u"a": 2, 5: 3}, 3: {7: 6}}
+        save_vocabularies(vocabularies, self.path)
+        for mmap in [True, False]:
+            loaded = load_vocabularies(self.path, mmap=mmap)
+            self.assertEqual(sorted(loaded), [1, 2, 3])
+            for i, vocabulary in vocabularies.items():
+                self.assertIsInstance(loaded[i], MappedVocabulary)
+                self.assertEqual(len(loaded[i]), len(vocabulary))
+                self.assertEqual(dict(loaded[i].items()), vocabulary)
+                for value, j in vocabulary.items():
+                    self.assertEqual(loaded[i][value], j)
+                    self.assertIn(value, loaded[i])
+            self.assertNotIn(u"c", loaded[1])
+            self.assertNotIn(u"a", loaded[3])
+            self.assertRaises(KeyError, loaded[2].__getitem__, 6)